@@ -0,0 +1,67 @@
+"""
+Benchmarks for brc_bids, run with pytest-benchmark
+
+Usage:
+python -m pytest benchmarks [--bench-subjects <n>,<n>...] [--bench-sessions <n>] [--bench-workdir <dir>] [--bench-submit]
+
+Benchmarks are not collected by a plain ``python -m pytest``, see pytest.ini.
+
+Results are compared with a saved baseline in benchmarks/.benchmarks using the usual
+pytest-benchmark options. The committed baseline covers datasets of 10 and 1000
+subjects, e.g. to fail if anything is more than 25% slower than the baseline:
+
+python -m pytest benchmarks --bench-subjects 10,1000 --bench-workdir <dir> --benchmark-compare=0001 --benchmark-compare-fail=min:25%
+
+There is no 10000 subject baseline: pybids needed more than the 6 GB of memory on the
+machine the baseline was saved on to index a dataset of that size. Timings depend on
+the machine and filesystem, so a baseline is only meaningful on the machine it was
+saved on. Save a new one with --benchmark-save=<name>, and keep large generated
+datasets in --bench-workdir between runs.
+"""
+import os
+import shutil
+
+import pytest
+
+import synth
+
+# Default dataset sizes (number of subjects) and sessions per subject
+DATASET_SUBJECTS = "10"
+DATASET_SESSIONS = 2
+
+BENCHMARK_STORAGE = "file://" + os.path.join(os.path.dirname(os.path.abspath(__file__)), ".benchmarks")
+
+def pytest_addoption(parser):
+    parser.addoption("--bench-subjects", default=DATASET_SUBJECTS, help="Comma separated dataset sizes in subjects, e.g. 10,1000,10000")
+    parser.addoption("--bench-sessions", type=int, default=DATASET_SESSIONS, help="Number of sessions per subject")
+    parser.addoption("--bench-workdir", help="Directory to keep generated datasets in. If not specified a temporary directory is used")
+    parser.addoption("--bench-submit", action="store_true", default=False, help="Also time cluster submission using stub fsl_sub and preprocessing scripts")
+
+def pytest_configure(config):
+    # Baselines are kept with the benchmarks rather than in the working directory
+    if config.getoption("benchmark_storage", None) == "file://./.benchmarks":
+        config.option.benchmark_storage = BENCHMARK_STORAGE
+
+def pytest_generate_tests(metafunc):
+    if "subjects" in metafunc.fixturenames:
+        subjects = [int(n) for n in metafunc.config.getoption("bench_subjects").split(",")]
+        metafunc.parametrize("subjects", subjects, scope="session")
+
+@pytest.fixture(scope="session")
+def dataset(request, subjects, tmp_path_factory):
+    """
+    Synthetic dataset with the requested number of subjects
+
+    Datasets in --bench-workdir are only generated once
+
+    :return: Dataset root directory
+    """
+    sessions = request.config.getoption("bench_sessions")
+    workdir = request.config.getoption("bench_workdir") or str(tmp_path_factory.getbasetemp())
+    root = os.path.join(workdir, f"ds-{subjects}x{sessions}")
+    marker = os.path.join(root, ".complete")
+    if not os.path.exists(marker):
+        shutil.rmtree(root, ignore_errors=True)
+        synth.make_dataset(root, subjects, sessions)
+        open(marker, "w").close()
+    return root
@@ -0,0 +1,231 @@
+"""
+Synthetic BIDS datasets for benchmarking
+
+Generates BIDS trees of any size containing everything the pipeline looks at:
+structural, diffusion and ASL images with JSON sidecars, ASL contexts and M0
+calibration images, both alongside the ASL data and as fieldmaps. Images consist of
+a NIfTI header only, which is all the pipeline reads, so very large datasets can be
+generated quickly and take little space.
+
+Stub versions of fsl_sub and the preprocessing scripts can also be written so the
+pipeline can be run end to end without a cluster or FSL.
+
+Usage:
+python benchmarks/synth.py <output dir> [--subjects <n>] [--sessions <n>] [--stubs <bin dir>]
+"""
+import argparse
+import gzip
+import json
+import os
+import stat
+import struct
+
+# Order of label/control images in the ASL data of successive subjects
+ASL_ORDERS = ("tc", "ct", "blocked")
+
+# Post labelling delays used for multi-PLD ASL data
+MULTI_PLDS = (0.25, 0.5, 0.75, 1.0, 1.25)
+
+# Scripts which need stubs to run the pipeline, other than fsl_sub
+STUB_COMMANDS = ("struc_preproc.sh", "dMRI_preproc.sh", "oxasl", "idp_extract.sh", "singularity")
+
+def nifti_header(shape, voxel_size=(3.0, 3.0, 3.0)):
+    """
+    Create a NIfTI-1 header for a single file (.nii) image with no image data
+
+    :param shape: Image shape
+    :param voxel_size: Voxel dimensions in mm
+    :return: Header bytes including the (empty) extension flag
+    """
+    hdr = bytearray(348)
+    struct.pack_into("<i", hdr, 0, 348)
+    dim = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    struct.pack_into("<8h", hdr, 40, *dim)
+    # Datatype int16, 16 bits per voxel
+    struct.pack_into("<2h", hdr, 70, 4, 16)
+    pixdim = [1.0] + list(voxel_size) + [1.0] * 4
+    struct.pack_into("<8f", hdr, 76, *pixdim)
+    struct.pack_into("<f", hdr, 108, 352.0)
+    # Units mm and seconds
+    struct.pack_into("<B", hdr, 123, 10)
+    # sform only
+    struct.pack_into("<2h", hdr, 252, 0, 1)
+    struct.pack_into("<4f", hdr, 280, voxel_size[0], 0, 0, 0)
+    struct.pack_into("<4f", hdr, 296, 0, voxel_size[1], 0, 0)
+    struct.pack_into("<4f", hdr, 312, 0, 0, voxel_size[2], 0)
+    hdr[344:348] = b"n+1\0"
+    return bytes(hdr) + b"\0\0\0\0"
+
+def write_image(fname, shape):
+    """
+    Write a header-only NIfTI image, gzipped if the filename ends in .gz
+    """
+    hdr = nifti_header(shape)
+    if fname.endswith(".gz"):
+        with gzip.GzipFile(fname, "wb", mtime=0) as f:
+            f.write(hdr)
+    else:
+        with open(fname, "wb") as f:
+            f.write(hdr)
+
+def write_json(fname, data):
+    with open(fname, "w") as f:
+        json.dump(data, f, indent=2)
+
+def make_dataset(root, subjects=10, sessions=2, repeats=5, shape=(64, 64, 24)):
+    """
+    Create a synthetic BIDS dataset
+
+    Successive subjects cycle through single-PLD interleaved label-control, multi-PLD
+    control-label and multi-PLD blocked ASL data. Existing files are overwritten.
+
+    :param root: Dataset root directory
+    :param subjects: Number of subjects
+    :param sessions: Number of sessions per subject. If zero, subjects have no session level
+    :param repeats: Number of repeats of each PLD in the ASL data
+    :param shape: 3D image shape
+    """
+    os.makedirs(root, exist_ok=True)
+    write_json(os.path.join(root, "dataset_description.json"), {"Name" : "brc_bids synthetic dataset", "BIDSVersion" : "1.8.0"})
+    # Inherited by all DWI images
+    write_json(os.path.join(root, "dwi.json"), {"EffectiveEchoSpacing" : 0.0005, "PhaseEncodingDirection" : "j"})
+
+    width = len(str(subjects - 1))
+    with open(os.path.join(root, "participants.tsv"), "w") as f:
+        f.write("participant_id\n")
+        for idx in range(subjects):
+            f.write(f"sub-{idx:0{width}d}\n")
+
+    nslices = shape[2]
+    slice_timing = [0.04 * (idx % (nslices // 2)) for idx in range(nslices)]
+    for idx in range(subjects):
+        subject = f"{idx:0{width}d}"
+        asl_order = ASL_ORDERS[idx % len(ASL_ORDERS)]
+        for session in [str(sess + 1) for sess in range(sessions)] or [None]:
+            sessdir = os.path.join(root, f"sub-{subject}")
+            prefix = f"sub-{subject}"
+            if session is not None:
+                sessdir = os.path.join(sessdir, f"ses-{session}")
+                prefix += f"_ses-{session}"
+            for datatype in ("anat", "dwi", "perf", "fmap"):
+                os.makedirs(os.path.join(sessdir, datatype), exist_ok=True)
+
+            anat = os.path.join(sessdir, "anat", prefix)
+            write_image(f"{anat}_T1w.nii.gz", shape)
+            write_json(f"{anat}_T1w.json", {"RepetitionTime" : 2.0, "EchoTime" : 0.003})
+
+            dwi = os.path.join(sessdir, "dwi", prefix)
+            write_image(f"{dwi}_dir-AP_dwi.nii.gz", shape + (33,))
+            write_image(f"{dwi}_dir-PA_dwi.nii.gz", shape + (3,))
+            write_json(f"{dwi}_dir-PA_dwi.json", {"PhaseEncodingDirection" : "j-"})
+
+            _make_asl(os.path.join(sessdir, "perf", prefix), asl_order, repeats, shape, slice_timing)
+
+            fmap = os.path.join(sessdir, "fmap", f"{prefix}_dir-PA")
+            write_image(f"{fmap}_m0scan.nii.gz", shape)
+            write_json(f"{fmap}_m0scan.json", {
+                "RepetitionTimePreparation" : 6.0, "EchoTime" : 0.012,
+                "PhaseEncodingDirection" : "j-", "TotalReadoutTime" : 0.03,
+            })
+
+def _make_asl(prefix, order, repeats, shape, slice_timing):
+    """
+    Write ASL data, its sidecar, ASL context and separate M0 image
+    """
+    plds = [1.8] if order == "tc" else list(MULTI_PLDS)
+    pair_plds = [pld for _rpt in range(repeats) for pld in plds]
+    if order == "tc":
+        volume_types = ["label", "control"] * len(pair_plds)
+        volume_plds = [pld for pld in pair_plds for _pair in range(2)]
+    elif order == "ct":
+        volume_types = ["control", "label"] * len(pair_plds)
+        volume_plds = [pld for pld in pair_plds for _pair in range(2)]
+    else:
+        volume_types = ["label"] * len(pair_plds) + ["control"] * len(pair_plds)
+        volume_plds = pair_plds + pair_plds
+
+    write_image(f"{prefix}_asl.nii.gz", shape + (len(volume_types),))
+    write_json(f"{prefix}_asl.json", {
+        "ArterialSpinLabelingType" : "PCASL",
+        "PostLabelingDelay" : volume_plds,
+        "LabelingDuration" : 1.8,
+        "M0Type" : "Separate",
+        "RepetitionTimePreparation" : 4.0,
+        "RepetitionTime" : 4.0,
+        "EchoTime" : 0.012,
+        "SliceTiming" : slice_timing,
+        "MagneticFieldStrength" : 3,
+        "BackgroundSuppression" : False,
+        "VascularCrushing" : False,
+        "AcquisitionVoxelSize" : [3, 3, 3],
+    })
+    with open(f"{prefix}_aslcontext.tsv", "w") as f:
+        f.write("volume_type\n" + "\n".join(volume_types) + "\n")
+
+    write_image(f"{prefix}_m0scan.nii.gz", shape)
+    write_json(f"{prefix}_m0scan.json", {"RepetitionTimePreparation" : 6.0, "EchoTime" : 0.012})
+
+def make_oxasl_outputs(outdir, subject_sessions, shape=(64, 64, 24)):
+    """
+    Create synthetic oxasl output directories as the pipeline would
+
+    :param outdir: Pipeline output directory
+    :param subject_sessions: Sequence of (subject, session) tuples
+    :return: List of dicts with keys oxasl_dir, subject, session, as for oxasl.oxasl_outputs_to_bids
+    """
+    from brc_bids.oxasl import OXASL_OUTPUT_MAPPING
+    outputs = []
+    for subject, session in subject_sessions:
+        oxasl_dir = os.path.join(outdir, f"{subject}_{session}", "oxasl")
+        for space in ("native", "struct"):
+            spacedir = os.path.join(oxasl_dir, f"{space}_space")
+            os.makedirs(spacedir, exist_ok=True)
+            for name in OXASL_OUTPUT_MAPPING:
+                write_image(os.path.join(spacedir, f"{name}.nii.gz"), shape)
+        outputs.append({"oxasl_dir" : oxasl_dir, "subject" : subject, "session" : session})
+    return outputs
+
+def write_stubs(bindir, latency=0.0):
+    """
+    Write stub versions of fsl_sub and the preprocessing scripts
+
+    The fsl_sub stub does not run anything. It appends its arguments to fsl_sub.log in
+    the same directory and prints a job ID. The other stubs exit successfully
+    without doing anything.
+
+    :param bindir: Directory to write stubs to. This should be put at the start of $PATH
+    :param latency: Seconds fsl_sub takes to respond, to simulate a loaded scheduler
+    """
+    os.makedirs(bindir, exist_ok=True)
+    log = os.path.join(os.path.abspath(bindir), "fsl_sub.log")
+    _write_script(os.path.join(bindir, "fsl_sub"), "\n".join([
+        "#!/bin/sh",
+        f"sleep {latency}" if latency else "",
+        f'echo "$@" >> "{log}"',
+        # The process ID is unique among running stubs so serves as a job ID
+        "echo $$",
+    ]))
+    for command in STUB_COMMANDS:
+        _write_script(os.path.join(bindir, command), "#!/bin/sh\nexit 0")
+
+def _write_script(fname, content):
+    with open(fname, "w") as f:
+        f.write(content + "\n")
+    os.chmod(fname, os.stat(fname).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+def main():
+    parser = argparse.ArgumentParser(prog="synth.py", add_help=True)
+    parser.add_argument("output", help="Directory to create dataset in")
+    parser.add_argument("--subjects", type=int, default=10, help="Number of subjects")
+    parser.add_argument("--sessions", type=int, default=2, help="Number of sessions per subject. 0 for no session level")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of repeats of each PLD in ASL data")
+    parser.add_argument("--stubs", help="Also write stub fsl_sub and preprocessing scripts to this directory")
+    parser.add_argument("--latency", type=float, default=0.0, help="Response time of stub fsl_sub in seconds")
+    args = parser.parse_args()
+
+    make_dataset(args.output, args.subjects, args.sessions, args.repeats)
+    if args.stubs:
+        write_stubs(args.stubs, args.latency)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Benchmarks for reading and interpreting ASL contexts with many volumes, in each of
+the label/control orderings we support
+"""
+import numpy as np
+import pytest
+
+from brc_bids import aslcontext
+
+# Minimum number of volumes in each context
+ASLCONTEXT_VOLUMES = 10000
+
+def synthetic_aslcontexts(volumes=ASLCONTEXT_VOLUMES, nplds=5, ncalib=2, seed=0):
+    """
+    Generate synthetic ASL contexts
+
+    :param volumes: Minimum number of volumes in each context. This is rounded up to
+                    whole repeats of all PLDs
+    :return: Dict mapping expected order to tuple of volume type names, per-volume PLDs
+    """
+    rng = np.random.default_rng(seed)
+    nrpts = max(1, -(-(volumes - ncalib) // (2 * nplds)))
+    plds = np.tile(np.linspace(0.25, 1.75, nplds), nrpts)
+    npairs = len(plds)
+    calib = ["m0scan"] * ncalib
+
+    contexts = {}
+    contexts["tc"] = (calib + ["label", "control"] * npairs, np.concatenate([np.zeros(ncalib), np.repeat(plds, 2)]))
+    contexts["ct"] = (calib + ["control", "label"] * npairs, np.concatenate([np.zeros(ncalib), np.repeat(plds, 2)]))
+    contexts["blocked"] = (calib + ["label"] * npairs + ["control"] * npairs, np.concatenate([np.zeros(ncalib), plds, plds]))
+    types = np.array(["label", "control"] * npairs)
+    times = np.repeat(plds, 2)
+    shuffle = rng.permutation(len(types))
+    contexts["mixed"] = (calib + list(types[shuffle]), np.concatenate([np.zeros(ncalib), times[shuffle]]))
+    return contexts
+
+@pytest.mark.parametrize("order", ["tc", "ct", "blocked", "mixed"])
+def test_aslcontext(benchmark, order, tmp_path):
+    types, plds = synthetic_aslcontexts()[order]
+    assert len(types) >= ASLCONTEXT_VOLUMES
+    fname = str(tmp_path / f"{order}_aslcontext.tsv")
+    with open(fname, "w") as f:
+        f.write("volume_type\n" + "\n".join(types) + "\n")
+
+    ctx = benchmark(lambda: aslcontext.interpret(aslcontext.read(fname), plds))
+    assert ctx.order == order
+    assert len(ctx.asl_volumes) + len(ctx.calib_volumes) == len(types)
@@ -0,0 +1,99 @@
+"""
+Benchmarks for discovery, configuration and output conversion on synthetic BIDS
+datasets, see conftest.py for the dataset sizes
+"""
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import synth
+from brc_bids import brc, index, mappings, nifti, oxasl, sidecars
+
+# Number of rounds for benchmarks which are too slow to calibrate
+ROUNDS = 3
+
+def _clear_caches():
+    nifti.clear_cache()
+    sidecars.clear_cache()
+
+@pytest.fixture
+def layout(dataset, tmp_path):
+    return index.get_layout(dataset, str(tmp_path))
+
+@pytest.fixture
+def image_files(layout):
+    _clear_caches()
+    return brc.get_image_files(layout)
+
+def test_layout_cold(benchmark, dataset, tmp_path):
+    benchmark.pedantic(index.get_layout, args=(dataset, str(tmp_path)), kwargs={"reset" : True}, rounds=ROUNDS)
+
+def test_layout_warm(benchmark, dataset, layout, tmp_path):
+    benchmark(index.get_layout, dataset, str(tmp_path))
+
+def test_get_image_files(benchmark, layout, subjects):
+    def _setup():
+        _clear_caches()
+        return (layout, ), {}
+    image_files = benchmark.pedantic(brc.get_image_files, setup=_setup, rounds=ROUNDS)
+    assert len(image_files) == subjects
+
+def test_oxasl_config_from_bids(benchmark, dataset, layout, tmp_path, subjects, request):
+    def _setup():
+        _clear_caches()
+        return (dataset, ), {"index_dir" : str(tmp_path)}
+    configs = benchmark.pedantic(oxasl.oxasl_config_from_bids, setup=_setup, rounds=ROUNDS)
+    assert len(configs) == subjects * request.config.getoption("bench_sessions")
+
+def test_options_from_metadata(benchmark, image_files):
+    # Work out the file type and any extra metadata for each file beforehand so only
+    # the mapping itself is timed
+    jobs = []
+    for sess_group in image_files.values():
+        for sess_files in sess_group.values():
+            for bids_file in sess_files.get("asl", ()):
+                jobs.append((bids_file.metadata, "asl", {}))
+            for bids_file in sess_files.get("m0scan", ()):
+                filetype = "cblip" if bids_file.entities.get("datatype") == "fmap" else "calib"
+                jobs.append((bids_file.metadata, filetype, {"img_shape" : nifti.probe(bids_file.path).shape}))
+            for bids_file in sess_files.get("dwi", ()):
+                jobs.append((bids_file.metadata, "dwi", {}))
+    benchmark(lambda: [mappings.options_from_metadata(metadata, filetype, **extra) for metadata, filetype, extra in jobs])
+
+@pytest.fixture
+def oxasl_outputs(image_files, tmp_path):
+    sessions = [(subject, session) for subject, sess_group in image_files.items() for session in sess_group]
+    return synth.make_oxasl_outputs(str(tmp_path), sessions)
+
+def test_oxasl_output_to_bids(benchmark, dataset, oxasl_outputs, tmp_path):
+    bids_output = str(tmp_path / "bids")
+    def _setup():
+        shutil.rmtree(bids_output, ignore_errors=True)
+        return (oxasl_outputs, dataset, bids_output), {}
+    benchmark.pedantic(oxasl.oxasl_outputs_to_bids, setup=_setup, rounds=ROUNDS)
+
+def test_oxasl_output_to_bids_repeat(benchmark, dataset, oxasl_outputs, tmp_path):
+    # Outputs which have already been converted are not transferred again
+    bids_output = str(tmp_path / "bids")
+    oxasl.oxasl_outputs_to_bids(oxasl_outputs, dataset, bids_output)
+    benchmark.pedantic(oxasl.oxasl_outputs_to_bids, args=(oxasl_outputs, dataset, bids_output), rounds=ROUNDS)
+
+def test_submit(benchmark, dataset, tmp_path, request):
+    if not request.config.getoption("bench_submit"):
+        pytest.skip("Cluster submission is only timed with --bench-submit")
+    bindir = str(tmp_path / "bin")
+    synth.write_stubs(bindir)
+    env = dict(os.environ)
+    env["PATH"] = bindir + os.pathsep + env.get("PATH", "")
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = package_dir + os.pathsep + env.get("PYTHONPATH", "")
+
+    def _setup():
+        outdir = str(tmp_path / "pipeline")
+        shutil.rmtree(outdir, ignore_errors=True)
+        cmd = [sys.executable, "-m", "brc_bids", "--bidsdir", dataset, "-o", outdir, "--cluster"]
+        return (cmd, ), {"env" : env, "stdout" : subprocess.DEVNULL, "check" : True}
+    benchmark.pedantic(subprocess.run, setup=_setup, rounds=1)
@@ -1,23 +1,30 @@
 """
-oxasl_bids: BIDS interface for the oxasl pipeline
+brc_bids: Run BRC pipeline on BIDS dataset
 
 Usage:
-oxasl_bids bids --bidsdir <bids_directory> [... additional oxasl arguments]
-oxasl_bids img --img <img file> --img-type <type>
-oxasl_bids bidsout --oxasl-output <output folder>
+brc_bids --bidsdir <bids_directory> -o <output folder> [... additional options]
+brc_bids bidsout --bidsdir <bids_directory> (--manifest <file> | --discover <output folder>)
+brc_bids status -o <output folder> [--wait] [--json <file>]
+brc_bids idpmerge --in <session list> --indir <output folder> [--output <file>]
+brc_bids shardmerge -o <output folder> [--manifest <file> ...] [--json <file>]
+brc_bids staged --output <output folder> --session <subject_session> [--stage <stage>] [--need <stage> ...] [--scratch <dir>] -- <command>
+brc_bids aslsplit --input <ASL data> --asl <file> --asl-volumes <list> --calib <file> --calib-volumes <list> -- <command>
 
-'bids' outputs commands to run oxasl on a BIDS data set
-'img' output a command to run oxasl on a single ASL image with JSON metadata
-'bidsout' converts an oxasl output directory to BIDS format
+The first form submits the pipeline for a BIDS data set
+'bidsout' converts many oxasl output directories to BIDS format in a single process
+'status' reports which of the jobs submitted to an output folder have completed
+'idpmerge' merges per-session IDPs into the cohort IDP matrix, run by the pipeline itself
+'shardmerge' merges the manifests written by runs with --shard into a single manifest
+'staged' runs a pipeline command on node-local scratch, used by the pipeline with --local-scratch
+'aslsplit' splits ASL data containing M0 volumes and runs oxasl on it, used by the pipeline
 """
 
 import argparse
+import json
 import logging
 import os
 import sys
 
-from . import brc
-
 def _parse_args(args):
     # FIXME not used at present
     ret = {}
@@ -49,24 +56,215 @@ class ArgumentParser(argparse.ArgumentParser):
         argparse.ArgumentParser.__init__(self, prog="brc_bids", add_help=True, **kwargs)
         self.add_argument('--bidsdir', required=True, help="Path to BIDS data set")
         self.add_argument('-o', '--output', required=True, help="Path to output directory. Subject directory will be created here")
-        self.add_argument('--mriqc', action="store_true", default=False, help="Include MRIQC processing")
+        self.add_argument('--participant-label', nargs="+", help="Only process these subjects (with or without sub- prefix)")
+        self.add_argument('--session-label', nargs="+", help="Only process these sessions (without ses- prefix)")
+        self.add_argument('--shard', help="Only process shard i of N of the subjects, specified as i/N")
+        self.add_argument('--shard-by', choices=["count", "size"], default="count", help="Balance shards by number of subjects or data size")
+        self.add_argument('--mriqc', action="store_true", default=False, help="Include MRIQC processing (stages mriqc and mriqcgroup)")
+        self.add_argument('--stages', type=lambda s: s.split(","), help="Comma separated list of pipeline stages to run: struc, dwi, perf, idps, idpmerge, mriqc, mriqcgroup. Default: struc,dwi,perf,idps,idpmerge")
         self.add_argument('--cluster', action="store_true", default=None, help="Force cluster mode (fsl_sub) - defaults to $CLUSTER_MODE == YES")
+        self.add_argument('--jobs', type=int, default=1, help="Number of commands to run concurrently when not in cluster mode")
+        self.add_argument('--max-ram', type=int, help="Maximum total memory in Mb for concurrently running commands when not in cluster mode")
+        self.add_argument('--submit-concurrency', type=int, default=8, help="Maximum number of concurrent fsl_sub calls in cluster mode")
+        self.add_argument('--array', action="store_true", default=False, help="Submit each pipeline stage as a single fsl_sub array job")
+        self.add_argument('--local-scratch', action="store_true", default=False, help="Run struc, dwi and perf stages on node-local scratch, copying inputs in and outputs back")
+        self.add_argument('--scratch-dir', help="Scratch directory to use with --local-scratch. Default: $TMPDIR on the node running each job")
         self.add_argument('--overwrite', action="store_true", default=False, help="Overwrite output directory if already exists")
+        self.add_argument('--incremental', action="store_true", default=False, help="Reuse existing output directory, only submitting stages whose inputs or commands have changed or which did not complete")
+        self.add_argument('--reindex', action="store_true", default=False, help="Rebuild the persistent BIDS index stored in the output directory")
+        self.add_argument('--profile', help="Record timings and counters and write them to this file as a JSON/Chrome trace report")
+        self.add_argument('--cprofile', help="Profile with cProfile and write the statistics to this file")
+        self.add_argument('--debug', help="Enable debug logging", action='store_true')
+
+class BidsoutArgumentParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="brc_bids bidsout", add_help=True, **kwargs)
+        self.add_argument('--bidsdir', required=True, help="Path to source BIDS data set")
+        group = self.add_mutually_exclusive_group(required=True)
+        group.add_argument('--manifest', help="JSON file listing oxasl output directories with subject and session")
+        group.add_argument('--discover', help="Convert all oxasl output directories found in this pipeline output directory")
+        self.add_argument('--bids-output', help="Path to destination BIDS data set. Default is to add a derivative to the source data set")
+        self.add_argument('--workers', type=int, default=8, help="Number of directories to list and files to transfer at once")
+        self.add_argument('--link', action="store_true", default=False, help="Hardlink files into the BIDS output where possible instead of copying them. The output then shares its data with the oxasl output")
+        self.add_argument('--profile', help="Record timings and counters and write them to this file as a JSON/Chrome trace report")
+        self.add_argument('--cprofile', help="Profile with cProfile and write the statistics to this file")
+        self.add_argument('--debug', help="Enable debug logging", action='store_true')
+
+class StatusArgumentParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="brc_bids status", add_help=True, **kwargs)
+        self.add_argument('-o', '--output', required=True, help="Path to pipeline output directory")
+        self.add_argument('--scheduler', choices=["auto", "slurm", "sge", "markers"], default="auto", help="How to find the state of unfinished jobs. 'markers' only checks completion markers and does not query the scheduler")
+        self.add_argument('--wait', action="store_true", default=False, help="Wait until no jobs are queued or running")
+        self.add_argument('--interval', type=float, default=60, help="Time in seconds between scheduler queries when waiting")
+        self.add_argument('--json', help="Write status summary to this file as JSON")
+        self.add_argument('--debug', help="Enable debug logging", action='store_true')
+
+class IdpmergeArgumentParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="brc_bids idpmerge", add_help=True, **kwargs)
+        self.add_argument('--in', dest="subjfile", required=True, help="File listing session output directory names, one per line")
+        self.add_argument('--indir', required=True, help="Pipeline output directory containing the session output directories")
+        self.add_argument('--output', help="Cohort IDP .npz file to create or update. Default: idps/cohort_idps.npz in the pipeline output directory")
+        self.add_argument('--profile', help="Record timings and counters and write them to this file as a JSON/Chrome trace report")
+        self.add_argument('--cprofile', help="Profile with cProfile and write the statistics to this file")
+        self.add_argument('--debug', help="Enable debug logging", action='store_true')
+
+class ShardmergeArgumentParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="brc_bids shardmerge", add_help=True, **kwargs)
+        self.add_argument('-o', '--output', required=True, help="Pipeline output directory shared by the shards")
+        self.add_argument('--manifest', nargs="+", help="Shard manifests to merge. Default: all manifests in the output directory")
+        self.add_argument('--json', help="Write merged manifest to this file. Default: .brc_bids/shards/merged.json in the output directory")
+        self.add_argument('--debug', help="Enable debug logging", action='store_true')
+
+class StagedArgumentParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="brc_bids staged", add_help=True, **kwargs)
+        self.add_argument('--output', required=True, help="Pipeline output directory, as given in the command")
+        self.add_argument('--session', required=True, help="Session output directory name, <subject>_<session>")
+        self.add_argument('--stage', help="Name of the pipeline stage. If given, the output files synced back are recorded")
+        self.add_argument('--need', action="append", default=[], help="Stage whose output files the command uses. May be given more than once")
+        self.add_argument('--scratch', help="Scratch directory. Default: $TMPDIR")
+        self.add_argument('--workers', type=int, default=8, help="Number of files to copy at once")
+        self.add_argument('--keep', action="store_true", default=False, help="Do not delete the scratch copy when finished")
+        self.add_argument('--profile', help="Record timings and counters and write them to this file as a JSON/Chrome trace report")
+        self.add_argument('--cprofile', help="Profile with cProfile and write the statistics to this file")
+        self.add_argument('--debug', help="Enable debug logging", action='store_true')
+        self.add_argument('cmd', nargs=argparse.REMAINDER, help="Command to run, after --")
+
+class AslsplitArgumentParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="brc_bids aslsplit", add_help=True, **kwargs)
+        self.add_argument('--input', required=True, help="ASL data containing M0 volumes")
+        self.add_argument('--asl', required=True, help="Output ASL image")
+        self.add_argument('--asl-volumes', required=True, type=_volumes, help="Comma separated indices of ASL volumes")
+        self.add_argument('--calib', required=True, help="Output M0 image")
+        self.add_argument('--calib-volumes', required=True, type=_volumes, help="Comma separated indices of M0 volumes")
         self.add_argument('--debug', help="Enable debug logging", action='store_true')
+        self.add_argument('cmd', nargs=argparse.REMAINDER, help="Command to run on the split images, after --")
+
+def _volumes(value):
+    return [int(vol) for vol in value.split(",") if vol]
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "shardmerge":
+        return shardmerge_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "aslsplit":
+        return aslsplit_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "staged":
+        return staged_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "idpmerge":
+        return idpmerge_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "bidsout":
+        return bidsout_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "status":
+        return status_main(sys.argv[2:])
+
     parser = ArgumentParser()
     args, remainder = parser.parse_known_args()
     #custom_args = _parse_args(remainder)
 
     _setup_logging(args)
-    if os.path.exists(args.output) and not args.overwrite:
-            raise ValueError(f"Output directory {args.output} already exists - use --overwrite to ignore")
+    if os.path.exists(args.output) and not (args.overwrite or args.incremental):
+            raise ValueError(f"Output directory {args.output} already exists - use --overwrite or --incremental to ignore")
     os.makedirs(args.output, exist_ok=True)
 
     if args.cluster is None:
         args.cluster = os.environ.get("CLUSTER_MODE", "NO") == "YES"
-    brc.run(args)
+
+    # Imported after argument parsing so --help and argument errors do not pay for
+    # importing pybids and other heavy dependencies
+    from . import brc
+    _profiled(args, brc.run, args)
+
+def bidsout_main(argv=None):
+    from . import oxasl
+    args = BidsoutArgumentParser().parse_args(argv)
+    _setup_logging(args)
+    if args.manifest:
+        outputs = oxasl.read_outputs_manifest(args.manifest)
+    else:
+        outputs = oxasl.discover_outputs(args.discover)
+    _profiled(args, oxasl.oxasl_outputs_to_bids, outputs, args.bidsdir, args.bids_output, workers=args.workers, link=args.link)
+
+def idpmerge_main(argv=None):
+    from . import idps
+    args = IdpmergeArgumentParser().parse_args(argv)
+    _setup_logging(args)
+    with open(args.subjfile) as f:
+        subjdirs = [line.strip() for line in f if line.strip()]
+    _profiled(args, idps.merge, subjdirs, args.indir, args.output or idps.cohort_path(args.indir))
+
+def status_main(argv=None):
+    from . import status
+    args = StatusArgumentParser().parse_args(argv)
+    _setup_logging(args)
+    summary = status.get_status(args.output, args.scheduler, args.wait, args.interval)
+    print(status.format_summary(summary))
+    if args.json:
+        status.write_summary(args.json, summary)
+    # Non-zero exit status until everything has completed, so the command can be used in scripts
+    complete = not summary["resubmit"]["sessions"] and not summary["pending"]
+    sys.exit(0 if complete else 1)
+
+def shardmerge_main(argv=None):
+    from . import shard, utils
+    args = ShardmergeArgumentParser().parse_args(argv)
+    _setup_logging(args)
+    fnames = args.manifest or shard.find_manifests(args.output)
+    if not fnames:
+        raise ValueError(f"No shard manifests found in {args.output}")
+    merged = shard.merge_manifests(fnames)
+    output = args.json or os.path.join(utils.work_dir(args.output, "shards"), "merged.json")
+    with open(output, "w") as f:
+        json.dump(merged, f, indent=2)
+    print(f"Merged {len(fnames)} shard manifests: {len(merged['subjects'])} subjects, {len(merged['sessions'])} sessions -> {output}")
+    missing = shard.missing_shards(merged)
+    if missing:
+        print(f"Missing shards: {', '.join(missing)}")
+        sys.exit(1)
+
+def staged_main(argv=None):
+    from . import staging
+    parser = StagedArgumentParser()
+    args = parser.parse_args(argv)
+    cmd = args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd
+    if not cmd:
+        parser.error("No command given")
+    _setup_logging(args)
+    sys.exit(_profiled(args, staging.run_staged, cmd, args.output, args.session, args.stage, args.need, args.scratch, workers=args.workers, keep=args.keep))
+
+def aslsplit_main(argv=None):
+    from . import oxasl
+    parser = AslsplitArgumentParser()
+    args = parser.parse_args(argv)
+    cmd = args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd
+    if not cmd:
+        parser.error("No command given")
+    _setup_logging(args)
+    sys.exit(oxasl.run_split(cmd, args.input, args.asl_volumes, args.calib_volumes, args.asl, args.calib))
+
+def _profiled(args, func, *func_args, **func_kwargs):
+    """
+    Run a function, with profiling if requested on the command line
+    """
+    from . import profiling
+    profiler = None
+    if args.profile:
+        profiling.enable()
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return func(*func_args, **func_kwargs)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+        if args.profile:
+            profiling.write_report(args.profile)
 
 def _setup_logging(args):
     if args.debug:
@@ -0,0 +1,170 @@
+"""
+BRC_BIDS: Interpretation of the ASL context (aslcontext.tsv)
+
+The ASL context gives the type of each volume in an ASL series. From it we work out
+which volumes are ASL data and which are calibration images, whether the data is
+already differenced, and how label and control images are paired. Pairs may be
+interleaved (label-control or control-label) or in any other order, e.g. blocks of
+labels followed by blocks of controls, in which case the ASL volumes are reordered
+so that oxasl sees label-control pairs.
+
+All of this is done with array operations since multi-PLD, multi-repeat acquisitions
+can have thousands of volumes.
+"""
+import collections
+import logging
+
+import numpy as np
+
+from .utils import IncompatabilityError
+
+LOG = logging.getLogger(__name__)
+
+CONTROL, LABEL, DELTAM, M0SCAN = 0, 1, 2, 3
+
+VOLUME_TYPES = {
+    'control' : CONTROL,
+    'control(perev)': CONTROL,
+    'label': LABEL,
+    'deltam': DELTAM,
+    'm0scan': M0SCAN,
+}
+
+AslContext = collections.namedtuple("AslContext", [
+    "iaf",            # Input format for oxasl: 'diff', 'tc' or 'ct'
+    "order",          # Order of ASL volumes: 'diff', 'tc', 'ct', 'blocked' or 'mixed'
+    "asl_volumes",    # Indices of ASL volumes in the order they should be passed to oxasl
+    "calib_volumes",  # Indices of calibration (m0scan) volumes
+    "timings",        # PLDs/TIs, one per repeat or de-duplicated as described by ibf/rpts
+    "ibf",            # Input block format for oxasl ('rpt' or 'tis') or None if timings are not de-duplicated
+    "rpts",           # Number of repeats of each timing for ibf='tis', otherwise None
+])
+
+def read(fname):
+    """
+    Read the volume types from an ASL context file
+
+    :return: Array of volume type codes
+    """
+    with open(fname) as f:
+        lines = [line.strip().lower() for line in f.read().splitlines()]
+    lines = [line for line in lines if line]
+    if not lines or lines[0] != 'volume_type':
+        raise IncompatabilityError("First line in ASL context is not volume_type")
+    return parse(lines[1:])
+
+def parse(volume_types):
+    """
+    Convert volume type names to codes
+
+    :param volume_types: Sequence of volume type names, e.g. 'label', 'control'
+    :return: Array of volume type codes
+    """
+    names, inverse = np.unique(np.array(volume_types, dtype=str), return_inverse=True)
+    if 'cbf' in names:
+        raise IncompatabilityError("ASL context contains CBF images")
+    unknown = [name for name in names if name not in VOLUME_TYPES]
+    if unknown:
+        raise IncompatabilityError(f"Unknown volume types in ASL context: {unknown}")
+    lookup = np.array([VOLUME_TYPES[name] for name in names], dtype=np.int8)
+    return lookup[inverse.reshape(-1)]
+
+def interpret(codes, timings=None):
+    """
+    Interpret the volume types of an ASL series
+
+    :param codes: Array of volume type codes as returned by read or parse
+    :param timings: Optional PLDs/TIs from the metadata. These may be given for every
+                    volume, for every ASL volume or already be one per repeat
+
+    :return: AslContext
+    """
+    codes = np.asarray(codes)
+    is_asl = codes < M0SCAN
+    asl_volumes = np.flatnonzero(is_asl)
+    calib_volumes = np.flatnonzero(codes == M0SCAN)
+    asl_codes = codes[asl_volumes]
+
+    if len(asl_volumes) == 0:
+        raise IncompatabilityError("No ASL data (label/control or deltam found in ASL data file")
+    ndiff = np.count_nonzero(asl_codes == DELTAM)
+    if 0 < ndiff < len(asl_codes):
+        raise IncompatabilityError("ASL sequence is mixed deltam and control/label")
+    if len(asl_volumes) == 1 and ndiff == 0:
+        raise IncompatabilityError("Only one ASL volume found in ASL data file and it was not a deltam image")
+
+    if timings is not None:
+        timings = np.atleast_1d(np.asarray(timings, dtype=float))
+        if len(timings) == len(codes):
+            timings = timings[asl_volumes]
+
+    if ndiff:
+        return _with_timings("diff", "diff", asl_volumes, calib_volumes, timings)
+
+    label_pos, control_pos = np.flatnonzero(asl_codes == LABEL), np.flatnonzero(asl_codes == CONTROL)
+    if len(label_pos) != len(control_pos):
+        raise IncompatabilityError(f"ASL context has {len(label_pos)} label images but {len(control_pos)} control images")
+
+    npairs = len(label_pos)
+    evens, odds = asl_codes[0::2], asl_codes[1::2]
+    if np.all(evens == LABEL) and np.all(odds == CONTROL):
+        order = "tc"
+    elif np.all(evens == CONTROL) and np.all(odds == LABEL):
+        order = "ct"
+    else:
+        # Runs of identical volume types of equal length, e.g. TTTTTCCCCC or TTCCTTCC
+        run_starts = np.flatnonzero(np.diff(asl_codes, prepend=-1) != 0)
+        run_lengths = np.diff(np.append(run_starts, len(asl_codes)))
+        order = "blocked" if np.all(run_lengths == run_lengths[0]) else "mixed"
+
+    if order in ("tc", "ct"):
+        # With TC or CT pairs the timings will be repeated. We don't care about the order since
+        # no valid ASL sequence will have different timings for tag and control.
+        if timings is not None and len(timings) == len(asl_codes):
+            timings = timings[0::2]
+        return _with_timings(order, order, asl_volumes, calib_volumes, timings)
+
+    # Pair the Nth label with the Nth control image with the same timing, and
+    # reorder the ASL volumes as label-control pairs
+    if timings is not None and len(timings) == len(asl_codes):
+        label_pos = label_pos[np.argsort(timings[label_pos], kind="stable")]
+        control_pos = control_pos[np.argsort(timings[control_pos], kind="stable")]
+        if not np.array_equal(timings[label_pos], timings[control_pos]):
+            raise IncompatabilityError("Could not pair label and control images with the same timings in aslcontext.tsv")
+        # Keep pairs in order of acquisition of the label image
+        pair_order = np.argsort(label_pos, kind="stable")
+        label_pos, control_pos = label_pos[pair_order], control_pos[pair_order]
+        timings = timings[label_pos]
+
+    reordered = np.empty(2 * npairs, dtype=asl_volumes.dtype)
+    reordered[0::2] = asl_volumes[label_pos]
+    reordered[1::2] = asl_volumes[control_pos]
+    LOG.debug(f"ASL volumes in {order} order - reordering as label-control pairs")
+    return _with_timings("tc", order, reordered, calib_volumes, timings)
+
+def _with_timings(iaf, order, asl_volumes, calib_volumes, timings):
+    """
+    Create an AslContext, de-duplicating the per-repeat timings where they are
+    either cycled (ibf=rpt) or grouped (ibf=tis)
+    """
+    ibf, rpts = None, None
+    if timings is not None and len(timings) > 1:
+        unique, first, counts = np.unique(timings, return_index=True, return_counts=True)
+        # Unique timings in order of first appearance
+        appearance = np.argsort(first)
+        unique, counts = unique[appearance], counts[appearance]
+        if len(unique) < len(timings):
+            if len(timings) % len(unique) == 0 and np.array_equal(timings, np.tile(unique, len(timings) // len(unique))):
+                ibf, timings = "rpt", unique
+            elif np.array_equal(timings, np.repeat(unique, counts)):
+                ibf, rpts, timings = "tis", counts, unique
+
+    return AslContext(
+        iaf=iaf,
+        order=order,
+        asl_volumes=asl_volumes,
+        calib_volumes=calib_volumes,
+        timings=timings,
+        ibf=ibf,
+        rpts=rpts,
+    )
@@ -0,0 +1,157 @@
+"""
+BRC_BIDS: Submission of many commands as a single fsl_sub array job
+
+Submitting one job per subject/session means one scheduler round trip each. Instead
+commands for a pipeline stage can be collected in a TaskArray and submitted together
+using ``fsl_sub -t <task file>``.
+
+Where every task in an array depends on a single task of an earlier array, the tasks are
+arranged so that task N depends on task N of the earlier array and a task-by-task hold
+(``fsl_sub --array_hold``) is used. Placeholder tasks are inserted where there is no
+matching task (e.g. sessions without DWI data). Otherwise the array holds on all of the
+jobs its tasks depend on.
+"""
+import logging
+import os
+import shlex
+import subprocess
+
+from . import profiling, utils
+
+LOG = logging.getLogger(__name__)
+
+# Command used for placeholder tasks when aligning an array with its parent
+NOOP_TASK = "true"
+
+class ArrayTask:
+    """
+    A single command within a TaskArray
+    """
+    def __init__(self, array, cmd, dep_job, minutes, ram):
+        self.array = array
+        self.cmd = cmd
+        self.dep_job = dep_job
+        self.minutes = minutes
+        self.ram = ram
+        self.index = None
+        self.local_job_id = None
+
+    @property
+    def job_id(self):
+        """
+        Job ID of the array containing this task. This is used when a single job depends
+        on the task since holds on individual array tasks are not portable between schedulers
+        """
+        if not self.array.submitted:
+            raise RuntimeError(f"Task array {self.array.name} must be submitted before tasks which depend on it")
+        if self.local_job_id is not None:
+            return self.local_job_id
+        return self.array.job_id
+
+    @property
+    def task_id(self):
+        """
+        ID of this task within the array (starting at 1)
+        """
+        return None if self.index is None else self.index + 1
+
+    def __repr__(self):
+        return f"<ArrayTask {self.array.name}:{self.task_id} {' '.join(self.cmd)}>"
+
+class TaskArray:
+    """
+    Collects commands to be submitted as a single array job
+    """
+    def __init__(self, name, outdir):
+        """
+        :param name: Name of the array, e.g. pipeline stage
+        :param outdir: Output directory. The task file is written to a subdirectory of this
+        """
+        self.name = name
+        self.outdir = outdir
+        self.tasks = []
+        self.job_id = None
+        self.submitted = False
+
+    def add(self, cmd, dep_job=None, minutes=5, ram=None):
+        """
+        Add a command to the array
+
+        :return: ArrayTask which can be used as a dependency for later commands
+        """
+        if self.submitted:
+            raise RuntimeError(f"Task array {self.name} has already been submitted")
+        task = ArrayTask(self, cmd, dep_job, minutes, ram)
+        task.index = len(self.tasks)
+        self.tasks.append(task)
+        return task
+
+    def submit(self, cluster):
+        """
+        Submit the array
+
+        :param cluster: If True, submit using ``fsl_sub -t``. Otherwise the commands
+                        are run individually using utils.submit_cmd
+        :return: Job ID of array job or None if nothing was submitted
+        """
+        if self.submitted:
+            raise RuntimeError(f"Task array {self.name} has already been submitted")
+        self.submitted = True
+        if not self.tasks:
+            return None
+
+        if not cluster:
+            for task in self.tasks:
+                task.local_job_id = utils.submit_cmd(task.cmd, cluster, task.dep_job, minutes=task.minutes, ram=task.ram)
+            return None
+
+        tasks, parent = self._arrange()
+        taskfile = os.path.join(utils.work_dir(self.outdir, "tasks"), f"{self.name}.txt")
+        with open(taskfile, "w") as f:
+            for task in tasks:
+                f.write((NOOP_TASK if task is None else shlex.join(task.cmd)) + "\n")
+
+        minutes = max([task.minutes for task in self.tasks])
+        sub_cmd = ["fsl_sub", "-T", str(minutes), "-N", self.name]
+        rams = [task.ram for task in self.tasks if task.ram]
+        if rams:
+            sub_cmd.extend(["-R", str(max(rams))])
+        if parent is not None:
+            LOG.info(f"Array hold on {parent.name}={parent.job_id}")
+            sub_cmd.extend(["--array_hold", str(parent.job_id)])
+        else:
+            dep_ids = sorted(set(utils.dep_job_ids([task.dep_job for task in self.tasks])))
+            if dep_ids:
+                LOG.info(f"Dep job={dep_ids}")
+                sub_cmd.extend(["-j", ",".join(dep_ids)])
+        sub_cmd.extend(["-t", taskfile])
+
+        LOG.info(" ".join(sub_cmd))
+        with profiling.timer("fsl_sub", "submit", tasks=len(tasks)):
+            stdout = subprocess.check_output(sub_cmd).decode("UTF-8")
+        profiling.count("subprocess_calls")
+        LOG.debug(stdout)
+        self.job_id = utils.fsl_sub_job_id(stdout)
+        LOG.info(f"Submitted {len(self.tasks)} {self.name} tasks as array job {self.job_id}")
+        return self.job_id
+
+    def _arrange(self):
+        """
+        Order the tasks for submission, aligning them with a parent array if possible
+
+        :return: Tuple of list of tasks (None for placeholder tasks), parent TaskArray or None
+        """
+        deps = [task.dep_job for task in self.tasks]
+        parents = set([dep.array for dep in deps if isinstance(dep, ArrayTask)])
+        if len(parents) == 1 and all(isinstance(dep, ArrayTask) for dep in deps):
+            parent = parents.pop()
+            if parent.job_id is not None and len(set([dep.index for dep in deps])) == len(deps):
+                # The parent may itself have been aligned with placeholders, so its
+                # tasks can have indices beyond the length of its task list
+                tasks = [None] * (max([task.index for task in parent.tasks]) + 1)
+                for task in self.tasks:
+                    task.index = task.dep_job.index
+                    tasks[task.index] = task
+                return tasks, parent
+
+        return self.tasks, None
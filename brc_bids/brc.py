@@ -4,62 +4,78 @@ BRC_BIDS: Script to run the BRC pipeline from a BIDS dataset
 import logging
 import os
 
-import bids
-
 LOG = logging.getLogger(__name__)
 
-from . import struc, idps, dwi, mriqc
+from . import index, local, pipeline, profiling, shard, utils
+
+# Suffixes of image files used by the pipeline
+SUFFIXES = ("asl", "m0scan", "T1w", "T2w", "dwi")
 
-def get_image_files(layout):
+def get_image_files(layout, subjects=None, sessions=None):
     """
     Get structure describing all relevant image files found in a BIDS dataset
 
     :param layout: BIDSLayout structure
+    :param subjects: Optional sequence of subject labels to include
+    :param sessions: Optional sequence of session labels to include
 
     :return dict mapping subjects to a group of sessions. The session group is a dict mapping
-            session ID to session dict. Each session is a dict mapping file suffixes asl, m0scan, 
-            T1w, T2w and dwi to lists of corresponding BIDSImageFile instances
+            session ID to records.SessionFiles. Each of these maps file suffixes asl, m0scan, 
+            T1w, T2w and dwi to tuples of records.FileRecord including the file metadata
+    """
+    return index.group_files(layout, SUFFIXES, subjects, sessions, metadata=True)
+
+def iter_image_files(layout, subjects=None, sessions=None):
     """
-    data_files = {}
-    for subj in layout.get_subjects():
-        data_files[subj] = {}
-        sessions = layout.get_sessions(subject=subj)
-        if not sessions:
-            # Deal with case where there is no session level
-            sessions = [None]
-        for sess in sessions:
-            LOG.info(f"Getting BIDS images for subject {subj} in session {sess}")
-            data_files[subj][sess] = {}
-            for suffix in ("asl", "m0scan", "T1w", "T2w", "dwi"):
-                data_files[subj][sess][suffix] = []
-                for fobj in layout.get(subject=subj, session=sess, suffix=suffix):
-                    if isinstance(fobj, bids.layout.models.BIDSImageFile):
-                        LOG.debug(f"Found {suffix.upper()} image: {fobj.filename} {fobj.entities['suffix']}")
-                        data_files[subj][sess][suffix].append(fobj)
+    Generate the relevant image files in a BIDS dataset one session at a time
 
-    return data_files
+    :param layout: BIDSLayout structure
+    :param subjects: Optional sequence of subject labels to include
+    :param sessions: Optional sequence of session labels to include
+
+    :return: Generator of records.SessionFiles as for get_image_files
+    """
+    return index.iter_session_files(layout, SUFFIXES, subjects, sessions, metadata=True)
 
 def run(args):
     LOG.info("BRC-BIDS")
     LOG.info(f"Cluster mode: {args.cluster}")
-    layout = bids.BIDSLayout(args.bidsdir)
+    executor = None
+    if not args.cluster and args.jobs != 1:
+        LOG.info(f"Running up to {args.jobs} commands concurrently")
+        executor = local.LocalExecutor(args.jobs, args.max_ram, logdir=os.path.join(utils.work_dir(args.output), "logs"))
+        utils.set_local_executor(executor)
 
-    if args.mriqc:
-        # MRIQC is a BIDS application independent of the rest of the BRC pipeline
-        LOG.info(f"Running MRIQC on dataset")
-        mriqc.run(args.bidsdir, args.output, cluster=args.cluster)
+    try:
+        subjects, shard_spec = None, None
+        if args.participant_label or args.shard:
+            shard_spec = shard.parse_shard(args.shard) if args.shard else None
+            subjects = shard.select_subjects(args.bidsdir, args.participant_label, shard_spec, by=args.shard_by)
 
-    image_files = get_image_files(layout)
-    subjdirs, last_job = [], None
-    for subject, sessions in image_files.items():
-        for session, data_files in sessions.items():
+        layout = index.get_layout(args.bidsdir, args.output, reset=args.reindex, subjects=subjects, sessions=args.session_label)
+        stages = args.stages if args.stages else list(pipeline.DEFAULT_STAGES)
+        if args.mriqc:
+            stages.extend([name for name in ("mriqc", "mriqcgroup") if name not in stages])
+        if shard_spec is not None:
+            # Cohort stages need all sessions so should be run once all shards have finished
+            cohort_stages = [stage.name for stage in pipeline.get_stages(stages) if stage.cohort]
+            if cohort_stages:
+                LOG.warn(f"Not running cohort stages {cohort_stages} for a single shard")
+            stages = [name for name in stages if name not in cohort_stages]
 
-            # Note structural pipeline will throw exception if no T1 image available - this is fine because structural
-            # processing is required for the rest of the pipeline
-            last_job = struc.run(subject, session, data_files, args.output, cluster=args.cluster)
-            #last_job = dwi.run(subject, session, data_files, output, cluster=args.cluster, dep_job=struc_job)
-            #perf.run(subject, session, data_files, output)
-            subjdirs.append(f"{subject}_{session}")
+        # Sessions are submitted as they are discovered
+        image_files = iter_image_files(layout, subjects, args.session_label)
 
-    #idps.run(subjdirs, output, cluster=cluster, dep_job=last_job)
-    #qc.run(subjdirs, output)
+        # Note structural pipeline will throw exception if no T1 image available - this is fine because structural
+        # processing is required for the rest of the pipeline
+        with profiling.timer("pipeline"):
+            session_jobs = pipeline.run(args, image_files, pipeline.get_stages(stages))
+        if shard_spec is not None:
+            shard.write_manifest(shard.manifest_path(args.output, shard_spec), shard_spec, subjects, session_jobs)
+    finally:
+        # Wait for commands already started even if submission failed part way
+        if executor is not None:
+            try:
+                executor.wait()
+            finally:
+                utils.set_local_executor(None)
@@ -6,16 +6,21 @@ import subprocess
 
 LOG = logging.getLogger(__name__)
 
-from . import mappings, utils
+from . import mappings, sidecars
 
-def run(subject, session, data_files, outdir, cluster=False, dep_job=None):
+def get_cmds(subject, session, data_files, outdir):
+    """
+    Get the commands to run the diffusion pipeline for a session
+
+    :return: List of commands, each a list of arguments. Empty if no DWI data
+    """
     dwis = data_files.get("dwi", [])
     if not dwis:
         LOG.info("No DWI files found - will not run diffusion pipeline")
-        return
+        return []
 
     # Get the echo spacing and PE dir from the metadata
-    options = [mappings.options_from_metadata(f.get_metadata(), "dwi") for f in dwis]
+    options = mappings.options_from_metadata_batch([sidecars.get_metadata(f) for f in dwis], "dwi")
     echospacings = [float(o["echospacing"]) for o in options]
     pedirs = [o["pedir"] for o in options]
 
@@ -54,4 +59,4 @@ def run(subject, session, data_files, outdir, cluster=False, dep_job=None):
     if rev_fnames:
         cmd.extend(["--input_2", rev_fnames])
 
-    return utils.submit_cmd(cmd, cluster, dep_job)
+    return [cmd]
@@ -1,20 +1,234 @@
 """
 BRC_BIDS: Code to run IDP extraction
+
+IDPs are extracted for each session as an independent job, writing to an ``idps``
+folder in the session output directory. The per-session IDPs are then merged into
+a single cohort matrix stored as a NumPy ``.npz`` file containing:
+
+ - ``sessions``: Session output directory names (<subject>_<session>), one per row
+ - ``columns``: IDP names, one per column
+ - ``values``: Float matrix of IDP values, NaN where an IDP is missing for a session
+ - ``fingerprints``: Modification time and size of the IDP files each row was read from
+
+Merging is incremental: rows for new sessions are appended and sessions whose IDP
+files have changed are re-read, but unchanged sessions are never read again.
 """
+import json
 import logging
 import os
-import subprocess
 
 LOG = logging.getLogger(__name__)
 
-def run(subjdirs, outdir, cluster=False, dep_job=None):
-    subjfile = os.path.join(outdir, "subjs.txt")
-    with open(subjfile, "w") as f:
-        for subjdir in subjdirs:
-            f.write(f'{subjdir}')
-    idpdir = os.path.join(outdir, 'idps')
-    cmd = ['idp_extract.sh', '--in', subjfile, '--indir', outdir, '--outdir', idpdir]
-    LOG.info(" ".join(cmd))
-    #stdout = subprocess.check_output(cmd)
-    #stdout = stdout.decode("UTF-8")
-    #LOG.debug(stdout)
+from . import utils
+
+# Name of IDP output folder within each session output directory
+IDP_DIRNAME = "idps"
+
+# Cohort IDP matrix, relative to the pipeline output directory
+COHORT_FILENAME = os.path.join("idps", "cohort_idps.npz")
+
+# Values in IDP files which mean the IDP could not be calculated
+MISSING_VALUES = ("n/a", "na", "nan", "")
+
+def session_idp_dir(outdir, subjdir):
+    """
+    :return: IDP output folder for a session
+    """
+    return os.path.join(outdir, subjdir, IDP_DIRNAME)
+
+def cohort_path(outdir):
+    """
+    :return: Path to the cohort IDP matrix for a pipeline output directory
+    """
+    return os.path.join(outdir, COHORT_FILENAME)
+
+def get_cmds(subject, session, data_files, outdir):
+    """
+    Get the commands to run IDP extraction on a single session
+
+    :return: List of commands, each a list of arguments
+    """
+    subjdir = f"{subject}_{session}"
+    subjfile = _write_list(os.path.join(utils.work_dir(outdir, "idps"), f"{subjdir}.txt"), [subjdir])
+    cmd = ['idp_extract.sh', '--in', subjfile, '--indir', outdir, '--outdir', session_idp_dir(outdir, subjdir)]
+    return [cmd]
+
+def get_merge_cmds(subjdirs, outdir):
+    """
+    Get the commands to merge the IDPs of a set of sessions into the cohort matrix
+
+    :param subjdirs: Names of session output directories
+    :return: List of commands, each a list of arguments
+    """
+    subjfile = _write_list(os.path.join(outdir, "subjs.txt"), subjdirs)
+    # The cohort file is not passed explicitly, otherwise incremental runs would treat
+    # it as an input which had changed every time it was updated
+    cmd = ['brc_bids', 'idpmerge', '--in', os.path.abspath(subjfile), '--indir', os.path.abspath(outdir)]
+    return [cmd]
+
+def _write_list(fname, subjdirs):
+    """
+    Write a list of session directories, one per line
+
+    The file is only rewritten if it has changed, so incremental runs can tell if the
+    session list is unchanged
+
+    :return: File name
+    """
+    content = "".join([f'{subjdir}\n' for subjdir in subjdirs])
+    if os.path.exists(fname):
+        with open(fname) as f:
+            if f.read() == content:
+                return fname
+    with open(fname, "w") as f:
+        f.write(content)
+    return fname
+
+def read_session_idps(idpdir):
+    """
+    Read the IDPs extracted for a single session
+
+    Every .txt file in the session IDP folder is read. A file either contains a single
+    row of values, or a header row of IDP names followed by a row of values. IDPs are
+    named <file>.<header name>, or <file>.<n> where there is no header
+
+    :return: Dict mapping IDP name to value
+    """
+    idps = {}
+    for relpath in _idp_files(idpdir):
+        group = relpath[:-len(".txt")].replace(os.sep, ".")
+        with open(os.path.join(idpdir, relpath)) as f:
+            lines = [line.split() for line in f if line.strip()]
+        if len(lines) > 1 and not all([_is_value(token) for token in lines[0]]):
+            names, values = lines[0], lines[1]
+            if len(names) != len(values):
+                LOG.warn(f"IDP file {relpath} in {idpdir} has {len(names)} names but {len(values)} values")
+        else:
+            values = [token for line in lines for token in line]
+            names = [str(idx + 1) for idx in range(len(values))]
+        for name, value in zip(names, values):
+            number = _to_float(value)
+            if number is None:
+                LOG.warn(f"Non-numeric value for IDP {name} in {relpath} in {idpdir}: {value}")
+                number = float("nan")
+            idps[f"{group}.{name}"] = number
+    return idps
+
+def merge(subjdirs, indir, output):
+    """
+    Merge per-session IDPs into the cohort matrix, updating it incrementally
+
+    Sessions already in the matrix but not in ``subjdirs`` are kept, so the matrix can
+    be built up from runs on different subsets of subjects
+
+    :param subjdirs: Names of session output directories to merge
+    :param indir: Pipeline output directory containing the session output directories
+    :param output: Path to cohort .npz file. It is created if it does not exist
+
+    :return: Number of sessions added or updated
+    """
+    import numpy as np
+    sessions, columns, values, fingerprints = _load_cohort(output)
+    rows = {session : idx for idx, session in enumerate(sessions)}
+    column_idx = {column : idx for idx, column in enumerate(columns)}
+
+    updates = []
+    for subjdir in subjdirs:
+        idpdir = session_idp_dir(indir, subjdir)
+        files = _idp_files(idpdir)
+        if not files:
+            LOG.warn(f"No IDPs found for {subjdir}")
+            continue
+        fingerprint = _fingerprint(idpdir, files)
+        if subjdir in rows and fingerprints[rows[subjdir]] == fingerprint:
+            continue
+        idps = read_session_idps(idpdir)
+        for name in idps:
+            if name not in column_idx:
+                column_idx[name] = len(columns)
+                columns.append(name)
+        updates.append((subjdir, fingerprint, idps))
+
+    if not updates:
+        LOG.info(f"Cohort IDPs in {output} are up to date")
+        return 0
+
+    # New columns are missing for existing sessions, new rows are missing for all columns
+    # until filled in
+    nnew = len([subjdir for subjdir, _fingerprint, _idps in updates if subjdir not in rows])
+    values = np.pad(values, ((0, nnew), (0, len(columns) - values.shape[1])), constant_values=np.nan)
+    for subjdir, fingerprint, idps in updates:
+        if subjdir in rows:
+            row = rows[subjdir]
+            values[row] = np.nan
+            fingerprints[row] = fingerprint
+        else:
+            row = rows[subjdir] = len(sessions)
+            sessions.append(subjdir)
+            fingerprints.append(fingerprint)
+        values[row, [column_idx[name] for name in idps]] = list(idps.values())
+
+    outdir = os.path.dirname(os.path.abspath(output))
+    os.makedirs(outdir, exist_ok=True)
+    tmp = os.path.join(outdir, f".{os.path.basename(output)}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        np.savez(f, sessions=np.array(sessions, dtype=str), columns=np.array(columns, dtype=str),
+                 values=values, fingerprints=np.array(fingerprints, dtype=str))
+    os.replace(tmp, output)
+    LOG.info(f"Updated {len(updates)} sessions in {output}: {len(sessions)} sessions, {len(columns)} IDPs")
+    return len(updates)
+
+def load_cohort(output):
+    """
+    Load the cohort IDP matrix
+
+    :return: Tuple of session names, IDP names, value matrix with one row per session
+    """
+    sessions, columns, values, _fingerprints = _load_cohort(output)
+    return sessions, columns, values
+
+def _load_cohort(output):
+    """
+    :return: Tuple of lists of sessions, columns, value matrix and list of fingerprints.
+             Empty if the cohort file does not exist yet
+    """
+    import numpy as np
+    if not os.path.exists(output):
+        return [], [], np.zeros((0, 0)), []
+    with np.load(output, allow_pickle=False) as data:
+        return data["sessions"].tolist(), data["columns"].tolist(), data["values"], data["fingerprints"].tolist()
+
+def _idp_files(idpdir):
+    """
+    :return: Sorted paths of the IDP files in a session IDP folder, relative to the folder
+    """
+    files = []
+    for dirpath, _dirnames, filenames in os.walk(idpdir):
+        for filename in filenames:
+            if filename.endswith(".txt"):
+                files.append(os.path.relpath(os.path.join(dirpath, filename), idpdir))
+    return sorted(files)
+
+def _fingerprint(idpdir, files):
+    """
+    :return: String identifying the current contents of the IDP files in a session IDP folder
+    """
+    ret = []
+    for relpath in files:
+        stat = os.stat(os.path.join(idpdir, relpath))
+        ret.append([relpath, stat.st_mtime_ns, stat.st_size])
+    return json.dumps(ret)
+
+def _is_value(token):
+    return token.lower() in MISSING_VALUES or _to_float(token) is not None
+
+def _to_float(token):
+    """
+    :return: Token as a float, NaN if it is a missing value, or None if it is not a number
+    """
+    if token.lower() in MISSING_VALUES:
+        return float("nan")
+    try:
+        return float(token)
+    except ValueError:
+        return None
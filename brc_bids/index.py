@@ -0,0 +1,382 @@
+"""
+BRC_BIDS: Persistent on-disk index of a BIDS dataset
+
+Crawling a large BIDS dataset and parsing all of its JSON sidecars is slow, particularly
+on network storage, so the pybids layout database is stored under the output directory
+and reused between runs. A snapshot of the dataset directory tree (path, mtime and size
+of every file) is stored alongside it so we can tell whether the dataset has changed
+since the database was built.
+"""
+import concurrent.futures
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+
+from . import profiling, records, sidecars
+
+LOG = logging.getLogger(__name__)
+
+# Name of index directory created under the output directory
+INDEX_DIRNAME = ".bids_index"
+
+# Extensions of image files returned by group_files
+IMAGE_EXTENSIONS = (".nii", ".nii.gz")
+
+# Top level directories which pybids does not index and so are not included in the snapshot
+SNAPSHOT_IGNORE = ("code", "derivatives", "sourcedata", "stimuli", "models")
+
+def get_layout(bidsdir, outdir=None, reset=False, subjects=None, sessions=None):
+    """
+    Get a BIDSLayout for a dataset, reusing a persistent index where possible
+
+    The index is only rebuilt if files have been added, removed or modified since
+    it was created. Only directories whose mtime has changed are re-scanned when
+    checking this, so modifying a file in place without changing its directory
+    will not be detected - use ``reset`` to force re-indexing in this case.
+
+    :param bidsdir: Path to BIDS dataset
+    :param outdir: Output directory to store the index in. If not specified, no
+                   persistent index is used
+    :param reset: If True, always rebuild the index
+    :param subjects: Optional sequence of subject labels. If specified, only these
+                     subjects are indexed. Each distinct selection has its own index
+    :param sessions: Optional sequence of session labels. If specified, other session
+                     directories are not indexed. Each distinct selection has its own index
+
+    :return: BIDSLayout instance
+    """
+    # pybids is slow to import so is only imported when a layout is needed
+    import bids
+    kwargs = {}
+    if subjects is not None or sessions is not None:
+        from bids.layout.index import BIDSLayoutIndexer
+        from bids.layout.validation import DEFAULT_LOCATIONS_TO_IGNORE
+        ignore = list(DEFAULT_LOCATIONS_TO_IGNORE)
+        if subjects is not None:
+            ignore.append(_other_subjects_regex(subjects))
+        if sessions is not None:
+            ignore.append(_other_sessions_regex(sessions))
+        kwargs["indexer"] = BIDSLayoutIndexer(ignore=ignore)
+
+    if outdir is None:
+        with profiling.timer("layout", reset=True):
+            return bids.BIDSLayout(bidsdir, **kwargs)
+
+    bidsdir = os.path.abspath(bidsdir)
+    index_dir = os.path.join(outdir, INDEX_DIRNAME)
+    if subjects is not None:
+        selection = hashlib.sha1("\n".join(sorted(subjects)).encode("utf-8")).hexdigest()[:12]
+        index_dir = os.path.join(index_dir, f"subjects-{selection}")
+    if sessions is not None:
+        selection = hashlib.sha1("\n".join(sorted(sessions)).encode("utf-8")).hexdigest()[:12]
+        index_dir = os.path.join(index_dir, f"sessions-{selection}")
+    os.makedirs(index_dir, exist_ok=True)
+    database_path = os.path.join(index_dir, "layout")
+
+    conn = sqlite3.connect(os.path.join(index_dir, "snapshot.sqlite"))
+    try:
+        with conn:
+            _init_snapshot(conn)
+            with profiling.timer("snapshot"):
+                changes = _update_snapshot(conn, bidsdir, None if subjects is None else set(subjects), None if sessions is None else set(sessions))
+            reset = reset or changes > 0 or not os.path.isdir(database_path)
+            if reset:
+                LOG.info(f"Indexing BIDS dataset {bidsdir} ({changes} changed files or directories)")
+            else:
+                LOG.info(f"Using existing index for BIDS dataset {bidsdir}")
+
+            # The snapshot is only committed once the layout database has been built
+            # successfully, otherwise the next run could reuse a partial database
+            with profiling.timer("layout", reset=reset):
+                layout = bids.BIDSLayout(bidsdir, database_path=database_path, reset_database=reset, **kwargs)
+    finally:
+        conn.close()
+    return layout
+
+def _other_subjects_regex(subjects):
+    """
+    :return: Regular expression matching subject directories not in the selection
+    """
+    selected = "|".join([re.escape(subj) for subj in sorted(subjects)])
+    return re.compile(rf"^/sub-(?!(?:{selected})(?:/|$))[^/]+")
+
+def _other_sessions_regex(sessions):
+    """
+    :return: Regular expression matching session directories not in the selection
+    """
+    selected = "|".join([re.escape(sess) for sess in sorted(sessions)])
+    return re.compile(rf"^/sub-[^/]+/ses-(?!(?:{selected})(?:/|$))[^/]+")
+
+def _init_snapshot(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dirname TEXT, mtime_ns INTEGER, size INTEGER)")
+    conn.execute("CREATE INDEX IF NOT EXISTS files_dirname ON files (dirname)")
+    conn.execute("CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)")
+
+def _update_snapshot(conn, bidsdir, subjects=None, sessions=None):
+    """
+    Update the snapshot of the dataset directory tree
+
+    Directories whose mtime has not changed are not scanned - their recorded files
+    and subdirectories are reused. If subjects or sessions are specified, other subject
+    and session directories are not included
+
+    :return: Number of files and directories which have been added, removed or modified
+    """
+    root = conn.execute("SELECT value FROM info WHERE key='root'").fetchone()
+    if root is None or root[0] != bidsdir:
+        # Snapshot is for a different dataset, so start again
+        conn.execute("DELETE FROM dirs")
+        conn.execute("DELETE FROM files")
+        conn.execute("INSERT OR REPLACE INTO info VALUES ('root', ?)", (bidsdir,))
+
+    old_dirs = {path: mtime for path, mtime in conn.execute("SELECT path, mtime_ns FROM dirs")}
+    changes, seen_dirs, stack = 0, set(), [(bidsdir, None)]
+    while stack:
+        dirpath, parent = stack.pop()
+        seen_dirs.add(dirpath)
+        try:
+            mtime = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            continue
+
+        if old_dirs.get(dirpath, None) == mtime:
+            subdirs = [row[0] for row in conn.execute("SELECT path FROM dirs WHERE parent=?", (dirpath,))]
+        else:
+            subdirs, dir_changes = _scan_dir(conn, dirpath, dirpath == bidsdir, subjects, sessions if parent == bidsdir else None)
+            conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (dirpath, parent, mtime))
+            changes += dir_changes + (dirpath not in old_dirs)
+        stack.extend([(subdir, dirpath) for subdir in subdirs])
+
+    # Directories which no longer exist
+    for dirpath in set(old_dirs) - seen_dirs:
+        changes += 1
+        conn.execute("DELETE FROM dirs WHERE path=?", (dirpath,))
+        conn.execute("DELETE FROM files WHERE dirname=?", (dirpath,))
+
+    return changes
+
+def _scan_dir(conn, dirpath, is_root, subjects=None, sessions=None):
+    """
+    Re-scan a directory whose mtime has changed
+
+    :param sessions: Session labels to include if this is a subject directory
+
+    :return: Tuple of list of subdirectory paths, number of files added, removed or modified
+    """
+    old_files = {path: (mtime, size) for path, mtime, size in conn.execute(
+        "SELECT path, mtime_ns, size FROM files WHERE dirname=?", (dirpath,)
+    )}
+    subdirs, changes = [], 0
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                if is_root and entry.name in SNAPSHOT_IGNORE:
+                    continue
+                if is_root and subjects is not None and entry.name.startswith("sub-") and entry.name[4:] not in subjects:
+                    continue
+                if sessions is not None and entry.name.startswith("ses-") and entry.name[4:] not in sessions:
+                    continue
+                subdirs.append(entry.path)
+                continue
+
+            stat = entry.stat()
+            fingerprint = (stat.st_mtime_ns, stat.st_size)
+            if old_files.pop(entry.path, None) != fingerprint:
+                changes += 1
+                conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (entry.path, dirpath) + fingerprint)
+
+    # Files which have been removed
+    for path in old_files:
+        changes += 1
+        conn.execute("DELETE FROM files WHERE path=?", (path,))
+    return subdirs, changes
+
+def group_files(layout, suffixes, subjects=None, sessions=None, metadata=False):
+    """
+    Group the image files in a dataset by subject, session and suffix
+
+    :param layout: BIDSLayout instance
+    :param suffixes: Sequence of file suffixes to include, e.g. T1w
+    :param subjects: Optional sequence of subject labels to include
+    :param sessions: Optional sequence of session labels to include
+    :param metadata: If True, resolve the JSON sidecar metadata of each image (in
+                     parallel) and include it in the records
+
+    :return dict mapping subjects to a group of sessions. The session group is a dict mapping
+            session ID to records.SessionFiles, which maps the requested file suffixes to
+            tuples of records.FileRecord. Subjects without a session level have a single
+            session with ID None
+    """
+    data_files = {}
+    for session_files in iter_session_files(layout, suffixes, subjects, sessions, metadata):
+        data_files.setdefault(session_files.subject, {})[session_files.session] = session_files
+    return data_files
+
+def iter_session_files(layout, suffixes, subjects=None, sessions=None, metadata=False):
+    """
+    Generate the image files in a dataset one session at a time
+
+    The entity table is streamed in path order, so the files of each subject arrive
+    together and its sessions can be yielded as soon as the next subject starts. Only
+    one subject's entities are held in memory at a time. Files are returned as
+    lightweight records so no pybids objects are kept alive.
+
+    :param layout: BIDSLayout instance. This must remain open until the generator is exhausted
+    :param suffixes: Sequence of file suffixes to include, e.g. T1w
+    :param subjects: Optional sequence of subject labels to include
+    :param sessions: Optional sequence of session labels to include
+    :param metadata: If True, resolve the JSON sidecar metadata of each image (in
+                     parallel) and include it in the records
+
+    :return: Generator of records.SessionFiles in order of subject and session. Subjects
+             without a session level have a single session with ID None
+    """
+    # The layout database is queried directly rather than through BIDSFile objects, which are
+    # far slower to load. Entity values are read from the Tag._value column since the public
+    # Tag.value is only set on loaded ORM objects, so requirements.txt pins pybids to the
+    # versions with this schema
+    from bids.layout.models import FileAssociation, Tag
+
+    # Entities of files outside the subject directories (e.g. top level sidecars), which
+    # may be associated with files of any subject
+    subjdir_prefix = os.path.join(os.path.abspath(layout.root), "sub-")
+    other_entities = {}
+    other_tags = layout.session.query(Tag.file_path, Tag.entity_name, Tag._value).filter(
+        Tag.is_metadata == False, ~Tag.file_path.startswith(subjdir_prefix, autoescape=True)
+    )
+    for path, name, value in other_tags:
+        other_entities.setdefault(path, {})[name] = value
+
+    # Entities and associations are each streamed in path order in a single query and
+    # merged one subject at a time
+    tags = layout.session.query(Tag.file_path, Tag.entity_name, Tag._value).filter(
+        Tag.is_metadata == False, Tag.file_path.startswith(subjdir_prefix, autoescape=True)
+    ).order_by(Tag.file_path).yield_per(10000)
+    assocs = layout.session.query(FileAssociation.src, FileAssociation.dst).filter(
+        FileAssociation.src.startswith(subjdir_prefix, autoescape=True)
+    ).order_by(FileAssociation.src, FileAssociation.dst).yield_per(10000)
+    subject_assocs = _subject_rows(assocs, subjdir_prefix)
+    next_assocs = next(subject_assocs, None)
+
+    # Sidecars are read as each subject is reached, since its images are only known once
+    # the stream gets there, but one thread pool is shared by all subjects
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=sidecars.DEFAULT_WORKERS) if metadata else None
+    assoc_records = {}
+    try:
+        for subjdir, rows in _subject_rows(tags, subjdir_prefix):
+            file_entities = {}
+            for path, name, value in rows:
+                file_entities.setdefault(path, {})[name] = value
+            associations = {}
+            while next_assocs is not None and next_assocs[0] + os.sep <= subjdir + os.sep:
+                if next_assocs[0] == subjdir:
+                    for src, dst in next_assocs[1]:
+                        associations.setdefault(src, []).append(dst)
+                next_assocs = next(subject_assocs, None)
+
+            yield from _subject_session_files(file_entities, associations, other_entities, suffixes, subjects, sessions, metadata, assoc_records, executor)
+            # Only records for files outside the subject directories are kept between subjects
+            assoc_records = {path : record for path, record in assoc_records.items() if path in other_entities}
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+def _subject_rows(rows, subjdir_prefix):
+    """
+    Group rows of a query in path order by subject directory
+
+    Paths are compared with a trailing separator so the order of subject directories
+    matches the order of the paths within them, e.g. sub-01-a/ sorts before sub-01/
+
+    :param rows: Iterable of rows whose first column is a path in a subject directory
+    :return: Generator of (subject directory, list of rows)
+    """
+    subjdir, subjdir_rows = None, []
+    for row in rows:
+        path = row[0]
+        path_subjdir = path[:path.find(os.sep, len(subjdir_prefix))]
+        if path_subjdir != subjdir:
+            if subjdir_rows:
+                yield subjdir, subjdir_rows
+            subjdir, subjdir_rows = path_subjdir, []
+        subjdir_rows.append(row)
+    if subjdir_rows:
+        yield subjdir, subjdir_rows
+
+@profiling.timed("group_files")
+def _subject_session_files(file_entities, associations, other_entities, suffixes, subjects, sessions, metadata, assoc_records, executor=None):
+    """
+    Get the session records for a single subject
+
+    :param file_entities: Dict mapping path to entities for all files in the subject directory
+    :param associations: Dict mapping path to paths of associated files for all files in the
+                         subject directory
+    :param other_entities: Dict mapping path to entities for files outside the subject directories
+    :param assoc_records: Dict mapping path to records.FileRecord for associated files, which
+                          is updated with any new associated files found
+    :param executor: Optional thread pool to read the sidecar metadata with
+
+    :return: List of records.SessionFiles
+    """
+    grouped = {}
+    for entities in file_entities.values():
+        if "subject" not in entities:
+            continue
+        if subjects is not None and entities["subject"] not in subjects:
+            continue
+        if sessions is not None and entities.get("session", None) not in sessions:
+            continue
+        grouped.setdefault(entities["subject"], {})
+        if "session" in entities:
+            grouped[entities["subject"]].setdefault(entities["session"], {suffix: [] for suffix in suffixes})
+
+    for subj_sessions in grouped.values():
+        if not subj_sessions:
+            subj_sessions[None] = {suffix: [] for suffix in suffixes}
+
+    paths = []
+    for path in sorted(file_entities):
+        entities = file_entities[path]
+        suffix = entities.get("suffix", None)
+        if suffix not in suffixes or entities.get("extension", None) not in IMAGE_EXTENSIONS:
+            continue
+        session_files = grouped.get(entities.get("subject", None), {}).get(entities.get("session", None), None)
+        if session_files is not None:
+            LOG.debug(f"Found {suffix.upper()} image: {os.path.basename(path)}")
+            session_files[suffix].append(path)
+            paths.append(path)
+    if not grouped:
+        return []
+
+    if metadata:
+        sidecars.prefetch(paths, executor=executor)
+
+    # Associated files are shared between the images which reference them. Files outside
+    # the subject directory (e.g. top level sidecars) are shared between subjects
+    def _record(path):
+        assocs = []
+        for dst in associations.get(path, []):
+            if dst not in assoc_records:
+                entities = file_entities.get(dst, None)
+                if entities is None:
+                    entities = other_entities.get(dst, {})
+                assoc_records[dst] = records.FileRecord(dst, entities)
+            assocs.append(assoc_records[dst])
+        md = sidecars.get_metadata(path) if metadata else None
+        return records.FileRecord(path, file_entities.get(path, {}), md, assocs)
+
+    profiling.count("image_files", len(paths))
+    return [
+        records.SessionFiles(subj, sess, {
+            suffix : [_record(path) for path in suffix_paths]
+            for suffix, suffix_paths in grouped[subj][sess].items()
+        })
+        for subj in sorted(grouped)
+        for sess in sorted(grouped[subj], key=lambda sess: "" if sess is None else sess)
+    ]
@@ -0,0 +1,109 @@
+"""
+BRC_BIDS: Ledger of submitted jobs
+
+Every command submitted by a pipeline run is appended to a JSON lines file in the
+output directory, recording the run, session, stage, job ID, command and completion
+marker. This is the record used by ``brc_bids status`` to work out which sessions
+have finished without asking the scheduler about each job separately.
+
+Entries from later runs supersede those from earlier runs for the same session, stage
+and command, so the ledger describes the latest submission of everything even after
+incremental re-runs.
+"""
+import json
+import os
+import time
+
+from . import utils
+
+LEDGER_FILENAME = "ledger.jsonl"
+
+def ledger_path(outdir):
+    """
+    :return: Path to the job ledger for a pipeline output directory
+    """
+    return os.path.join(utils.work_dir(outdir), LEDGER_FILENAME)
+
+def new_run_id():
+    """
+    :return: Identifier for a pipeline run, unique for the output directory
+    """
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+
+def entries(run_id, key, stage, cmds, jobs, markers, cluster):
+    """
+    Create ledger entries for the commands submitted for a stage
+
+    :param run_id: ID of the pipeline run, see new_run_id
+    :param key: Session key <subject>_<session> or 'cohort'
+    :param stage: Stage name
+    :param cmds: Commands submitted, without completion marker wrappers
+    :param jobs: Job labels, one for each command. None where no job ID is known
+    :param markers: Completion marker paths, one for each command
+    :param cluster: Whether the jobs were submitted to the cluster
+
+    :return: List of entry dicts
+    """
+    submitted = time.time()
+    return [
+        {
+            "run" : run_id,
+            "time" : submitted,
+            "key" : key,
+            "stage" : stage,
+            "idx" : idx,
+            "job" : job,
+            "cluster" : cluster,
+            "cmd" : cmd,
+            "marker" : marker,
+        }
+        for idx, (cmd, job, marker) in enumerate(zip(cmds, jobs, markers))
+    ]
+
+def append(outdir, new_entries):
+    """
+    Append entries to the ledger with a single write
+    """
+    if not new_entries:
+        return
+    lines = "".join([json.dumps(entry) + "\n" for entry in new_entries])
+    with open(ledger_path(outdir), "a") as f:
+        f.write(lines)
+
+def read(outdir):
+    """
+    Read all entries in the ledger
+
+    A truncated final line, e.g. from a run which was killed while writing, is ignored
+
+    :return: List of entry dicts in the order they were recorded
+    """
+    fname = os.path.join(outdir, utils.WORK_DIRNAME, LEDGER_FILENAME)
+    if not os.path.exists(fname):
+        return []
+    ret = []
+    with open(fname) as f:
+        for line in f:
+            try:
+                ret.append(json.loads(line))
+            except ValueError:
+                continue
+    return ret
+
+def latest(ledger_entries):
+    """
+    Get the latest entry for each command
+
+    When a stage is resubmitted, all entries for it from earlier runs are superseded,
+    even if the stage now has fewer commands
+
+    :return: Dict mapping (key, stage, idx) to entry dict
+    """
+    stage_runs = {}
+    for entry in ledger_entries:
+        stage_runs[(entry["key"], entry["stage"])] = entry["run"]
+    return {
+        (entry["key"], entry["stage"], entry["idx"]) : entry
+        for entry in ledger_entries
+        if stage_runs[(entry["key"], entry["stage"])] == entry["run"]
+    }
@@ -0,0 +1,171 @@
+"""
+BRC_BIDS: Concurrent execution of pipeline commands on the local machine
+
+When not running in cluster mode, commands passed to utils.submit_cmd can be run
+by a LocalExecutor rather than one at a time. Up to a fixed number of commands run
+concurrently, subject to a limit on their total memory requirement, and a command
+does not start until the commands it depends on have completed successfully.
+"""
+import logging
+import os
+import subprocess
+import threading
+
+from . import profiling
+
+LOG = logging.getLogger(__name__)
+
+class LocalJob:
+    """
+    A command submitted to a LocalExecutor
+    """
+    def __init__(self, job_id, cmd, deps, minutes, ram):
+        self.job_id = job_id
+        self.cmd = cmd
+        self.deps = deps
+        self.minutes = minutes
+        self.ram = ram or 0
+        self.status = "pending"
+
+class LocalExecutor:
+    """
+    Runs commands concurrently on the local machine
+    """
+    def __init__(self, jobs=None, max_ram=None, logdir=None):
+        """
+        :param jobs: Maximum number of commands to run at once. Defaults to the number of CPUs
+        :param max_ram: Maximum total memory requirement in Mb of running commands. A command
+                        which requires more than this on its own is run when nothing else is
+        :param logdir: Directory to write command output to. If not specified, output
+                       is logged at debug level
+        """
+        self.jobs = jobs or os.cpu_count() or 1
+        self.max_ram = max_ram
+        self.logdir = logdir
+        self._cond = threading.Condition()
+        self._all_jobs = {}
+        self._pending = []
+        self._running_ram = 0
+        self._running = 0
+        self._threads = []
+        self._shutdown = False
+        if logdir:
+            os.makedirs(logdir, exist_ok=True)
+
+    def submit(self, cmd, dep_job=None, minutes=5, ram=None):
+        """
+        Queue a command to run
+
+        :param cmd: Command as sequence of arguments
+        :param dep_job: Sequence of job IDs which must complete successfully first
+        :param minutes: Expected run time. Where several commands are ready to run,
+                        the longest running are started first
+        :param ram: Expected memory requirement in Mb
+
+        :return: Job ID
+        """
+        with self._cond:
+            job_id = f"local-{len(self._all_jobs)+1}"
+            deps = []
+            for dep in dep_job or []:
+                if dep in self._all_jobs:
+                    deps.append(dep)
+                else:
+                    LOG.warn(f"Unknown dependency for local job {job_id}: {dep} - ignoring")
+            job = LocalJob(job_id, cmd, deps, minutes, ram)
+            self._all_jobs[job_id] = job
+            self._pending.append(job)
+            LOG.info(f"{job_id}: " + " ".join(cmd))
+            if len(self._threads) < self.jobs:
+                thread = threading.Thread(target=self._worker, daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify_all()
+        return job_id
+
+    def wait(self):
+        """
+        Wait for all submitted commands to finish
+
+        :raise RuntimeError: If any command failed or was not run because a command it
+                             depended on failed
+        """
+        with self._cond:
+            while self._pending or self._running:
+                self._cond.wait()
+            failed = [job for job in self._all_jobs.values() if job.status != "done"]
+            self._shutdown = True
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._shutdown = False
+        if failed:
+            raise RuntimeError(f"{len(failed)} local jobs failed: " + ", ".join([f"{job.job_id} ({job.status})" for job in failed]))
+
+    def _next_job(self):
+        """
+        Get the next job which is ready to run, or None. Must be called with the lock held
+        """
+        ready = []
+        for job in list(self._pending):
+            dep_status = [self._all_jobs[dep].status for dep in job.deps]
+            if any(status in ("failed", "skipped") for status in dep_status):
+                LOG.warn(f"{job.job_id}: Not running as a job it depends on failed")
+                job.status = "skipped"
+                self._pending.remove(job)
+                self._cond.notify_all()
+            elif all(status == "done" for status in dep_status):
+                ready.append(job)
+
+        for job in sorted(ready, key=lambda job: -job.minutes):
+            if not self.max_ram or not self._running or self._running_ram + job.ram <= self.max_ram:
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    if self._shutdown:
+                        return
+                    self._cond.wait()
+                    job = self._next_job()
+                self._pending.remove(job)
+                job.status = "running"
+                self._running += 1
+                self._running_ram += job.ram
+
+            try:
+                with profiling.timer("local_job", "run", job=job.job_id, cmd=job.cmd[0]):
+                    success = self._run(job)
+            except Exception as exc:
+                # The job must still be marked as finished or wait() would never return
+                LOG.exception(f"{job.job_id}: Failed: {exc}")
+                success = False
+
+            with self._cond:
+                job.status = "done" if success else "failed"
+                self._running -= 1
+                self._running_ram -= job.ram
+                self._cond.notify_all()
+
+    def _run(self, job):
+        LOG.info(f"{job.job_id}: Starting")
+        profiling.count("subprocess_calls")
+        try:
+            if self.logdir:
+                with open(os.path.join(self.logdir, f"{job.job_id}.log"), "w") as f:
+                    f.write(" ".join(job.cmd) + "\n")
+                    f.flush()
+                    subprocess.run(job.cmd, stdout=f, stderr=subprocess.STDOUT, check=True)
+            else:
+                result = subprocess.run(job.cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+                LOG.debug(result.stdout.decode("UTF-8"))
+            LOG.info(f"{job.job_id}: Completed")
+            return True
+        except (OSError, subprocess.CalledProcessError) as exc:
+            LOG.error(f"{job.job_id}: Failed: {exc}")
+            return False
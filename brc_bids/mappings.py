@@ -2,6 +2,7 @@
 BRC_BIDS: Defines mapping of BIDS metadata keys to pipeline options
 """
 
+import collections
 import logging
 
 LOG = logging.getLogger(__name__)
@@ -17,11 +18,44 @@ def _calc_bolus(js_dict, options):
     elif 'LabelingDuration' in js_dict:
         return js_dict['LabelingDuration']
 
-def _calc_slicedt(js_dict, options):
+def analyse_slice_timing(times):
+    """
+    Analyse slice timings, detecting multiband acquisitions
+
+    In a multiband acquisition the slices are acquired in groups (bands) with the
+    same timing pattern repeated in each band, so each acquisition time is shared by
+    one slice in every band
+
+    :param times: Sequence of acquisition times, one per slice
+    :return: Tuple of time between successive slice acquisitions, number of slices
+             per band or None if not multiband
+    """
+    import numpy as np
+    times = np.asarray(times, dtype=float)
+    if times.size < 2:
+        return None, None
+
+    unique, counts = np.unique(times, return_counts=True)
+    slicedt = float(np.mean(np.diff(unique))) if unique.size > 1 else 0.0
+    sliceband = None
+    if counts[0] > 1:
+        nbands = counts[0]
+        if np.all(counts == nbands) and times.size % nbands == 0:
+            bands = times.reshape(nbands, -1)
+            if np.all(bands == bands[0]):
+                sliceband = bands.shape[1]
+        if sliceband is None:
+            LOG.warn("Slice timings have repeated values but do not form a regular multiband pattern")
+    return slicedt, sliceband
+
+def _calc_slice_timing(js_dict, options):
+    # Slice timings are analysed once per file and set both slicedt and sliceband
     if "SliceTiming" in js_dict:
-        times = js_dict['SliceTiming']
-        dts = [ pair[0]-pair[1] for pair in zip(times[1:], times[:-1]) ] 
-        return sum(dts) / len(dts)
+        slicedt, sliceband = analyse_slice_timing(js_dict['SliceTiming'])
+        if slicedt is not None:
+            options['slicedt'] = slicedt
+        if sliceband is not None:
+            options['sliceband'] = sliceband
 
 def _interpret_pedir(js_dict, options):
     dir_map = {"i" : "x", "j" : "y", "k" : "z"}
@@ -38,10 +72,10 @@ def _postproc_asl(metadata, options):
     else:
         ttype, otype = 'tis', 'plds'
 
-    # Remove unused timings field and make sure it is a list
+    # Remove unused timings field and make sure it is an array
+    import numpy as np
     options.pop(otype, None)
-    if isinstance(options[ttype], (int, float)):
-        options[ttype] = [options[ttype]]
+    options[ttype] = np.atleast_1d(np.asarray(options[ttype], dtype=float))
 
 def _postproc_cblip(metadata, options):
     if "totalreadouttime" in options:
@@ -78,8 +112,7 @@ METADATA_MAPPINGS = {
         ('nenc', None),
         ('casl', _is_casl),
         ('bolus', _calc_bolus),
-        ('slicedt', _calc_slicedt),
-        ('sliceband', None),
+        (None, _calc_slice_timing),
         ('artsupp', 'VascularCrushing'),
         (None, _postproc_asl),
     ],
@@ -113,6 +146,27 @@ METADATA_MAPPINGS = {
     ]
 }
 
+def compile_mappings(mappings):
+    """
+    Compile a list of mappings into a plan which can be run against metadata
+
+    Mappings with no metadata key or function are dropped since they can never
+    produce a value
+
+    :param mappings: List of (option key, metadata key or function) as in METADATA_MAPPINGS
+    :return: Tuple of (option key, metadata key or None, function or None)
+    """
+    plan = []
+    for option_key, md_key in mappings:
+        if type(md_key) is str:
+            plan.append((option_key, md_key, None))
+        elif callable(md_key):
+            plan.append((option_key, None, md_key))
+    return tuple(plan)
+
+# Compiled plans for each file type - see compile_mappings
+PLANS = {filetype : compile_mappings(mappings) for filetype, mappings in METADATA_MAPPINGS.items()}
+
 def options_from_metadata(metadata, filetype, **extra_metadata):
     """
     Get the relevant options from JSON metadata
@@ -121,16 +175,40 @@ def options_from_metadata(metadata, filetype, **extra_metadata):
     :param filetype: Type of file metadata describes: asl, calib, cblip, struct, dwi
     :param extra_metadata: Keyword arguments to override metadata from JSON file
     """
-    config = {}
-    metadata = dict(metadata)
-    metadata.update(extra_metadata)
+    return _run_plan(PLANS[filetype], metadata, extra_metadata)
 
-    for option_key, md_key in METADATA_MAPPINGS[filetype]:
-        val = None
-        if type(md_key) is str and md_key in metadata:
+def options_from_metadata_batch(metadatas, filetype, **extra_metadata):
+    """
+    Get the relevant options from the JSON metadata of many files of the same type
+
+    :param metadatas: Sequence of metadata dictionaries
+    :param filetype: Type of file metadata describes: asl, calib, cblip, struct, dwi
+    :param extra_metadata: Keyword arguments to override metadata from JSON files
+
+    :return: List of option dictionaries, one for each metadata dictionary
+    """
+    plan = PLANS[filetype]
+    return [_run_plan(plan, metadata, extra_metadata) for metadata in metadatas]
+
+def _run_plan(plan, metadata, extra_metadata):
+    """
+    Run a compiled plan against metadata
+
+    The metadata is not copied. Overrides are checked before the metadata for plain
+    keys, and functions are given a view of the metadata with the overrides layered on top
+    """
+    config = {}
+    view = metadata
+    if extra_metadata:
+        view = collections.ChainMap(extra_metadata, metadata)
+
+    for option_key, md_key, func in plan:
+        if func is not None:
+            val = func(view, config)
+        elif extra_metadata and md_key in extra_metadata:
+            val = extra_metadata[md_key]
+        else:
             val = metadata.get(md_key)
-        elif callable(md_key):
-            val = md_key(metadata, config)
 
         if val is not None:
             config[option_key] = val
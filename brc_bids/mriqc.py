@@ -1,8 +1,13 @@
 """
-BRC_BIDS: Code to run structural pipeline
+BRC_BIDS: Code to run MRIQC
+
+MRIQC is run at participant level as a separate job for each session, each with its
+own work directory, so a large cohort is spread across many nodes and no single job
+has to process the whole dataset. A single group level job then runs once all the
+participant level jobs have completed.
 """
 import logging
-import subprocess
+import os
 
 LOG = logging.getLogger(__name__)
 
@@ -10,6 +15,65 @@ from . import utils
 
 SINGULARITY_IMAGE="/software/imaging/singularity_images/poldracklab_mriqc-2021-01-30-767af1135fae.simg"
 
-def run(bidsdir, outdir, cluster=False, dep_job=None):
-    cmd = ['singularity', 'run', '--cleanenv', SINGULARITY_IMAGE, bidsdir, outdir, 'participant', '--no-sub']
-    return utils.submit_cmd(cmd, cluster, dep_job, minutes=600, ram=64000)
+# Resources requested for each participant level MRIQC job
+MINUTES = 120
+RAM = 16000
+
+# Resources requested for the group level MRIQC job
+GROUP_MINUTES = 30
+GROUP_RAM = 8000
+
+def participant_cmd(bidsdir, outdir, subject, session=None):
+    """
+    Get the command to run participant level MRIQC on a single subject or session
+
+    :param subject: Subject label
+    :param session: Optional session label. If not specified all sessions of the subject are processed
+    :return: Command as a list of arguments
+    """
+    workdir = os.path.abspath(utils.work_dir(outdir, "mriqc", f"{subject}_{session}"))
+    cmd = ['singularity', 'run', '--cleanenv', SINGULARITY_IMAGE, os.path.abspath(bidsdir), os.path.abspath(outdir), 'participant',
+           '--participant-label', subject]
+    if session:
+        cmd.extend(['--session-id', session])
+    cmd.extend(['-w', workdir, '--mem_gb', str(RAM // 1000), '--no-sub'])
+    return cmd
+
+def group_cmd(bidsdir, outdir):
+    """
+    Get the command to run group level MRIQC once all participants have been processed
+    """
+    return ['singularity', 'run', '--cleanenv', SINGULARITY_IMAGE, os.path.abspath(bidsdir), os.path.abspath(outdir), 'group', '--no-sub']
+
+def get_cmds(subject, session, data_files, outdir):
+    """
+    Get the commands to run participant level MRIQC on a session
+
+    :return: List of commands, each a list of arguments
+    """
+    bidsdir = _bids_root(subject, data_files)
+    if bidsdir is None:
+        LOG.info(f"No files found for subject {subject} session {session} - will not run MRIQC")
+        return []
+    return [participant_cmd(bidsdir, outdir, subject, session)]
+
+def get_group_cmds(bidsdir, outdir):
+    """
+    Get the commands to run group level MRIQC
+
+    :return: List of commands, each a list of arguments
+    """
+    return [group_cmd(bidsdir, outdir)]
+
+def _bids_root(subject, data_files):
+    """
+    Get the BIDS dataset root directory from the path of any file in a session
+
+    :return: Dataset root, or None if the session has no files
+    """
+    subjdir = os.sep + f"sub-{subject}" + os.sep
+    for records in data_files.values():
+        for record in records:
+            if subjdir in record.path:
+                return record.path[:record.path.rindex(subjdir)]
+    return None
@@ -0,0 +1,270 @@
+"""
+BRC_BIDS: Lightweight access to NIfTI image headers
+
+Only the fixed size NIfTI-1 (348 byte) or NIfTI-2 (540 byte) header is read. For
+gzipped images only as much of the compressed stream as is needed to recover the
+header is decompressed.
+
+Volumes can also be extracted from 4D images into new images without loading the
+whole image: uncompressed images are memory-mapped and gzipped images are
+decompressed once as a stream.
+"""
+import collections
+import gzip
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from . import profiling
+
+LOG = logging.getLogger(__name__)
+
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+HeaderInfo = collections.namedtuple("HeaderInfo", ["shape", "affine", "header_size", "vox_offset"])
+
+_LOCK = threading.Lock()
+
+# Path -> ((mtime, size), HeaderInfo)
+_CACHE = {}
+
+def probe(fname):
+    """
+    Get the shape and affine of a NIfTI image without loading it
+
+    Results are cached until the file's mtime or size changes
+
+    :param fname: Path to .nii or .nii.gz file
+    :return: HeaderInfo with image shape, 4x4 voxel-to-world affine matrix, header
+             size and offset of image data
+    """
+    fname = os.path.abspath(fname)
+    stat = os.stat(fname)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _LOCK:
+        cached = _CACHE.get(fname, None)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    with profiling.timer("nifti.probe"):
+        hdr = read_header(fname)
+        info = parse_header(hdr)
+    profiling.count("header_reads")
+    profiling.count("header_bytes", len(hdr))
+    with _LOCK:
+        _CACHE[fname] = (key, info)
+    return info
+
+def clear_cache():
+    """
+    Discard all cached header information
+    """
+    with _LOCK:
+        _CACHE.clear()
+
+def read_header(fname):
+    """
+    Read the raw header bytes from a NIfTI file
+
+    :return: Header bytes - at least 348 bytes for NIfTI-1 or 540 for NIfTI-2
+    """
+    with _open(fname) as f:
+        hdr = f.read(NIFTI1_HEADER_SIZE)
+        if len(hdr) < NIFTI1_HEADER_SIZE:
+            raise ValueError(f"{fname} is too short to be a NIfTI file")
+        if _endian(hdr)[1] == NIFTI2_HEADER_SIZE:
+            hdr += f.read(NIFTI2_HEADER_SIZE - NIFTI1_HEADER_SIZE)
+    return hdr
+
+def parse_header(hdr):
+    """
+    Get the image shape and affine from NIfTI header bytes
+
+    :param hdr: Raw header bytes
+    :return: HeaderInfo
+    """
+    import numpy as np
+    endian, header_size = _endian(hdr)
+    if header_size == NIFTI1_HEADER_SIZE:
+        dim = struct.unpack_from(endian + "8h", hdr, 40)
+        pixdim = struct.unpack_from(endian + "8f", hdr, 76)
+        vox_offset = struct.unpack_from(endian + "f", hdr, 108)[0]
+        qform_code, sform_code = struct.unpack_from(endian + "2h", hdr, 252)
+        quatern = struct.unpack_from(endian + "6f", hdr, 256)
+        srow = struct.unpack_from(endian + "12f", hdr, 280)
+    else:
+        dim = struct.unpack_from(endian + "8q", hdr, 16)
+        pixdim = struct.unpack_from(endian + "8d", hdr, 104)
+        vox_offset = struct.unpack_from(endian + "q", hdr, 168)[0]
+        qform_code, sform_code = struct.unpack_from(endian + "2i", hdr, 344)
+        quatern = struct.unpack_from(endian + "6d", hdr, 352)
+        srow = struct.unpack_from(endian + "12d", hdr, 400)
+
+    ndim = dim[0]
+    if not 0 < ndim <= 7:
+        raise ValueError(f"Invalid number of dimensions in NIfTI header: {ndim}")
+    shape = tuple(int(d) for d in dim[1:ndim+1])
+
+    if sform_code > 0:
+        affine = np.eye(4)
+        affine[:3] = np.array(srow).reshape(3, 4)
+    elif qform_code > 0:
+        affine = _quatern_affine(quatern, pixdim)
+    else:
+        affine = np.diag(list(pixdim[1:4]) + [1])
+    return HeaderInfo(shape, affine, header_size, int(vox_offset))
+
+def extract_volumes(fname, outputs, compresslevel=1):
+    """
+    Extract volumes from a 4D image into one or more new images in a single pass
+
+    Each output image has the same header as the input, including any extensions,
+    apart from the number of volumes. Output files are written under a temporary name
+    and renamed into place once complete.
+
+    :param fname: Path to 4D .nii or .nii.gz image
+    :param outputs: Sequence of (output path, volume indices). Volume indices must be
+                    in ascending order. Outputs ending in .gz are gzipped
+    :param compresslevel: gzip compression level for gzipped outputs
+    """
+    hdr = read_header(fname)
+    info = parse_header(hdr)
+    with _open(fname) as f:
+        # Includes any header extensions
+        full_hdr = f.read(info.vox_offset)
+    endian, header_size = _endian(hdr)
+    shape = info.shape
+    if len(shape) < 4 or any([d != 1 for d in shape[4:]]):
+        raise ValueError(f"{fname} is not a 4D image: shape {shape}")
+    bitpix = struct.unpack_from(endian + "h", hdr, 72 if header_size == NIFTI1_HEADER_SIZE else 14)[0]
+    volume_bytes = shape[0] * shape[1] * shape[2] * bitpix // 8
+    for out_fname, volumes in outputs:
+        if list(volumes) != sorted(volumes) or (len(volumes) > 0 and not 0 <= volumes[0] <= volumes[-1] < shape[3]):
+            raise ValueError(f"Invalid volumes for {out_fname}: must be in ascending order and within the {shape[3]} volumes in {fname}")
+
+    tmps = [os.path.join(os.path.dirname(out_fname), f".{os.path.basename(out_fname)}.{os.getpid()}.tmp") for out_fname, _volumes in outputs]
+    out_files = []
+    try:
+        for tmp, (out_fname, volumes) in zip(tmps, outputs):
+            out_file = gzip.GzipFile(tmp, "wb", compresslevel=compresslevel) if out_fname.endswith(".gz") else open(tmp, "wb")
+            out_files.append(out_file)
+            out_file.write(_with_volumes(full_hdr, endian, header_size, len(volumes)))
+
+        with profiling.timer("nifti.extract_volumes"):
+            if fname.endswith(".gz"):
+                _stream_volumes(fname, info.vox_offset, volume_bytes, outputs, out_files)
+            else:
+                _mmap_volumes(fname, info.vox_offset, volume_bytes, outputs, out_files)
+        while out_files:
+            out_files.pop().close()
+        for tmp, (out_fname, _volumes) in zip(tmps, outputs):
+            os.replace(tmp, out_fname)
+    except BaseException:
+        for out_file in out_files:
+            out_file.close()
+        for tmp in tmps:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+        raise
+    profiling.count("volumes_extracted", sum([len(volumes) for _out_fname, volumes in outputs]))
+
+def _open(fname):
+    return gzip.open(fname, "rb") if fname.endswith(".gz") else open(fname, "rb")
+
+def _with_volumes(hdr, endian, header_size, nvols):
+    """
+    :return: Copy of header bytes with the number of volumes changed
+    """
+    hdr = bytearray(hdr)
+    fmt, dim_offset = ("h", 40) if header_size == NIFTI1_HEADER_SIZE else ("q", 16)
+    size = struct.calcsize(fmt)
+    struct.pack_into(endian + fmt, hdr, dim_offset + 4 * size, nvols)
+    if nvols == 1 and struct.unpack_from(endian + fmt, hdr, dim_offset)[0] == 4:
+        struct.pack_into(endian + fmt, hdr, dim_offset, 3)
+    return bytes(hdr)
+
+def _runs(volumes):
+    """
+    :return: Generator of (start, stop) ranges of consecutive volume indices
+    """
+    start = prev = None
+    for vol in volumes:
+        if start is None:
+            start = prev = vol
+        elif vol == prev + 1:
+            prev = vol
+        else:
+            yield start, prev + 1
+            start = prev = vol
+    if start is not None:
+        yield start, prev + 1
+
+def _mmap_volumes(fname, vox_offset, volume_bytes, outputs, out_files):
+    """
+    Copy volumes from an uncompressed image by slicing a memory map of it, so the
+    data is written straight from the page cache
+    """
+    with open(fname, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # Views of the map must be released before it can be closed
+        with memoryview(mm) as data:
+            for out_file, (_out_fname, volumes) in zip(out_files, outputs):
+                for start, stop in _runs(volumes):
+                    with data[vox_offset + start * volume_bytes:vox_offset + stop * volume_bytes] as chunk:
+                        if len(chunk) < (stop - start) * volume_bytes:
+                            raise ValueError(f"{fname} is truncated")
+                        out_file.write(chunk)
+                    profiling.count("extract_bytes", (stop - start) * volume_bytes)
+
+def _stream_volumes(fname, vox_offset, volume_bytes, outputs, out_files):
+    """
+    Copy volumes from a gzipped image, decompressing it once as a stream and reading
+    only as far as the last volume needed
+    """
+    destinations = {}
+    for out_file, (_out_fname, volumes) in zip(out_files, outputs):
+        for vol in volumes:
+            destinations.setdefault(vol, []).append(out_file)
+    if not destinations:
+        return
+
+    buf = bytearray(volume_bytes)
+    view = memoryview(buf)
+    with gzip.open(fname, "rb") as f:
+        f.seek(vox_offset)
+        for vol in range(max(destinations) + 1):
+            if f.readinto(view) < volume_bytes:
+                raise ValueError(f"{fname} is truncated")
+            for out_file in destinations.get(vol, ()):
+                out_file.write(view)
+                profiling.count("extract_bytes", volume_bytes)
+
+def _endian(hdr):
+    """
+    :return: Tuple of struct byte order character, header size
+    """
+    for endian in ("<", ">"):
+        header_size = struct.unpack_from(endian + "i", hdr, 0)[0]
+        if header_size in (NIFTI1_HEADER_SIZE, NIFTI2_HEADER_SIZE):
+            return endian, header_size
+    raise ValueError("Not a NIfTI-1 or NIfTI-2 header")
+
+def _quatern_affine(quatern, pixdim):
+    """
+    Get the affine from the quaternion (qform) parameters, following the NIfTI standard
+    """
+    import numpy as np
+    b, c, d, qx, qy, qz = quatern
+    a = np.sqrt(max(0.0, 1.0 - (b*b + c*c + d*d)))
+    rot = np.array([
+        [a*a + b*b - c*c - d*d, 2*b*c - 2*a*d, 2*b*d + 2*a*c],
+        [2*b*c + 2*a*d, a*a + c*c - b*b - d*d, 2*c*d - 2*a*b],
+        [2*b*d - 2*a*c, 2*c*d + 2*a*b, a*a + d*d - c*c - b*b],
+    ])
+    qfac = -1.0 if pixdim[0] < 0 else 1.0
+    affine = np.eye(4)
+    affine[:3, :3] = rot * [pixdim[1], pixdim[2], pixdim[3] * qfac]
+    affine[:3, 3] = [qx, qy, qz]
+    return affine
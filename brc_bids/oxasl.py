@@ -4,13 +4,16 @@ OXASL_BIDS: Maps BIDS data sets on to oxasl options and oxasl output back to BID
 import os.path as op
 import os
 import copy
+import hashlib
+import json
 import logging
-import shutil
+import re
+import shlex
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
-import bids
-
-from . import utils
-from .mappings import oxasl_config_from_metadata
+from . import index, nifti, profiling, sidecars, state, transfer, utils
+from .mappings import options_from_metadata
 
 LOG = logging.getLogger(__name__)
 
@@ -30,36 +33,93 @@ OXASL_OUTPUT_MAPPING = {
     # PVC outputs
 }
 
-def oxasl_config_from_bids(bids_root, common_options=None):
+# BIDS version written to the oxasl derivative dataset description
+BIDS_VERSION = "1.8.0"
+
+# Resources requested for oxasl jobs
+MINUTES = 60
+
+def get_cmds(subject, session, data_files, outdir):
+    """
+    Get the commands to run oxasl on each ASL file in a session
+
+    ASL files which cannot be interpreted are skipped with a warning
+
+    :return: List of commands, each a list of arguments
+    """
+    cmds = []
+    for idx, asl_file in enumerate(data_files.get("asl", [])):
+        try:
+            options = _get_oxasl_config(asl_file, data_files)
+        except utils.IncompatabilityError as exc:
+            LOG.warn(f"Cannot run oxasl on {asl_file.filename}: {exc}")
+            continue
+
+        suffix = f"_{idx+1}" if idx > 0 else ""
+        options["output"] = os.path.join(outdir, f"{subject}_{session}", "oxasl" + suffix)
+        # ASL data containing M0 volumes is split by the oxasl job itself, so nothing
+        # is read from the data when the job is submitted
+        options, split = _cached_split_options(options, asl_split_dir(outdir))
+        cmd = get_oxasl_command(options)
+        if split is not None:
+            cmd = get_split_command(*split) + ["--"] + cmd
+        cmds.append(cmd)
+
+    if not cmds:
+        LOG.info("No usable ASL files found - will not run perfusion pipeline")
+    return cmds
+
+def oxasl_config_from_bids(bids_root, common_options=None, index_dir=None):
     """
     Get OXASL configuration options from a BIDS data set
 
     :param bids_root: Path to root of BIDS dataset
     :param common_options: Optional dictionary of oxasl options to add to BIDS derived options
+    :param index_dir: Optional directory containing a persistent BIDS index, e.g. the
+                      output directory of a previous brc_bids run. ASL data containing
+                      M0 volumes is split into separate ASL and M0 images in this directory
 
     :return Sequence of OXASL configuration options, one for each ASL file found
             in the BIDS dataset
     """
-    configs = []
-    bids_sessions = _get_bids_sessions(bids_root)
-    for subjid, sessions in bids_sessions.items():
-        for sessid, sess_files in sessions.items():
-            for asl_file in sess_files["asl"]:
-                bids_options = _get_oxasl_config(asl_file, sess_files)
-                if common_options:
-                    bids_options = _guarded_merge(common_options, bids_options)
-                if "output" not in bids_options:
-                    output_dir = f"sub-{subjid}"
-                    if sessid:
-                        output_dir += f"sess-{sessid}"
-                    bids_options["output"] = output_dir
-
-                LOG.debug("OXASL config for file %s" % asl_file.filename)
-                LOG.debug(get_oxasl_command_line(bids_options))
-                configs.append({"options" : bids_options, "subject" : subjid, "session" : sessid})
-    return configs
-
-def oxasl_output_to_bids(oxasl_dir, bidsdir, subject, session=None, bids_output_dir=None):
+    return list(iter_oxasl_configs(bids_root, common_options, index_dir))
+
+def iter_oxasl_configs(bids_root, common_options=None, index_dir=None):
+    """
+    Generate OXASL configuration options from a BIDS data set
+
+    Sessions are read from the dataset one at a time, so the first configuration is
+    available without waiting for the whole dataset to be scanned
+
+    :param bids_root: Path to root of BIDS dataset
+    :param common_options: Optional dictionary of oxasl options to add to BIDS derived options
+    :param index_dir: Optional directory containing a persistent BIDS index
+
+    :return Generator of OXASL configuration options, one for each ASL file found
+            in the BIDS dataset
+    """
+    dataset = index.get_layout(bids_root, index_dir)
+    for sess_files in index.iter_session_files(dataset, ("asl", "m0scan", "T1w"), metadata=True):
+        subjid, sessid = sess_files.subject, sess_files.session
+        for asl_file in sess_files["asl"]:
+            bids_options = _get_oxasl_config(asl_file, sess_files)
+            if index_dir:
+                bids_options, split = _cached_split_options(bids_options, asl_split_dir(index_dir))
+                if split is not None:
+                    _cached_split(*split)
+            if common_options:
+                bids_options = _guarded_merge(common_options, bids_options)
+            if "output" not in bids_options:
+                output_dir = f"sub-{subjid}"
+                if sessid:
+                    output_dir += f"sess-{sessid}"
+                bids_options["output"] = output_dir
+
+            LOG.debug("OXASL config for file %s" % asl_file.filename)
+            LOG.debug(get_oxasl_command_line(bids_options))
+            yield {"options" : bids_options, "subject" : subjid, "session" : sessid}
+
+def oxasl_output_to_bids(oxasl_dir, bidsdir, subject, session=None, bids_output_dir=None, workers=transfer.DEFAULT_WORKERS, link=False):
     """
     Convert oxasl output to BIDS format
     
@@ -71,6 +131,31 @@ def oxasl_output_to_bids(oxasl_dir, bidsdir, subject, session=None, bids_output_
                     one session present in dataset
     :param output_dir: Destination BIDS output. If not specified, merge with source BIDS
                        data as a derivative
+    :param workers: Number of files to transfer at once
+    :param link: If True, hardlink files where possible rather than copying them
+    """
+    outputs = [{"oxasl_dir" : oxasl_dir, "subject" : subject, "session" : session}]
+    return oxasl_outputs_to_bids(outputs, bidsdir, bids_output_dir, workers, link)
+
+@profiling.timed("oxasl_output_to_bids")
+def oxasl_outputs_to_bids(outputs, bidsdir, bids_output_dir=None, workers=transfer.DEFAULT_WORKERS, link=False):
+    """
+    Convert the output of many oxasl runs to BIDS format in a single pass
+
+    The output directories are listed and the files transferred concurrently, and the
+    derivative dataset description is written once for all of them
+
+    :param outputs: Sequence of dicts with keys oxasl_dir, subject, session and optionally
+                    run, e.g. as returned by discover_outputs or read_outputs_manifest
+    :param bidsdir: Source BIDS dataset
+    :param bids_output_dir: Destination BIDS output. If not specified, merge with source BIDS
+                            data as a derivative
+    :param workers: Number of directories to list and files to transfer at once
+    :param link: If True, hardlink files where possible rather than copying them. The
+                 BIDS output then shares its data with the oxasl output, so modifying
+                 a file in one modifies it in the other
+
+    :return: Dict mapping transfer method to number of files transferred using it
     """
     if bids_output_dir:
         # We are creating a separate output dataset, so we need to start by copying
@@ -83,42 +168,131 @@ def oxasl_output_to_bids(oxasl_dir, bidsdir, subject, session=None, bids_output_
         bids_output_dir = bidsdir
         bids_output_subdir = "derivatives"
 
+    deriv_dir = os.path.join(bids_output_dir, bids_output_subdir, "oxasl")
+    os.makedirs(deriv_dir, exist_ok=True)
+    _write_dataset_description(deriv_dir)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        session_pairs = executor.map(lambda output: _output_pairs(deriv_dir, **output), outputs)
+        pairs = [pair for pairs in session_pairs for pair in pairs]
+
+    methods = transfer.LINK_METHODS if link else transfer.METHODS
+    counts = transfer.transfer_files(pairs, methods=methods, workers=workers)
+    LOG.info(f"Transferred {len(pairs)} files: " + ", ".join([f"{count} {method}" for method, count in sorted(counts.items())]))
+    return counts
+
+def discover_outputs(outdir):
+    """
+    Find the oxasl output directories created by the pipeline
+
+    These are named ``<outdir>/<subject>_<session>/oxasl`` with a numeric suffix
+    where a session has more than one ASL file, see get_cmds
+
+    :return: List of dicts with keys oxasl_dir, subject, session, run
+    """
+    outputs = []
+    with os.scandir(outdir) as it:
+        sessdirs = sorted([entry for entry in it if "_" in entry.name and entry.is_dir()], key=lambda entry: entry.name)
+    for sessdir in sessdirs:
+        subject, session = sessdir.name.split("_", 1)
+        if session == "None":
+            session = None
+        with os.scandir(sessdir.path) as it:
+            oxasl_dirs = [entry for entry in it if re.fullmatch(r"oxasl(_\d+)?", entry.name) and entry.is_dir()]
+        for oxasl_dir in sorted(oxasl_dirs, key=lambda entry: entry.name):
+            run = int(oxasl_dir.name[6:]) if oxasl_dir.name != "oxasl" else None
+            if len(oxasl_dirs) > 1 and run is None:
+                run = 1
+            outputs.append({"oxasl_dir" : oxasl_dir.path, "subject" : subject, "session" : session, "run" : run})
+    return outputs
+
+def read_outputs_manifest(fname):
+    """
+    Read a manifest of oxasl outputs to convert to BIDS
+
+    :param fname: JSON file containing a list of objects with keys oxasl_dir, subject and
+                  optionally session and run
+    :return: List of dicts with keys oxasl_dir, subject, session, run
+    """
+    with open(fname) as f:
+        manifest = json.load(f)
+    return [
+        {
+            "oxasl_dir" : output["oxasl_dir"],
+            "subject" : output["subject"],
+            "session" : output.get("session", None),
+            "run" : output.get("run", None),
+        }
+        for output in manifest
+    ]
+
+def _output_pairs(deriv_dir, oxasl_dir, subject, session=None, run=None):
+    """
+    Get the files to transfer for a single oxasl output directory
+
+    :return: List of (source path, destination path)
+    """
     # FIXME, check that subject exists in bidsdir and session too (or if no session that
     # source dataset only has single session for this subject)
-    base_dir = os.path.join(bids_output_dir, bids_output_subdir, "oxasl", "sub-%s" % subject)
+    base_dir = os.path.join(deriv_dir, "sub-%s" % subject)
     if session:
         base_dir = os.path.join(base_dir, "ses-%s" % session)
     os.makedirs(base_dir, exist_ok=True)
 
+    pairs = []
     for space in ("native", "std", "struct"):
         srcdir = os.path.join(oxasl_dir, f"{space}_space")
         LOG.info(f"Looking for {space} space output")
-        if not os.path.isdir(srcdir): continue
+        images = transfer.list_images(srcdir)
+        if not images: continue
+        labels = {"space" : space} if run is None else {"run" : run, "space" : space}
         for src, dest in OXASL_OUTPUT_MAPPING.items():
-            srcpath, ext = utils.find_img(os.path.join(srcdir, src))
-            if srcpath:
-                destpath =  os.path.join(base_dir, utils.bids_filename(dest + ext, subject, session, {"space" : space}))
+            if src in images:
+                srcpath, ext = images[src]
+                destpath =  os.path.join(base_dir, utils.bids_filename(dest + ext, subject, session, labels))
                 LOG.info(f"Copying {srcpath} to {destpath}")
-                shutil.copy(srcpath, destpath)
+                pairs.append((srcpath, destpath))
             else:
                 LOG.warn("Oxasl output file not found: %s" % src)
+    return pairs
 
-def get_output_as_bids_command(args, config):
+def _write_dataset_description(deriv_dir):
     """
-    Get the command to convert the output of oxasl to a BIDS data set
+    Write the dataset description for the oxasl derivative dataset unless it already exists
+    """
+    fname = os.path.join(deriv_dir, "dataset_description.json")
+    if os.path.exists(fname):
+        return
+    description = {
+        "Name" : "oxasl",
+        "BIDSVersion" : BIDS_VERSION,
+        "DatasetType" : "derivative",
+        "GeneratedBy" : [{"Name" : "oxasl"}],
+    }
+    with open(fname, "w") as f:
+        json.dump(description, f, indent=2)
+
+def get_output_as_bids_command(args, configs):
+    """
+    Get a single command to convert the output of many oxasl runs to a BIDS data set
+
+    The outputs are listed in a manifest file written to the output directory
 
     :param args: Command line arguments
-    :param config: oxasl session config
-    """
-    options = config["options"]
-    cmdline = f"oxasl_bids bidsout --bidsdir {os.path.abspath(args.bidsdir)} --oxasl-output {options['output']} --subject {config['subject']}"
-    if config['session']:
-        cmdline += f" --session {config['session']}"
-    if args.bids_output:
-        cmdline += f" --bids-output {os.path.abspath(args.bids_output)}"
-    if args.merge_source:
-        cmdline += f" --merge-source"
-    return cmdline
+    :param configs: Sequence of oxasl session configs
+    """
+    outputs = [
+        {"oxasl_dir" : os.path.abspath(config["options"]["output"]), "subject" : config["subject"], "session" : config["session"]}
+        for config in configs
+    ]
+    manifest = os.path.join(utils.work_dir(args.output, "bidsout"), "oxasl_outputs.json")
+    with open(manifest, "w") as f:
+        json.dump(outputs, f, indent=2)
+
+    cmd = ["brc_bids", "bidsout", "--bidsdir", os.path.abspath(args.bidsdir), "--manifest", os.path.abspath(manifest)]
+    if getattr(args, "bids_output", None):
+        cmd += ["--bids-output", os.path.abspath(args.bids_output)]
+    return shlex.join(cmd)
 
 def get_fslanat_command(options):
     """
@@ -134,13 +308,14 @@ def get_fslanat_command(options):
     options["fslanat"] = struct_name + ".anat"
     return f"fsl_anat -i {struct_data} -o {options['fslanat']}\n"
 
-def get_oxasl_command_line(options, extra_args=[]):
+def get_oxasl_command(options, extra_args=()):
     """
     :param options: Dictionary of options derived from BIDS
+    :param extra_args: Additional arguments to append
 
-    :return: Command string to run oxasl
+    :return: Command to run oxasl as a list of arguments
     """
-    txt = 'oxasl '
+    cmd = ['oxasl']
     for key,val in options.items():
         if key == "asl":
             key = "-i"
@@ -155,22 +330,36 @@ def get_oxasl_command_line(options, extra_args=[]):
         else:
             key = "--" + key
 
-        if isinstance(val, list):
-            if all([isinstance(v, int) for v in val]):
-                val = ",".join(["%i" % v for v in val])
-            else:
-                val = ",".join(["%.3g" % v for v in val])
+        if isinstance(val, (list, tuple)) or hasattr(val, "dtype"):
+            val = _format_list(val)
         elif isinstance(val, float):
             val = "%.4g" % val
 
         if isinstance(val, bool):
             if val: 
-                txt += f"{key} "
+                cmd.append(key)
         elif val is not None:
-            txt += f"{key} {val} "
+            cmd.extend([key, str(val)])
+
+    return cmd + list(extra_args)
 
-    txt += " ".join(extra_args)
-    return txt 
+def get_oxasl_command_line(options, extra_args=()):
+    """
+    :param options: Dictionary of options derived from BIDS
+
+    :return: Command string to run oxasl, quoted for the shell
+    """
+    return shlex.join(get_oxasl_command(options, extra_args))
+
+def _format_list(val):
+    """
+    Format a list or array of numbers as a comma separated option value
+    """
+    import numpy as np
+    arr = np.asarray(val)
+    if np.issubdtype(arr.dtype, np.integer):
+        return ",".join(["%i" % v for v in arr.ravel()])
+    return ",".join(["%.3g" % v for v in arr.ravel()])
 
 def _guarded_merge(common, specific):
     """
@@ -196,13 +385,140 @@ def _guarded_merge(common, specific):
 
     return merged
 
+def asl_split_dir(outdir):
+    """
+    :return: Directory where ASL data containing M0 volumes is split into separate images.
+             This is a cache shared by all sessions, see _split_cache_dir
+    """
+    return os.path.join(outdir, utils.WORK_DIRNAME, state.SPLIT_DIRNAME)
+
+def _cached_split_options(options, cache_dir):
+    """
+    Rewrite oxasl options to use separate ASL and M0 images split into the cache
+
+    :return: Tuple of options and split arguments, see _split_options
+    """
+    if "calib_volumes" not in options:
+        return options, None
+    return _split_options(options, _split_cache_dir(options, cache_dir))
+
+def _split_options(options, split_dir):
+    """
+    Rewrite oxasl options which select the ASL and M0 volumes from the same file so they
+    use separate ASL and M0 images split from it instead
+
+    Only the options are changed, the data is not read. The split images are named
+    asl and m0scan in the split directory
+
+    :param options: oxasl options as returned by _get_oxasl_config
+    :param split_dir: Directory to split the data into
+
+    :return: Tuple of options and (source path, ASL volumes, M0 volumes, ASL image path,
+             M0 image path) to pass to split_asl_calib, or None if no split is needed
+    """
+    if "calib_volumes" not in options or options.get("calib", None) != options["asl"]:
+        return options, None
+
+    asl_path = options["asl"]
+    asl_volumes = [int(vol) for vol in options["asl_volumes"]]
+    calib_volumes = sorted([int(vol) for vol in options["calib_volumes"]])
+    split_asl = sorted(asl_volumes)
+    ext = ".nii.gz" if asl_path.endswith(".gz") else ".nii"
+    split_dir = os.path.abspath(split_dir)
+    asl_out, calib_out = os.path.join(split_dir, "asl" + ext), os.path.join(split_dir, "m0scan" + ext)
+
+    options = dict(options)
+    options["asl"], options["calib"] = asl_out, calib_out
+    options.pop("asl_volumes")
+    options.pop("calib_volumes")
+    # The split ASL image has the volumes in their original order, so any reordering
+    # (e.g. of blocked label/control images into pairs) still needs to be applied
+    position = {vol : idx for idx, vol in enumerate(split_asl)}
+    order = [position[vol] for vol in asl_volumes]
+    if order != list(range(len(order))):
+        options["asl_volumes"] = order
+    return options, (asl_path, split_asl, calib_volumes, asl_out, calib_out)
+
+def get_split_command(asl_path, asl_volumes, calib_volumes, asl_out, calib_out):
+    """
+    Get the command which splits ASL data containing M0 volumes before running a command
+
+    The command given after ``--`` is appended, see run_split
+
+    :return: Command as a list of arguments
+    """
+    return [
+        "brc_bids", "aslsplit", "--input", asl_path,
+        "--asl", asl_out, "--asl-volumes", _format_list(asl_volumes),
+        "--calib", calib_out, "--calib-volumes", _format_list(calib_volumes),
+    ]
+
+def split_asl_calib(asl_path, asl_volumes, calib_volumes, asl_out, calib_out):
+    """
+    Split ASL data containing M0 volumes into separate ASL and M0 images
+
+    :param asl_path: Path to ASL data
+    :param asl_volumes: Indices of ASL volumes in ascending order
+    :param calib_volumes: Indices of M0 volumes in ascending order
+    :param asl_out: Path to write ASL image to
+    :param calib_out: Path to write M0 image to
+    """
+    LOG.info(f"Splitting ASL and M0 volumes of {asl_path} into {os.path.dirname(asl_out)}")
+    for path in (asl_out, calib_out):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with profiling.timer("aslsplit"):
+        nifti.extract_volumes(asl_path, [(asl_out, asl_volumes), (calib_out, calib_volumes)])
+
+def run_split(cmd, asl_path, asl_volumes, calib_volumes, asl_out, calib_out):
+    """
+    Split ASL data containing M0 volumes unless it is already in the cache, then run a
+    command which uses the split images
+
+    :param cmd: Command as a sequence of arguments
+
+    :return: Exit status of command
+    """
+    _cached_split(asl_path, asl_volumes, calib_volumes, asl_out, calib_out)
+    LOG.info(" ".join(cmd))
+    return subprocess.call(cmd)
+
+def _split_cache_dir(options, cache_dir):
+    """
+    Get the cache directory for the split of ASL data containing M0 volumes
+
+    This is named by a hash of the input file identity (path, mtime and size) and the
+    volumes selected, so generating the same configuration again reuses the split
+    images. The file identity is used rather than its content so that the key can be
+    worked out on the submit host without reading the data. It changes whenever the
+    data is rewritten, in the same way as the input fingerprints in the state module
+
+    :param options: oxasl options as returned by _get_oxasl_config
+    """
+    stat = os.stat(options["asl"])
+    volumes = [[int(vol) for vol in options.get(name, [])] for name in ("asl_volumes", "calib_volumes")]
+    identity = json.dumps([options["asl"], stat.st_mtime_ns, stat.st_size] + volumes)
+    return os.path.join(os.path.abspath(cache_dir), hashlib.sha1(identity.encode("UTF-8")).hexdigest()[:16])
+
+def _cached_split(asl_path, asl_volumes, calib_volumes, asl_out, calib_out):
+    """
+    Split ASL data containing M0 volumes unless the split images already exist
+    """
+    if os.path.exists(asl_out) and os.path.exists(calib_out):
+        LOG.debug(f"Using cached split of {asl_path} in {os.path.dirname(asl_out)}")
+        profiling.count("aslsplit_cached")
+    else:
+        split_asl_calib(asl_path, asl_volumes, calib_volumes, asl_out, calib_out)
+
 def _get_asl_config(asl_file):
     """
     Extract relevant oxasl configuration from a BIDSImageFile containing ASL data
+
+    If the ASL data contains M0 volumes, oxasl is given the same file for both with the
+    volumes to use from it, see _split_options
     """
     options = {"asl" : op.abspath(asl_file.path)}
-    options.update(oxasl_config_from_metadata(asl_file.get_metadata(), "asl"))
-    metadata = asl_file.get_metadata()
+    metadata = sidecars.get_metadata(asl_file)
+    options.update(options_from_metadata(metadata, "asl"))
 
     # Get the ASL context and interpret it. This is what tells us the ordering of
     # label/control image, or if the data is already differenced
@@ -218,50 +534,24 @@ def _get_asl_config(asl_file):
     if not os.path.isfile(ctx_filename):
         raise utils.IncompatabilityError("ASL context file not found")
 
-    with open(ctx_filename) as f:
-        ctx = [l.lower().strip() for l in f.readlines() if l.strip()]
-    if ctx[0] != 'volume_type':
-        raise utils.IncompatabilityError("First line in ASL context is not volume_type")
-    ctx = ctx[1:]
-    if 'cbf' in ctx:
-        raise utils.IncompatabilityError("ASL context contains CBF images")
-    if 'deltam' in ctx and ('label' in ctx or 'control' in ctx):
-        raise utils.IncompatabilityError("ASL sequence is mixed deltam and control/label")
-
-    keys = {'control' : 0,
-            'control(perev)': 0,
-            'label': 1,
-            'deltam': 2,
-            'm0scan': 3}
-
-    frame_codes = [ keys[frame] for frame in ctx ]
-    asl_frames = [ i for i,code in enumerate(frame_codes) if code < 3 ]
-    calib_frames = [ i for i,code in enumerate(frame_codes) if code == 3 ]
-    asl_frame_codes = [frame_codes[i] for i in asl_frames]
-    if not asl_frames:
-        raise utils.IncompatabilityError("No ASL data (label/control or deltam found in ASL data file")
-    elif len(asl_frames) == 1 and frame_codes[asl_frames[0]] != 2:
-        raise utils.IncompatabilityError("Only one ASL volume found in ASL data file and it was not a deltam image")
-
-    if asl_frame_codes[0] == 2:
-        options["iaf"] = 'diff'
-    else:
-        label_idxs = [idx for idx, frame_type in enumerate(asl_frame_codes) if frame_type == 1]
-        control_idxs = [idx for idx, frame_type in enumerate(asl_frame_codes) if frame_type == 2]
-        if all([idx % 2 == 0 for idx in label_idxs]) and all([idx % 2 == 1 for idx in control_idxs]):
-            options["iaf"] = 'tc'
-        elif all([idx % 2 == 1 for idx in label_idxs]) and all([idx % 2 == 0 for idx in control_idxs]):
-            options["iaf"] = 'ct'
-        else:
-            # FIXME detect other kinds of ordering, e.g. TTTTTCCCCC etc
-            raise utils.IncompatabilityError("Could not interpret label-control order in aslcontext.tsv")
-
-        # With TC or CT pairs the timings will be repeated. We don't care about the order since
-        # no valid ASL sequence will have different timings for tag and control.
-        ttype = 'plds' if options.get('casl', False) else "tis"
-        options[ttype] = [options[ttype][idx] for idx in range(0, len(options[ttype]), 2)]
+    # numpy is only needed here so is not imported with the rest of the module
+    from . import aslcontext
+    ttype = 'plds' if options.get('casl', False) else "tis"
+    ctx = aslcontext.interpret(aslcontext.read(ctx_filename), options.get(ttype, None))
+    options["iaf"] = ctx.iaf
+    if ctx.timings is not None:
+        options[ttype] = ctx.timings
+    if ctx.ibf is not None:
+        options["ibf"] = ctx.ibf
+    if ctx.rpts is not None:
+        options["rpts"] = ctx.rpts
+
+    calib_frames, asl_frames = ctx.calib_volumes, ctx.asl_volumes
+    if ctx.order not in ("tc", "ct", "diff"):
+        LOG.info(f"Label/control images in {asl_file.filename} are in {ctx.order} order - reordering as label-control pairs")
+        options["asl_volumes"] = asl_frames
 
-    if calib_frames:
+    if len(calib_frames) > 0:
         # We have m0scan volumes in the ASL context - this suggests M0 is included in
         # ASL data, so check this and determine volume index. Calibration image options
         # (e.g. TR, TE) are then to be derived from this image
@@ -271,7 +561,7 @@ def _get_asl_config(asl_file):
         options["calib"] = op.abspath(asl_file.path)
         options["calib_volumes"] = calib_frames
         options["asl_volumes"] = asl_frames
-        options.update(oxasl_config_from_metadata(asl_file.get_metadata(), "calib"))
+        options.update(options_from_metadata(metadata, "calib"))
     else: 
         # No sign of m0scan volumes in ASL context - check M0 type is separate
         # and look for it in associated files
@@ -281,7 +571,7 @@ def _get_asl_config(asl_file):
             if bids_file.entities["suffix"] == "m0scan":
                 LOG.debug(f"Found M0 in separate file referenced from ASL data: {bids_file.filename}")
                 options["calib"] = op.abspath(bids_file.path)
-                options.update(oxasl_config_from_metadata(bids_file.get_metadata(), "calib"))
+                options.update(options_from_metadata(sidecars.get_metadata(bids_file), "calib"))
     return options
 
 def _get_struct_config(struct_file):
@@ -297,7 +587,8 @@ def _get_calib_config(m0_file):
     ret = {}
     if m0_file.entities.get("datatype", None) != "fmap":
         ret["calib"] = op.abspath(m0_file.path)
-        ret.update(oxasl_config_from_metadata(m0_file.get_metadata(), "calib", img_shape=m0_file.get_image().shape))
+        ret.update(options_from_metadata(sidecars.get_metadata(m0_file), "calib", img_shape=nifti.probe(m0_file.path).shape))
+    return ret
 
 def _get_cblip_config(m0_file):
     """
@@ -307,7 +598,7 @@ def _get_cblip_config(m0_file):
     ret = {}
     if m0_file.entities.get("datatype", None) == "fmap":
         ret["cblip"] = op.abspath(m0_file.path)
-        ret.update(oxasl_config_from_metadata(m0_file.get_metadata(), "cblip", img_shape=m0_file.get_image().shape))
+        ret.update(options_from_metadata(sidecars.get_metadata(m0_file), "cblip", img_shape=nifti.probe(m0_file.path).shape))
 
     return ret
 
@@ -342,34 +633,5 @@ def _get_oxasl_config(asl_file, sess_files):
     # Need to fix PLDs a bit 
     return options
 
-def _get_bids_sessions(bids_root):
-    """
-    Get structure describing all sessions found in a BIDS dataset
-
-    :param bids_root: Path to root of BIDS dataset
-
-    :return dict mapping subjects to a group of sessions. The session group is a dict mapping
-            session ID to session dict. Each session is a dict mapping file suffixes asl, m0scan, 
-            and T1w to lists of corresponding BIDSImageFile instances
-    """
-    dataset = bids.BIDSLayout(bids_root)
-    data_files = {}
-    for subj in dataset.get_subjects():
-        data_files[subj] = {}
-        sessions = dataset.get_sessions(subject=subj)
-        if not sessions:
-            sessions = [None]
-        for sess in sessions:
-            LOG.info("Getting ASL data for subject %s in session %s" % (subj, sess))
-            data_files[subj][sess] = {}
-            for suffix in ("asl", "m0scan", "T1w"):
-                data_files[subj][sess][suffix] = []
-                for fobj in dataset.get(subject=subj, session=sess, suffix=suffix):
-                    if isinstance(fobj, bids.layout.models.BIDSImageFile):
-                        LOG.debug("Found %s image: %s %s" % (suffix.upper(), fobj.filename, fobj.entities["suffix"]))
-                        data_files[subj][sess][suffix].append(fobj)
-
-    return data_files
-
 def _copy_bids_dataset(bidsdir, output_dir, subject=None, session=None):
     raise NotImplementedError()
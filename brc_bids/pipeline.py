@@ -0,0 +1,363 @@
+"""
+BRC_BIDS: Dependency graph of pipeline stages
+
+Each stage declares the stages it needs. Session stages are submitted for every
+session, depending only on the jobs of the stages they need in the same session, so
+sessions and subjects are never serialized behind each other. Cohort stages run once
+for the whole dataset, after the jobs they need have finished in every session.
+"""
+import asyncio
+import concurrent.futures
+import logging
+
+from . import batch, dwi, idps, ledger, mriqc, oxasl, staging, state, status, struc, utils
+
+LOG = logging.getLogger(__name__)
+
+class Stage:
+    """
+    A pipeline stage
+
+    Session stages get their commands as ``get_cmds(subject, session, data_files, outdir)``,
+    cohort stages as ``get_cmds(args, subjdirs)``. Either returns a list of commands, which
+    may be empty if there is nothing to do
+
+    Stages with ``scratch=True`` only write to their session output directory, so they
+    can be run on node-local scratch when ``--local-scratch`` is given
+    """
+    def __init__(self, name, get_cmds, needs=(), cohort=False, minutes=5, ram=None, scratch=False):
+        self.name = name
+        self.get_cmds = get_cmds
+        self.needs = tuple(needs)
+        self.cohort = cohort
+        self.minutes = minutes
+        self.ram = ram
+        self.scratch = scratch
+
+    def __repr__(self):
+        return f"<Stage {self.name} needs={self.needs}>"
+
+def _idpmerge_cmds(args, subjdirs):
+    return idps.get_merge_cmds(subjdirs, args.output)
+
+def _mriqc_group_cmds(args, subjdirs):
+    # MRIQC is a BIDS application independent of the rest of the BRC pipeline
+    return mriqc.get_group_cmds(args.bidsdir, args.output)
+
+STAGES = [
+    Stage("struc", struc.get_cmds, scratch=True),
+    Stage("dwi", dwi.get_cmds, needs=["struc"], scratch=True),
+    Stage("perf", oxasl.get_cmds, minutes=oxasl.MINUTES, scratch=True),
+    Stage("idps", idps.get_cmds, needs=["struc", "dwi"]),
+    Stage("idpmerge", _idpmerge_cmds, needs=["idps"], cohort=True),
+    Stage("mriqc", mriqc.get_cmds, minutes=mriqc.MINUTES, ram=mriqc.RAM),
+    Stage("mriqcgroup", _mriqc_group_cmds, needs=["mriqc"], cohort=True, minutes=mriqc.GROUP_MINUTES, ram=mriqc.GROUP_RAM),
+]
+
+DEFAULT_STAGES = ["struc", "dwi", "perf", "idps", "idpmerge"]
+
+def get_stages(names):
+    """
+    Get the stages to run, in dependency order
+
+    Stages needed by the selected stages but not selected themselves are not run
+    and are assumed to have completed already
+
+    :param names: Sequence of stage names
+    :return: List of Stage
+    """
+    known = [stage.name for stage in STAGES]
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        raise ValueError(f"Unknown pipeline stage(s): {unknown} - must be one of {known}")
+    return [stage for stage in STAGES if stage.name in names]
+
+class Submission:
+    """
+    Records the stages submitted by a pipeline run
+
+    Stages submitted for a session are written to the pipeline state and the job ledger
+    when the session is finished, and then forgotten, so memory use does not grow with
+    the number of sessions. Stages submitted as array tasks can only be written once
+    their arrays have been submitted, see flush
+    """
+    def __init__(self, args):
+        self.args = args
+        self.run_id = ledger.new_run_id()
+        # Names of stages submitted for any session
+        self.stage_names = set()
+        # Session key -> list of (stage name, commands, jobs) not yet written
+        self._sessions = {}
+        self._deferred = []
+
+    def add(self, key, stage_name, cmds, jobs):
+        """
+        Add the commands and jobs submitted for a stage
+        """
+        self.stage_names.add(stage_name)
+        self._sessions.setdefault(key, []).append((stage_name, cmds, jobs))
+
+    def is_submitted(self, key, stage_name):
+        """
+        :return: True if a stage has been submitted for a session which is not yet finished
+        """
+        return any(name == stage_name for name, _cmds, _jobs in self._sessions.get(key, []))
+
+    def finish_session(self, key, defer=False):
+        """
+        Write the stages submitted for a session
+
+        :param defer: If True, the jobs are array tasks which have not been submitted yet,
+                      so they are only written by flush
+        """
+        stages = self._sessions.pop(key, [])
+        if defer:
+            self._deferred.extend([(key, ) + stage for stage in stages])
+        else:
+            self._write([(key, ) + stage for stage in stages])
+
+    def flush(self):
+        """
+        Write everything not yet written, e.g. once array jobs have been submitted or
+        when submission has failed
+        """
+        stages = self._deferred + [(key, ) + stage for key, stages in self._sessions.items() for stage in stages]
+        self._deferred, self._sessions = [], {}
+        self._write(stages)
+
+    def _write(self, stages):
+        entries = []
+        for key, stage_name, cmds, jobs in stages:
+            labels = [_job_label(job) for job in jobs]
+            state.record_jobs(self.args.output, key, stage_name, labels)
+            markers = [state.marker_path(self.args.output, key, stage_name, idx) for idx in range(len(cmds))]
+            entries.extend(ledger.entries(self.run_id, key, stage_name, cmds, labels, markers, bool(self.args.cluster)))
+        ledger.append(self.args.output, entries)
+
+def run(args, session_files, stages):
+    """
+    Submit the pipeline for all sessions in a dataset
+
+    Sessions are submitted as they are generated, so submission starts while the rest
+    of the dataset is still being discovered. Cohort stages are submitted once all
+    sessions have been seen.
+
+    In incremental mode, stages which are up to date are not resubmitted - see the state module.
+    Stages whose jobs from an earlier run are still queued or running are not resubmitted
+    either, so two jobs never write to the same output at once. Stages which need them
+    hold on the existing jobs instead.
+
+    Each session is recorded in the pipeline state and the job ledger as soon as its
+    stages have been submitted, so ``brc_bids status`` can follow a long submission and
+    nothing already submitted is lost if it fails part way
+
+    :param args: Command line arguments
+    :param session_files: Iterable of records.SessionFiles, e.g. as generated by
+                          brc.iter_image_files
+    :param stages: Sequence of Stage in dependency order
+
+    :return: Dict mapping (subject, session) to dict of stage name to job(s). The job
+             is None for stages which were not submitted
+    """
+    session_jobs, submission = {}, Submission(args)
+    pending = {}
+    if getattr(args, "incremental", False):
+        pending = status.pending_jobs(args.output)
+        if pending:
+            LOG.info(f"{len(pending)} stages from earlier runs are still queued or running")
+    try:
+        _run(args, session_files, stages, session_jobs, submission, pending)
+    finally:
+        submission.flush()
+    return session_jobs
+
+def _run(args, session_files, stages, session_jobs, submission, pending):
+    """
+    Submit session stages followed by cohort stages, filling in session_jobs
+
+    :param pending: Dict mapping (key, stage name) to IDs of jobs still queued or running
+                    from earlier runs
+    """
+    session_stages = [stage for stage in stages if not stage.cohort]
+    if args.cluster and not args.array and getattr(args, "submit_concurrency", 1) > 1:
+        # Submit sessions concurrently - stages within a session are still submitted in order
+        # so that each has the job IDs of the stages it needs
+        asyncio.run(_submit_sessions_async(args, session_files, session_stages, session_jobs, submission, pending))
+    else:
+        # In array mode, commands for each stage are collected and submitted as a single array
+        # job once all sessions have been seen
+        stage_batches = {
+            stage.name : batch.TaskArray(stage.name, args.output) if args.array else None
+            for stage in session_stages
+        }
+        for data_files in session_files:
+            key, jobs = _session_key(data_files, session_jobs)
+            try:
+                for stage in session_stages:
+                    cmds = stage.get_cmds(data_files.subject, data_files.session, data_files, args.output)
+                    rerun_needed = _rerun_needed(key, stage, submission, pending)
+                    dep_job = _deps([jobs.get(need, None) for need in stage.needs])
+                    jobs[stage.name] = _submit(args, stage, key, cmds, dep_job, stage_batches[stage.name], rerun_needed, submission, pending)
+            finally:
+                submission.finish_session(key, defer=args.array)
+        for stage in session_stages:
+            if stage_batches[stage.name] is not None:
+                stage_batches[stage.name].submit(args.cluster)
+
+    subjdirs = [f"{subject}_{session}" for subject, session in session_jobs]
+    for stage in stages:
+        if not stage.cohort:
+            continue
+        cmds = stage.get_cmds(args, subjdirs)
+        needed_jobs = [jobs.get(need, None) for jobs in session_jobs.values() for need in stage.needs]
+        rerun_needed = any(need in submission.stage_names for need in stage.needs) or \
+                       any(stage_name in stage.needs for _key, stage_name in pending)
+        try:
+            _submit(args, stage, "cohort", cmds, _deps(needed_jobs), None, rerun_needed, submission, pending, extra=subjdirs)
+        finally:
+            submission.finish_session("cohort")
+
+def _rerun_needed(key, stage, submission, pending):
+    """
+    :return: True if a stage needed by a session stage has been submitted in this run
+             or is still running from an earlier run
+    """
+    return any(submission.is_submitted(key, need) or (key, need) in pending for need in stage.needs)
+
+def _session_key(data_files, session_jobs):
+    """
+    Register a session in the job record
+
+    :return: Tuple of session key for the pipeline state, dict of stage name to jobs for the session
+    """
+    subject, session = data_files.subject, data_files.session
+    return f"{subject}_{session}", session_jobs.setdefault((subject, session), {})
+
+def _prepare(args, stage, key, cmds, rerun_needed, pending, extra=None):
+    """
+    Check whether a stage needs to be submitted and if so record it in the pipeline state
+
+    :return: Commands to submit, or None if the stage does not need to be submitted
+    """
+    if not cmds:
+        return None
+    if (key, stage.name) in pending:
+        LOG.warn(f"{stage.name} for {key} is still queued or running as job(s) {', '.join(pending[(key, stage.name)])} - not resubmitting")
+        return None
+    if getattr(args, "incremental", False) and not rerun_needed and state.is_up_to_date(args.output, key, stage.name, cmds, extra):
+        LOG.info(f"{stage.name} for {key} is up to date")
+        return None
+
+    LOG.info(f"Submitting {stage.name} for {key}")
+    run_cmds = None
+    if stage.scratch and getattr(args, "local_scratch", False):
+        run_cmds = [staging.wrap_cmd(cmd, args.output, key, stage.name, stage.needs, args.scratch_dir) for cmd in cmds]
+    return state.prepare(args.output, key, stage.name, cmds, extra, run_cmds)
+
+def _submit(args, stage, key, cmds, dep_job, stage_batch, rerun_needed, submission, pending, extra=None):
+    """
+    Submit the commands for a stage unless it is up to date or still running
+
+    :return: Submitted job(s), IDs of the jobs still running from an earlier run, or None
+    """
+    wrapped_cmds = _prepare(args, stage, key, cmds, rerun_needed, pending, extra)
+    if wrapped_cmds is None:
+        return pending.get((key, stage.name), None)
+
+    jobs = [
+        utils.submit_cmd(cmd, args.cluster, dep_job, minutes=stage.minutes, ram=stage.ram, batch=stage_batch)
+        for cmd in wrapped_cmds
+    ]
+    submission.add(key, stage.name, cmds, jobs)
+    return _deps(jobs)
+
+async def _submit_sessions_async(args, session_files, stages, session_jobs, submission, pending):
+    """
+    Submit session stages to the cluster, with different sessions submitted concurrently
+
+    Sessions are taken from the generator only when there is capacity to submit them,
+    so discovery never runs far ahead of submission. Discovery, building the commands
+    and recording the submission block on the filesystem, so they are run in a single
+    worker thread while the event loop waits on fsl_sub
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(args.submit_concurrency)
+    in_flight = asyncio.Semaphore(2 * args.submit_concurrency)
+    tasks, errors = set(), []
+    session_files = iter(session_files)
+
+    def prepare_stage(stage, key, data_files):
+        cmds = stage.get_cmds(data_files.subject, data_files.session, data_files, args.output)
+        rerun_needed = _rerun_needed(key, stage, submission, pending)
+        return cmds, _prepare(args, stage, key, cmds, rerun_needed, pending)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        async def blocking(func, *func_args):
+            return await loop.run_in_executor(executor, func, *func_args)
+
+        async def submit_session(data_files):
+            key, jobs = _session_key(data_files, session_jobs)
+            try:
+                for stage in stages:
+                    cmds, wrapped_cmds = await blocking(prepare_stage, stage, key, data_files)
+                    if wrapped_cmds is None:
+                        jobs[stage.name] = pending.get((key, stage.name), None)
+                        continue
+
+                    dep_job = _deps([jobs.get(need, None) for need in stage.needs])
+                    stage_jobs = await asyncio.gather(*[
+                        utils.submit_cmd_async(cmd, dep_job, minutes=stage.minutes, ram=stage.ram, semaphore=semaphore)
+                        for cmd in wrapped_cmds
+                    ])
+                    await blocking(submission.add, key, stage.name, cmds, list(stage_jobs))
+                    jobs[stage.name] = _deps(stage_jobs)
+            finally:
+                await blocking(submission.finish_session, key)
+                in_flight.release()
+
+        def session_done(task):
+            tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                errors.append(task.exception())
+
+        while True:
+            await in_flight.acquire()
+            if errors:
+                break
+            data_files = await blocking(next, session_files, None)
+            if data_files is None:
+                break
+            task = asyncio.create_task(submit_session(data_files))
+            tasks.add(task)
+            task.add_done_callback(session_done)
+
+        if tasks:
+            await asyncio.wait(set(tasks))
+    if errors:
+        raise errors[0]
+
+def _job_label(job):
+    """
+    :return: ID of a submitted job as a string, including the task ID for array tasks.
+             None if the job was never submitted, e.g. a task in an array which was not
+             submitted because submission failed
+    """
+    array = getattr(job, "array", None)
+    if array is not None and not array.submitted:
+        return None
+    task_id = getattr(job, "task_id", None)
+    if task_id is not None and getattr(job, "local_job_id", None) is None:
+        return f"{job.job_id}.{task_id}"
+    ids = utils.dep_job_ids(job)
+    return ids[0] if ids else None
+
+def _deps(jobs):
+    """
+    :return: Dependency specification for submit_cmd from a list of jobs, any of which may be None
+    """
+    jobs = [job for job in jobs if job is not None and job != []]
+    if not jobs:
+        return None
+    elif len(jobs) == 1:
+        return jobs[0]
+    return jobs
@@ -0,0 +1,153 @@
+"""
+BRC_BIDS: Timing and counting instrumentation
+
+Sections of code are timed using the ``timer`` context manager or ``timed`` decorator,
+and quantities such as files, bytes and subprocess calls are recorded using ``count``.
+Nothing is recorded unless profiling has been enabled (e.g. using ``--profile``), so
+the instrumentation costs a single flag check when disabled.
+
+The report is written as JSON in the Chrome trace event format, so it can be loaded
+into chrome://tracing or Perfetto, with a summary of total times and counters alongside
+the trace events.
+"""
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+_ENABLED = False
+
+_LOCK = threading.Lock()
+
+# Completed timed sections as Chrome trace 'complete' events
+_EVENTS = []
+
+# Counter name -> total
+_COUNTERS = {}
+
+# Time origin for trace events
+_START = time.perf_counter()
+
+def enable():
+    """
+    Start recording timings and counters
+    """
+    global _ENABLED
+    _ENABLED = True
+
+def disable():
+    """
+    Stop recording timings and counters. Anything already recorded is kept
+    """
+    global _ENABLED
+    _ENABLED = False
+
+def is_enabled():
+    return _ENABLED
+
+def reset():
+    """
+    Discard all recorded timings and counters
+    """
+    global _START
+    with _LOCK:
+        _EVENTS.clear()
+        _COUNTERS.clear()
+        _START = time.perf_counter()
+
+@contextlib.contextmanager
+def _timer(name, category, args):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        event = {
+            "name" : name,
+            "cat" : category,
+            "ph" : "X",
+            "ts" : (start - _START) * 1e6,
+            "dur" : (end - start) * 1e6,
+            "pid" : os.getpid(),
+            "tid" : threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+        with _LOCK:
+            _EVENTS.append(event)
+
+def timer(name, category="brc_bids", **args):
+    """
+    Context manager which records the time taken by a section of code
+
+    :param name: Name of section, e.g. 'layout'
+    :param category: Category shown in the trace viewer
+    :param args: Optional JSON-serializable values to attach to the trace event
+    """
+    if not _ENABLED:
+        return contextlib.nullcontext()
+    return _timer(name, category, args)
+
+def timed(name=None, category="brc_bids"):
+    """
+    Decorator which records the time taken by each call to a function
+
+    :param name: Name of section. Defaults to the qualified name of the function
+    """
+    def decorator(func):
+        section = name or f"{func.__module__.split('.')[-1]}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _ENABLED:
+                return func(*args, **kwargs)
+            with _timer(section, category, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, value=1):
+    """
+    Add to a counter, e.g. number of files or bytes read
+    """
+    if not _ENABLED:
+        return
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+
+def summary():
+    """
+    :return: Dict with 'sections' mapping section name to dict of calls, total and
+             maximum time in seconds, and 'counters' mapping counter name to total
+    """
+    sections = {}
+    with _LOCK:
+        for event in _EVENTS:
+            section = sections.setdefault(event["name"], {"calls" : 0, "total" : 0.0, "max" : 0.0})
+            section["calls"] += 1
+            section["total"] += event["dur"] / 1e6
+            section["max"] = max(section["max"], event["dur"] / 1e6)
+        counters = dict(_COUNTERS)
+    return {"sections" : sections, "counters" : counters}
+
+def write_report(fname):
+    """
+    Write recorded timings and counters as a Chrome trace JSON file with a summary
+    """
+    report = summary()
+    with _LOCK:
+        report["traceEvents"] = list(_EVENTS)
+    report["displayTimeUnit"] = "ms"
+    with open(fname, "w") as f:
+        json.dump(report, f, indent=1)
+
+    LOG.info(f"Profile written to {fname}")
+    for name, section in sorted(report["sections"].items(), key=lambda item: -item[1]["total"]):
+        LOG.info(f"{name}: {section['calls']} calls, {section['total']:.3f}s total, {section['max']:.3f}s max")
+    for name, value in sorted(report["counters"].items()):
+        LOG.info(f"{name}: {value}")
@@ -0,0 +1,115 @@
+"""
+BRC_BIDS: Lightweight records of the files in a BIDS dataset
+
+The pipeline only needs the path, entities and metadata of each file, so rather than
+keeping pybids ORM objects (and the SQLAlchemy session behind them) alive for the whole
+run, the files are copied into small immutable records. These support the parts of
+the BIDSImageFile interface used by the pipeline stages and are cheap to pickle, e.g.
+to send to worker processes.
+"""
+import collections.abc
+import os
+import sys
+import types
+
+class FileRecord:
+    """
+    An immutable record of a file in a BIDS dataset
+
+    The entities and metadata are read-only views, so the metadata can be shared with
+    the sidecars cache without being copied
+    """
+    __slots__ = ("path", "entities", "metadata", "associations")
+
+    def __init__(self, path, entities, metadata=None, associations=()):
+        """
+        :param path: Absolute path to the file
+        :param entities: Dict of BIDS entities, e.g. subject, session, suffix
+        :param metadata: Optional metadata dictionary resolved from the JSON sidecars
+        :param associations: Sequence of FileRecord for associated files, e.g. aslcontext
+        """
+        set_attr = object.__setattr__
+        set_attr(self, "path", path)
+        set_attr(self, "entities", types.MappingProxyType({sys.intern(k) : sys.intern(v) if isinstance(v, str) else v for k, v in entities.items()}))
+        set_attr(self, "metadata", None if metadata is None else types.MappingProxyType(metadata))
+        set_attr(self, "associations", tuple(associations))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self):
+        # Read-only views cannot be pickled, so the underlying dictionaries are copied
+        metadata = None if self.metadata is None else dict(self.metadata)
+        return (FileRecord, (self.path, dict(self.entities), metadata, self.associations))
+
+    def __eq__(self, other):
+        return isinstance(other, FileRecord) and self.path == other.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return f"<FileRecord {self.path}>"
+
+    @property
+    def filename(self):
+        return os.path.basename(self.path)
+
+    @property
+    def dirname(self):
+        return os.path.dirname(self.path)
+
+    def get_associations(self):
+        """
+        :return: List of FileRecord for files directly associated with this file
+        """
+        return list(self.associations)
+
+    def get_metadata(self):
+        """
+        :return: Read-only metadata mapping, or the metadata dictionary resolved from the
+                 JSON sidecars if it was not included in the record
+        """
+        if self.metadata is not None:
+            return self.metadata
+        from . import sidecars
+        return sidecars.get_metadata(self.path)
+
+class SessionFiles(collections.abc.Mapping):
+    """
+    An immutable record of the files in a session, mapping file suffix to a tuple of FileRecord
+    """
+    __slots__ = ("subject", "session", "_files")
+
+    def __init__(self, subject, session, files):
+        """
+        :param subject: Subject label
+        :param session: Session label or None if the subject has no session level
+        :param files: Dict mapping file suffix to sequence of FileRecord
+        """
+        set_attr = object.__setattr__
+        set_attr(self, "subject", subject)
+        set_attr(self, "session", session)
+        set_attr(self, "_files", {suffix : tuple(records) for suffix, records in files.items()})
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self):
+        return (SessionFiles, (self.subject, self.session, self._files))
+
+    def __getitem__(self, suffix):
+        return self._files[suffix]
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __len__(self):
+        return len(self._files)
+
+    def __repr__(self):
+        counts = ", ".join([f"{suffix}={len(records)}" for suffix, records in self._files.items()])
+        return f"<SessionFiles sub-{self.subject} ses-{self.session} {counts}>"
@@ -0,0 +1,176 @@
+"""
+BRC_BIDS: Selection of subjects and splitting of a cohort into shards
+
+A cohort can be split into N shards, each processed by a separate brc_bids run
+(e.g. on different submit hosts). The split is deterministic, so every run computes
+the same assignment of subjects to shards, and is balanced either by the number of
+subjects or by the total size of their data. Each run writes a manifest of the
+sessions it processed which can be merged with those of the other shards.
+"""
+import glob
+import json
+import logging
+import os
+
+from . import utils
+
+LOG = logging.getLogger(__name__)
+
+def parse_shard(text):
+    """
+    Parse a shard specification
+
+    :param text: Shard in the form i/N where 1 <= i <= N
+    :return: Tuple of shard index i, number of shards N
+    """
+    try:
+        idx, num = [int(part) for part in text.split("/")]
+    except ValueError:
+        raise ValueError(f"Invalid shard: {text} - must be in the form i/N")
+    if not 1 <= idx <= num:
+        raise ValueError(f"Invalid shard: {text} - must have 1 <= i <= N")
+    return idx, num
+
+def list_subjects(bidsdir):
+    """
+    :return: Sorted list of subject labels in a BIDS dataset, without the sub- prefix
+    """
+    with os.scandir(bidsdir) as it:
+        return sorted([
+            entry.name[4:] for entry in it
+            if entry.name.startswith("sub-") and entry.is_dir()
+        ])
+
+def subject_size(bidsdir, subject):
+    """
+    :return: Total size in bytes of the files in a subject directory
+    """
+    size = 0
+    for dirpath, _dirnames, filenames in os.walk(os.path.join(bidsdir, f"sub-{subject}")):
+        for filename in filenames:
+            try:
+                size += os.stat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+def split(subjects, num, sizes=None):
+    """
+    Split subjects into shards
+
+    :param subjects: Sequence of subject labels
+    :param num: Number of shards
+    :param sizes: Optional dict mapping subject label to data size. If given, subjects
+                  are assigned largest first to the shard with the smallest total size.
+                  Otherwise subjects are dealt out in sorted order
+    :return: List of lists of subject labels, one for each shard
+    """
+    shards = [[] for _idx in range(num)]
+    if sizes is None:
+        for idx, subject in enumerate(sorted(subjects)):
+            shards[idx % num].append(subject)
+    else:
+        totals = [0] * num
+        for subject in sorted(subjects, key=lambda subj: (-sizes[subj], subj)):
+            idx = totals.index(min(totals))
+            shards[idx].append(subject)
+            totals[idx] += sizes[subject]
+    return [sorted(shard) for shard in shards]
+
+def select_subjects(bidsdir, participant_labels=None, shard=None, by="count"):
+    """
+    Get the subjects to process
+
+    :param bidsdir: Path to BIDS dataset
+    :param participant_labels: Optional sequence of subject labels to include, with or
+                               without the sub- prefix
+    :param shard: Optional tuple of shard index, number of shards as returned by parse_shard
+    :param by: Balance shards by subject 'count' or data 'size'
+
+    :return: Sorted list of subject labels
+    """
+    subjects = list_subjects(bidsdir)
+    if participant_labels:
+        labels = set([label[4:] if label.startswith("sub-") else label for label in participant_labels])
+        missing = labels - set(subjects)
+        if missing:
+            LOG.warn(f"Participant labels not found in dataset: {sorted(missing)}")
+        subjects = [subj for subj in subjects if subj in labels]
+
+    if shard is not None:
+        idx, num = shard
+        sizes = None
+        if by == "size":
+            sizes = {subj : subject_size(bidsdir, subj) for subj in subjects}
+        elif by != "count":
+            raise ValueError(f"Unknown shard balancing method: {by}")
+        subjects = split(subjects, num, sizes)[idx-1]
+        LOG.info(f"Shard {idx}/{num}: {len(subjects)} subjects")
+    return subjects
+
+def manifest_path(outdir, shard):
+    """
+    :return: Path to the manifest file for a shard
+    """
+    idx, num = shard
+    return os.path.join(utils.work_dir(outdir, "shards"), f"shard-{idx}-of-{num}.json")
+
+def write_manifest(fname, shard, subjects, session_jobs):
+    """
+    Write a manifest of the sessions processed by a shard
+
+    :param shard: Tuple of shard index, number of shards
+    :param subjects: Subjects assigned to the shard
+    :param session_jobs: Dict mapping (subject, session) to dict of stage name to job IDs
+    """
+    manifest = {
+        "shard" : list(shard),
+        "subjects" : list(subjects),
+        "sessions" : [
+            {
+                "subject" : subject,
+                "session" : session,
+                "jobs" : {stage : utils.dep_job_ids(jobs) for stage, jobs in stage_jobs.items()},
+            }
+            for (subject, session), stage_jobs in session_jobs.items()
+        ],
+    }
+    with open(fname, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+def find_manifests(outdir):
+    """
+    :return: Sorted paths of the shard manifests in a pipeline output directory
+    """
+    return sorted(glob.glob(os.path.join(outdir, utils.WORK_DIRNAME, "shards", "shard-*-of-*.json")))
+
+def missing_shards(merged):
+    """
+    :param merged: Merged manifest as returned by merge_manifests
+    :return: Sorted list of shard specifications i/N for which there is no manifest
+    """
+    found = set([tuple(shard) for shard in merged["shards"]])
+    nums = set([num for _idx, num in found])
+    return [f"{idx}/{num}" for num in sorted(nums) for idx in range(1, num+1) if (idx, num) not in found]
+
+def merge_manifests(fnames):
+    """
+    Merge the manifests written by a set of shards
+
+    :param fnames: Sequence of manifest file paths
+    :return: Merged manifest dict with subjects and sessions from all shards
+    """
+    merged = {"shards" : [], "subjects" : [], "sessions" : []}
+    for fname in fnames:
+        with open(fname) as f:
+            manifest = json.load(f)
+        overlap = set(manifest["subjects"]) & set(merged["subjects"])
+        if overlap:
+            raise ValueError(f"Subjects appear in more than one shard manifest: {sorted(overlap)}")
+        merged["shards"].append(manifest["shard"])
+        merged["subjects"].extend(manifest["subjects"])
+        merged["sessions"].extend(manifest["sessions"])
+
+    merged["subjects"].sort()
+    merged["sessions"].sort(key=lambda sess: (sess["subject"], sess["session"] or ""))
+    return merged
@@ -0,0 +1,214 @@
+"""
+BRC_BIDS: Memoized access to BIDS JSON sidecar metadata
+
+Metadata for an image is resolved once using the BIDS inheritance principle and
+cached. When cached metadata is revalidated, each sidecar is only re-read if its
+mtime or size has changed, and the resolved metadata is only rebuilt if the content
+hash of one of its sidecars has changed.
+"""
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from . import profiling
+
+LOG = logging.getLogger(__name__)
+
+# Default number of threads used to prefetch metadata
+DEFAULT_WORKERS = 8
+
+_LOCK = threading.Lock()
+
+# Sidecar path -> ((mtime, size), content hash, parsed JSON)
+_SIDECARS = {}
+
+# Image path -> (sidecar path/hash sequence, resolved metadata)
+_METADATA = {}
+
+# Directory -> (mtime, JSON files in directory)
+_DIRS = {}
+
+# Directory -> dataset root directory containing it
+_ROOTS = {}
+
+@profiling.timed("get_metadata")
+def get_metadata(bids_file, revalidate=False):
+    """
+    Get the metadata for a BIDS file, including metadata inherited from higher levels
+
+    :param bids_file: BIDSFile, records.FileRecord instance or path to file
+    :param revalidate: If True, check whether the sidecars have changed since the metadata
+                       was cached. Otherwise cached metadata is returned without touching
+                       the filesystem
+    :return: Metadata dictionary. This is shared between callers and should not be modified
+    """
+    if not revalidate and getattr(bids_file, "metadata", None) is not None:
+        # Metadata already resolved into a records.FileRecord
+        return bids_file.metadata
+
+    path = os.path.abspath(getattr(bids_file, "path", bids_file))
+    with _LOCK:
+        cached = _METADATA.get(path, None)
+    if cached is not None and not revalidate:
+        return cached[1]
+
+    sidecars = [(sidecar, ) + _read_sidecar(sidecar) for sidecar in _find_sidecars(path)]
+    digests = tuple((sidecar, digest) for sidecar, digest, _data in sidecars)
+    if cached is not None and cached[0] == digests:
+        return cached[1]
+
+    metadata = {}
+    for _sidecar, _digest, data in sidecars:
+        metadata.update(data)
+    with _LOCK:
+        _METADATA[path] = (digests, metadata)
+    return metadata
+
+def clear_cache():
+    """
+    Discard all cached sidecars and metadata, e.g. to time metadata reads from cold
+    """
+    with _LOCK:
+        _SIDECARS.clear()
+        _METADATA.clear()
+        _DIRS.clear()
+        _ROOTS.clear()
+
+def prefetch(bids_files, workers=DEFAULT_WORKERS, executor=None):
+    """
+    Resolve metadata for a set of files in parallel so subsequent calls to
+    get_metadata do not need to touch the filesystem
+
+    :param bids_files: Sequence of BIDSFile instances or file paths
+    :param workers: Number of threads to use
+    :param executor: Optional concurrent.futures.Executor to use instead of creating
+                     a thread pool, so a pool can be shared between batches of files
+    """
+    bids_files = list(bids_files)
+    LOG.info(f"Reading metadata for {len(bids_files)} files")
+    def _prefetch(executor):
+        # Force evaluation so exceptions are raised here
+        list(executor.map(lambda f: get_metadata(f, revalidate=True), bids_files))
+
+    if executor is not None:
+        _prefetch(executor)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            _prefetch(executor)
+
+def find_sidecars(path):
+    """
+    Find the JSON sidecars which apply to a file, including inherited sidecars in
+    parent directories
+
+    :return: Sidecar paths in the order they are applied
+    """
+    return _find_sidecars(os.path.abspath(path))
+
+def _parse_filename(filename):
+    """
+    :return: Tuple of dict of entities, suffix from a BIDS filename
+    """
+    parts = filename.split(".", 1)[0].split("_")
+    entities = dict([part.split("-", 1) for part in parts[:-1] if "-" in part])
+    return entities, parts[-1]
+
+def _find_root(dirname):
+    """
+    Find the root of the BIDS dataset containing a directory
+    """
+    with _LOCK:
+        if dirname in _ROOTS:
+            return _ROOTS[dirname]
+
+    root = dirname
+    while not os.path.exists(os.path.join(root, "dataset_description.json")):
+        parent = os.path.dirname(root)
+        if parent == root:
+            # Not in a BIDS dataset - only use sidecars in the same directory
+            root = dirname
+            break
+        root = parent
+
+    with _LOCK:
+        _ROOTS[dirname] = root
+    return root
+
+def _list_sidecars(dirname):
+    """
+    :return: JSON files in a directory, cached until the directory mtime changes
+    """
+    mtime = os.stat(dirname).st_mtime_ns
+    with _LOCK:
+        cached = _DIRS.get(dirname, None)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with os.scandir(dirname) as it:
+        sidecars = sorted([entry.name for entry in it if entry.name.endswith(".json") and entry.is_file()])
+    with _LOCK:
+        _DIRS[dirname] = (mtime, sidecars)
+    return sidecars
+
+def _find_sidecars(path):
+    """
+    Find the sidecars which apply to a file, in the order they should be applied
+
+    Following the BIDS inheritance principle a sidecar applies if it is in the same
+    directory as the file or a parent directory within the dataset, has the same suffix,
+    and all of its entities are present in the file name. Sidecars closer to the file,
+    or with more entities, take precedence.
+
+    Only the directories containing the file are searched, so a sidecar in a datatype
+    directory (e.g. anat/) never applies to files of another datatype. JSON files are
+    metadata themselves and have no sidecars.
+    """
+    dirname, filename = os.path.split(path)
+    if filename.endswith(".json"):
+        return []
+    entities, suffix = _parse_filename(filename)
+    root = _find_root(dirname)
+
+    dirs = [dirname]
+    while dirs[-1] != root and os.path.dirname(dirs[-1]) != dirs[-1]:
+        dirs.append(os.path.dirname(dirs[-1]))
+
+    sidecars = []
+    for depth, sidecar_dir in enumerate(reversed(dirs)):
+        for sidecar in _list_sidecars(sidecar_dir):
+            sidecar_entities, sidecar_suffix = _parse_filename(sidecar)
+            if sidecar_suffix != suffix:
+                continue
+            if all(entities.get(k, None) == v for k, v in sidecar_entities.items()):
+                sidecars.append((depth, len(sidecar_entities), os.path.join(sidecar_dir, sidecar)))
+    return [sidecar for _depth, _nents, sidecar in sorted(sidecars)]
+
+def _read_sidecar(path):
+    """
+    :return: Tuple of content hash, parsed JSON for a sidecar, re-reading it only
+             if its mtime or size have changed
+    """
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _LOCK:
+        cached = _SIDECARS.get(path, None)
+    if cached is not None and cached[0] == key:
+        return cached[1:]
+
+    with open(path, "rb") as f:
+        content = f.read()
+    profiling.count("sidecar_reads")
+    profiling.count("sidecar_bytes", len(content))
+    digest = hashlib.sha1(content).hexdigest()
+    if cached is not None and cached[1] == digest:
+        data = cached[2]
+    else:
+        LOG.debug(f"Reading sidecar {path}")
+        data = json.loads(content)
+
+    with _LOCK:
+        _SIDECARS[path] = (key, digest, data)
+    return digest, data
@@ -0,0 +1,234 @@
+"""
+BRC_BIDS: Running pipeline commands on node-local scratch storage
+
+With many jobs running at once, reading inputs from and writing outputs to shared
+storage makes the shared filesystem the bottleneck. A staged command instead runs
+on node-local scratch space (``$TMPDIR`` by default):
+
+ - Input files named on the command line are copied to scratch, together with files
+   alongside them with the same name stem (e.g. JSON sidecars, .bval and .bvec files)
+ - The outputs of the stages it needs are copied to scratch. A staged command records
+   the output files it synced back, so only those are copied. If a needed stage was not
+   run staged, the whole session output directory is copied instead
+ - The command is run with its arguments rewritten to point at the scratch copies
+ - If it succeeds, new and changed output files are synced back to the output
+   directory. Each file is written under a temporary name and renamed into place,
+   and the command only succeeds (so its completion marker is only created) once
+   everything has been synced
+
+Files are copied concurrently using the transfer module. Outputs which were staged
+in and have not been modified are not copied back.
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+from . import profiling, state, transfer
+
+LOG = logging.getLogger(__name__)
+
+# Methods used to copy files to scratch. Hardlinks are not used because the command
+# could then modify the original files in place
+STAGE_IN_METHODS = ("reflink", "sendfile")
+
+def wrap_cmd(cmd, outdir, key, stage, needs=(), scratch=None):
+    """
+    Wrap a command so it runs on node-local scratch
+
+    :param cmd: Command as a sequence of arguments
+    :param outdir: Pipeline output directory, as used in the command
+    :param key: Session output directory name, <subject>_<session>
+    :param stage: Name of the stage the command belongs to
+    :param needs: Names of stages whose outputs the command uses
+    :param scratch: Scratch directory. Default is $TMPDIR on the node running the command
+
+    :return: Wrapped command
+    """
+    wrapped = ["brc_bids", "staged", "--output", outdir, "--session", key, "--stage", stage]
+    for need in needs:
+        wrapped.extend(["--need", need])
+    if scratch:
+        wrapped.extend(["--scratch", scratch])
+    return wrapped + ["--"] + list(cmd)
+
+def scratch_root(scratch=None):
+    """
+    :return: Scratch directory to use, by default $TMPDIR or the system temporary directory
+    """
+    return scratch or os.environ.get("TMPDIR", None) or tempfile.gettempdir()
+
+def outputs_path(outdir, key, stage):
+    """
+    :return: Path to the list of output files synced back by a staged stage
+    """
+    return os.path.join(state.state_dir(outdir, key), f"{stage}.outputs.json")
+
+def run_staged(cmd, outdir, key, stage=None, needs=(), scratch=None, workers=transfer.DEFAULT_WORKERS, keep=False):
+    """
+    Run a command on node-local scratch, syncing its output back to the output directory
+
+    :param cmd: Command as a sequence of arguments
+    :param outdir: Pipeline output directory, as used in the command
+    :param key: Session output directory name
+    :param stage: Name of the stage the command belongs to. If given, the output files
+                  are recorded so that stages which need it can stage them in
+    :param needs: Names of stages whose outputs the command uses
+    :param scratch: Scratch directory, see scratch_root
+    :param workers: Number of files to copy at once
+    :param keep: If True, do not delete the scratch copy afterwards
+
+    :return: Exit status of command
+    """
+    root = scratch_root(scratch)
+    os.makedirs(root, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix=f"brc_bids_{key}_", dir=root)
+    LOG.info(f"Staging {key} in {workdir}")
+    try:
+        scratch_out = os.path.join(workdir, "output")
+        mapping, staged = _stage_in(cmd, outdir, key, needs, workdir, scratch_out, workers)
+        staged_cmd = [_rewrite(str(arg), mapping, outdir, scratch_out) for arg in cmd]
+
+        LOG.info(" ".join(staged_cmd))
+        with profiling.timer("staged_cmd", cmd=cmd[0]):
+            returncode = subprocess.call(staged_cmd, cwd=workdir)
+        if returncode != 0:
+            LOG.warn(f"Command failed with exit status {returncode} - output not synced back to {outdir}")
+            return returncode
+
+        synced = _sync_out(scratch_out, outdir, staged, workers)
+        if stage:
+            _write_outputs(outdir, key, stage, synced)
+        return 0
+    finally:
+        if keep:
+            LOG.info(f"Keeping scratch directory {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def _stage_in(cmd, outdir, key, needs, workdir, scratch_out, workers):
+    """
+    Copy the inputs of a command and the outputs of the stages it needs to scratch
+
+    :return: Tuple of dict mapping absolute input path to scratch path, dict mapping
+             scratch output path to (mtime, size) after staging
+    """
+    pairs, mapping, dirs = [], {}, {}
+    outdir_abs = os.path.abspath(outdir)
+    for path in state.input_files([cmd]):
+        if path.startswith(outdir_abs + os.sep):
+            # Inputs in the output directory keep their relative path so arguments
+            # can be rewritten in the same way as output paths
+            pairs.append((path, os.path.join(scratch_out, os.path.relpath(path, outdir_abs))))
+            continue
+        srcdir = os.path.dirname(path)
+        if srcdir not in dirs:
+            dirs[srcdir] = os.path.join(workdir, "inputs", str(len(dirs)))
+            os.makedirs(dirs[srcdir])
+        mapping[path] = os.path.join(dirs[srcdir], os.path.basename(path))
+        for sibling in _siblings(path):
+            pairs.append((sibling, os.path.join(dirs[srcdir], os.path.basename(sibling))))
+
+    for relpath in _needed_outputs(outdir_abs, key, needs):
+        pairs.append((os.path.join(outdir_abs, relpath), os.path.join(scratch_out, relpath)))
+    os.makedirs(scratch_out, exist_ok=True)
+
+    pairs = list(dict(pairs).items())
+    for _src, dest in pairs:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with profiling.timer("stage_in", files=len(pairs)):
+        transfer.transfer_files(pairs, methods=STAGE_IN_METHODS, workers=workers)
+    staged = {}
+    for _src, dest in pairs:
+        if dest.startswith(scratch_out + os.sep):
+            stat = os.stat(dest)
+            staged[dest] = (stat.st_mtime_ns, stat.st_size)
+    LOG.info(f"Staged {len(pairs)} files in")
+    return mapping, staged
+
+def _needed_outputs(outdir, key, needs):
+    """
+    Get the output files of the stages a command needs
+
+    :return: Paths relative to the output directory
+    """
+    relpaths, unrecorded = set(), []
+    for need in needs:
+        fname = outputs_path(outdir, key, need)
+        if not os.path.exists(fname):
+            unrecorded.append(need)
+            continue
+        with open(fname) as f:
+            relpaths.update([relpath for relpath in json.load(f) if os.path.isfile(os.path.join(outdir, relpath))])
+
+    if unrecorded:
+        # Outputs of stages which were not run staged are not known
+        LOG.info(f"No recorded outputs for {', '.join(unrecorded)} - staging all of {key}")
+        sessdir = os.path.join(outdir, key)
+        for dirpath, _dirnames, filenames in os.walk(sessdir):
+            for filename in filenames:
+                relpaths.add(os.path.relpath(os.path.join(dirpath, filename), outdir))
+    return sorted(relpaths)
+
+def _write_outputs(outdir, key, stage, synced):
+    """
+    Record the output files synced back by a staged stage
+
+    :param synced: Absolute paths of files synced back to the output directory
+    """
+    outdir_abs = os.path.abspath(outdir)
+    with open(outputs_path(outdir, key, stage), "w") as f:
+        json.dump(sorted([os.path.relpath(path, outdir_abs) for path in synced]), f, indent=2)
+
+def _siblings(path):
+    """
+    :return: Paths of files in the same directory with the same name stem, including the file itself
+    """
+    dirname, basename = os.path.split(path)
+    stem = basename.split(".", 1)[0]
+    with os.scandir(dirname) as it:
+        return sorted([
+            entry.path for entry in it
+            if (entry.name == basename or entry.name.split(".", 1)[0] == stem) and entry.is_file()
+        ])
+
+def _rewrite(arg, mapping, outdir, scratch_out):
+    """
+    Rewrite a command argument to refer to scratch copies of inputs and outputs
+    """
+    parts = []
+    outdir_abs = os.path.abspath(outdir)
+    for part in arg.split("@"):
+        if part and os.path.abspath(part) in mapping:
+            part = mapping[os.path.abspath(part)]
+        else:
+            for prefix in (outdir.rstrip(os.sep), outdir_abs):
+                if part == prefix or part.startswith(prefix + os.sep):
+                    part = scratch_out + part[len(prefix):]
+                    break
+        parts.append(part)
+    return "@".join(parts)
+
+def _sync_out(scratch_out, outdir, staged, workers):
+    """
+    Copy new and modified output files from scratch back to the output directory
+
+    :return: Paths of the files synced back
+    """
+    pairs = []
+    for dirpath, _dirnames, filenames in os.walk(scratch_out):
+        destdir = os.path.join(outdir, os.path.relpath(dirpath, scratch_out))
+        os.makedirs(destdir, exist_ok=True)
+        for filename in filenames:
+            src = os.path.join(dirpath, filename)
+            stat = os.stat(src)
+            if staged.get(src, None) == (stat.st_mtime_ns, stat.st_size):
+                continue
+            pairs.append((src, os.path.join(destdir, filename)))
+
+    with profiling.timer("sync_out", files=len(pairs)):
+        counts = transfer.transfer_files(pairs, workers=workers)
+    LOG.info(f"Synced {len(pairs)} files back to {outdir}: " + ", ".join([f"{count} {method}" for method, count in sorted(counts.items())]))
+    return [dest for _src, dest in pairs]
@@ -0,0 +1,149 @@
+"""
+BRC_BIDS: Record of submitted pipeline stages for incremental re-runs
+
+For each session and stage we record the commands submitted, the mtime and size of
+the input files they reference and the ID of the submitted jobs. Each command is
+wrapped so that it writes a completion marker when it succeeds. On an incremental
+re-run a stage is only resubmitted if its commands or inputs have changed, if any of
+its commands did not complete successfully, or if a stage it needs was resubmitted.
+A stage whose jobs are still queued or running is never resubmitted (see
+status.pending_jobs).
+"""
+import json
+import logging
+import os
+import shlex
+import time
+
+from . import sidecars, utils
+
+LOG = logging.getLogger(__name__)
+
+# Work directory caching ASL data split into separate ASL and M0 images, see
+# oxasl.asl_split_dir. The split images are not treated as inputs: they are derived
+# from the ASL data given to the same command, which is fingerprinted instead
+SPLIT_DIRNAME = "aslsplit"
+
+def state_dir(outdir, key):
+    """
+    :param key: Name of session output directory, e.g. <subject>_<session>, or
+                'cohort' for cohort stages
+    :return: Directory containing stage records for a session
+    """
+    return utils.work_dir(outdir, "state", key)
+
+def marker_path(outdir, key, stage, idx):
+    """
+    :return: Absolute path to completion marker for a command within a stage. This is
+             independent of the working directory the command is run from
+    """
+    return os.path.abspath(os.path.join(state_dir(outdir, key), f"{stage}.{idx}.done"))
+
+def wrap_cmd(cmd, marker):
+    """
+    Wrap a command so it creates a completion marker if it succeeds
+    """
+    return ["/bin/sh", "-c", f"{shlex.join(cmd)} && touch {shlex.quote(marker)}"]
+
+def input_files(cmds):
+    """
+    Get the input files referenced by a set of commands
+
+    Arguments which are existing files (including @-separated lists of files) are
+    included, together with the JSON sidecars which apply to any NIfTI images, including
+    sidecars inherited from higher levels of the dataset. Split ASL images in the
+    split cache are not included
+    """
+    split_dir = os.sep + os.path.join(utils.WORK_DIRNAME, SPLIT_DIRNAME) + os.sep
+    inputs = set()
+    for cmd in cmds:
+        for arg in cmd:
+            for path in str(arg).split("@"):
+                if os.path.isfile(path) and split_dir not in os.path.abspath(path):
+                    inputs.add(os.path.abspath(path))
+                    if ".nii" in path:
+                        inputs.update(sidecars.find_sidecars(path))
+    return sorted(inputs)
+
+def fingerprint(paths):
+    """
+    :return: Dict mapping file path to [mtime, size]
+    """
+    ret = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            ret[path] = [stat.st_mtime_ns, stat.st_size]
+        except OSError:
+            ret[path] = None
+    return ret
+
+def load(outdir, key, stage):
+    """
+    :return: Recorded state for a stage, or None if not found
+    """
+    fname = os.path.join(state_dir(outdir, key), f"{stage}.json")
+    if not os.path.exists(fname):
+        return None
+    with open(fname) as f:
+        return json.load(f)
+
+def is_up_to_date(outdir, key, stage, cmds, extra=None):
+    """
+    Check whether a stage has already been run successfully with the same commands and inputs
+
+    :param cmds: Commands which would be submitted for the stage (without completion markers)
+    :param extra: Optional JSON-serializable data which must also match the recorded state
+    """
+    record = load(outdir, key, stage)
+    if record is None:
+        return False
+    if record["cmds"] != cmds or record.get("extra", None) != extra:
+        LOG.debug(f"{key} {stage}: commands have changed")
+        return False
+    if record["inputs"] != fingerprint(record["inputs"].keys()):
+        LOG.debug(f"{key} {stage}: inputs have changed")
+        return False
+    for idx in range(len(cmds)):
+        if not os.path.exists(marker_path(outdir, key, stage, idx)):
+            LOG.debug(f"{key} {stage}: command {idx} did not complete")
+            return False
+    return True
+
+def prepare(outdir, key, stage, cmds, extra=None, run_cmds=None):
+    """
+    Record that a stage is about to be submitted
+
+    Any existing completion markers for the stage are removed
+
+    :param run_cmds: Optional commands to actually run in place of ``cmds``, e.g. wrapped
+                     to run on node-local scratch. ``cmds`` are still the ones recorded
+
+    :return: Commands wrapped to create completion markers
+    """
+    statedir = state_dir(outdir, key)
+    for fname in os.listdir(statedir):
+        if fname.startswith(stage + ".") and fname.endswith(".done"):
+            os.remove(os.path.join(statedir, fname))
+
+    record = {
+        "cmds" : cmds,
+        "extra" : extra,
+        "inputs" : fingerprint(input_files(cmds)),
+        "submitted" : time.time(),
+        "jobs" : [],
+    }
+    with open(os.path.join(statedir, f"{stage}.json"), "w") as f:
+        json.dump(record, f, indent=2)
+    return [wrap_cmd(cmd, marker_path(outdir, key, stage, idx)) for idx, cmd in enumerate(run_cmds or cmds)]
+
+def record_jobs(outdir, key, stage, jobs):
+    """
+    Add submitted job IDs to the record for a stage
+    """
+    fname = os.path.join(state_dir(outdir, key), f"{stage}.json")
+    with open(fname) as f:
+        record = json.load(f)
+    record["jobs"] = [job for job in jobs if job is not None]
+    with open(fname, "w") as f:
+        json.dump(record, f, indent=2)
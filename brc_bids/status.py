@@ -0,0 +1,302 @@
+"""
+BRC_BIDS: Status of submitted pipeline jobs
+
+The status of each command recorded in the job ledger is resolved in bulk. Commands
+which have written their completion marker are done, which needs no scheduler query at
+all. The rest are looked up with a single batched scheduler query: ``sacct`` on SLURM,
+or one ``qstat`` listing on SGE. A job which has left the queue without writing its
+marker has failed.
+
+The result is summarised per stage and the sessions which need to be resubmitted are
+listed, so the run can be resumed using ``--incremental``.
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import time
+
+from . import ledger, profiling, utils
+
+LOG = logging.getLogger(__name__)
+
+DONE = "done"
+FAILED = "failed"
+RUNNING = "running"
+QUEUED = "queued"
+# Not complete but the state of the job is unknown, e.g. commands run locally
+INCOMPLETE = "incomplete"
+
+# States in order of precedence when summarising the commands in a stage
+STATES = (FAILED, INCOMPLETE, RUNNING, QUEUED, DONE)
+
+# Scheduler query methods
+SCHEDULERS = ("auto", "slurm", "sge", "markers")
+
+# Maximum number of job IDs passed to a single sacct call
+SACCT_CHUNK = 1000
+
+# Default polling interval in seconds when waiting for jobs to finish
+POLL_INTERVAL = 60
+
+_SLURM_STATES = {
+    "PENDING" : QUEUED, "REQUEUED" : QUEUED, "REQUEUE_HOLD" : QUEUED, "SUSPENDED" : QUEUED,
+    "RESIZING" : QUEUED, "RUNNING" : RUNNING, "CONFIGURING" : RUNNING, "COMPLETING" : RUNNING,
+    "STAGE_OUT" : RUNNING, "SIGNALING" : RUNNING,
+}
+
+def detect_scheduler():
+    """
+    :return: Scheduler query method available on this system: 'slurm', 'sge' or
+             'markers' if neither sacct nor qstat is available
+    """
+    if shutil.which("sacct"):
+        return "slurm"
+    elif shutil.which("qstat"):
+        return "sge"
+    return "markers"
+
+def resolve(entries, scheduler="auto", known=None):
+    """
+    Resolve the state of each command in the ledger
+
+    :param entries: Dict mapping (key, stage, idx) to ledger entry, see ledger.latest
+    :param scheduler: One of SCHEDULERS
+    :param known: Optional dict of previously resolved states. Commands which are already
+                  done or failed are not checked again
+
+    :return: Dict mapping (key, stage, idx) to state
+    """
+    if scheduler == "auto":
+        scheduler = detect_scheduler()
+    known = known or {}
+    states, pending = {}, {}
+    for task, entry in entries.items():
+        if known.get(task, None) in (DONE, FAILED):
+            states[task] = known[task]
+        elif os.path.exists(entry["marker"]):
+            states[task] = DONE
+        elif not entry["cluster"] or not entry["job"] or scheduler == "markers":
+            states[task] = INCOMPLETE
+        else:
+            pending[task] = entry
+
+    if pending:
+        LOG.info(f"Querying {scheduler} for {len(pending)} jobs")
+        with profiling.timer("status.query", scheduler=scheduler):
+            if scheduler == "slurm":
+                job_states = _query_slurm(set(utils.split_job_id(entry["job"])[0] for entry in pending.values()))
+            elif scheduler == "sge":
+                job_states = _query_sge()
+            else:
+                raise ValueError(f"Unknown scheduler: {scheduler}")
+
+        for task, entry in pending.items():
+            state = _lookup(job_states, entry["job"])
+            if state is None:
+                # No longer known to the scheduler. Check the marker again in case the
+                # job finished since we last looked
+                state = DONE if os.path.exists(entry["marker"]) else FAILED
+            states[task] = state
+    return states
+
+def pending_jobs(outdir, scheduler="auto"):
+    """
+    Find the stages whose most recently submitted jobs are still queued or running
+
+    :return: Dict mapping (key, stage) to list of job IDs to hold on. Array tasks are
+             given as the ID of the array job
+    """
+    entries = ledger.latest(ledger.read(outdir))
+    task_states = resolve(entries, scheduler)
+    ret = {}
+    for task, state in sorted(task_states.items()):
+        if state in (QUEUED, RUNNING):
+            key, stage, _idx = task
+            job_id = utils.split_job_id(entries[task]["job"])[0]
+            jobs = ret.setdefault((key, stage), [])
+            if job_id not in jobs:
+                jobs.append(job_id)
+    return ret
+
+def stage_states(task_states):
+    """
+    Summarise command states for each stage of each session
+
+    :return: Dict mapping (key, stage) to state
+    """
+    ret = {}
+    for (key, stage, _idx), state in task_states.items():
+        current = ret.get((key, stage), DONE)
+        ret[(key, stage)] = min(current, state, key=STATES.index)
+    return ret
+
+def summary(entries, task_states):
+    """
+    Summarise the status of a pipeline run
+
+    :return: Dict with 'stages' mapping stage name to dict of state counts, 'sessions'
+             mapping session key to dict of stage name to state and job IDs,
+             'resubmit' listing the sessions which did not complete and the participant
+             labels to resubmit them, and 'pending' giving the number of stages still
+             queued or running
+    """
+    stage_jobs = {}
+    for (key, stage, _idx), entry in sorted(entries.items()):
+        stage_jobs.setdefault((key, stage), []).append(entry["job"])
+
+    stages, sessions = {}, {}
+    for (key, stage), state in sorted(stage_states(task_states).items()):
+        counts = stages.setdefault(stage, {})
+        counts[state] = counts.get(state, 0) + 1
+        sessions.setdefault(key, {})[stage] = {"state" : state, "jobs" : stage_jobs[(key, stage)]}
+
+    resubmit = sorted([
+        key for key, sess_stages in sessions.items()
+        if any(stage["state"] in (FAILED, INCOMPLETE) for stage in sess_stages.values())
+    ])
+    participants = sorted(set([key.split("_", 1)[0] for key in resubmit if key != "cohort"]))
+    pending = sum([count for counts in stages.values() for state, count in counts.items() if state in (QUEUED, RUNNING)])
+    return {
+        "time" : time.time(),
+        "stages" : stages,
+        "sessions" : sessions,
+        "resubmit" : {"sessions" : resubmit, "participants" : participants},
+        "pending" : pending,
+    }
+
+def get_status(outdir, scheduler="auto", wait=False, interval=POLL_INTERVAL):
+    """
+    Get the status of the jobs submitted to a pipeline output directory
+
+    :param outdir: Pipeline output directory
+    :param scheduler: One of SCHEDULERS
+    :param wait: If True, poll until no jobs are queued or running. Each poll makes a
+                 single scheduler query for the jobs which have not yet finished
+    :param interval: Time between polls in seconds
+
+    :return: Summary dict, see summary
+    """
+    entries = ledger.latest(ledger.read(outdir))
+    if not entries:
+        raise ValueError(f"No submitted jobs recorded in {outdir}")
+    if scheduler == "auto":
+        scheduler = detect_scheduler()
+
+    task_states = resolve(entries, scheduler)
+    while wait and any(state in (QUEUED, RUNNING) for state in task_states.values()):
+        time.sleep(interval)
+        task_states = resolve(entries, scheduler, task_states)
+    return summary(entries, task_states)
+
+def format_summary(status):
+    """
+    :return: Human readable summary of the status of a pipeline run
+    """
+    lines = []
+    for stage, counts in status["stages"].items():
+        lines.append(f"{stage}: " + ", ".join([f"{counts[state]} {state}" for state in reversed(STATES) if state in counts]))
+    resubmit = status["resubmit"]
+    for key in resubmit["sessions"]:
+        failed = [
+            f"{stage} ({', '.join([str(job) for job in info['jobs'] if job]) or 'no job ID'})"
+            for stage, info in status["sessions"][key].items() if info["state"] in (FAILED, INCOMPLETE)
+        ]
+        lines.append(f"Not complete: {key}: {', '.join(failed)}")
+    if resubmit["sessions"]:
+        lines.append("Resubmit using brc_bids with the same options and --incremental")
+        if resubmit["participants"]:
+            lines.append("To resubmit only these subjects add --participant-label " + " ".join(resubmit["participants"]))
+    if status["pending"]:
+        lines.append(f"{status['pending']} stage(s) still queued or running")
+    return "\n".join(lines)
+
+def write_summary(fname, status):
+    """
+    Write a status summary as JSON
+    """
+    with open(fname, "w") as f:
+        json.dump(status, f, indent=2)
+
+def _query_slurm(job_ids):
+    """
+    Get the state of jobs using sacct
+
+    :return: Dict mapping job ID to dict of task ID (or None) to state. Pending array
+             tasks which SLURM reports as a range are keyed by the range
+    """
+    job_ids = sorted(job_ids)
+    job_states = {}
+    for start in range(0, len(job_ids), SACCT_CHUNK):
+        chunk = job_ids[start:start+SACCT_CHUNK]
+        stdout = subprocess.check_output(["sacct", "-n", "-P", "-X", "-o", "JobID,State", "-j", ",".join(chunk)])
+        profiling.count("subprocess_calls")
+        for line in stdout.decode("UTF-8").splitlines():
+            parts = line.strip().split("|")
+            if len(parts) < 2 or not parts[1]:
+                continue
+            state = _SLURM_STATES.get(parts[1].split()[0], FAILED)
+            match = re.match(r"^(\d+)(?:_(\[.*\]|\d+))?", parts[0])
+            if match:
+                job_states.setdefault(match.group(1), {})[match.group(2)] = state
+    return job_states
+
+def _query_sge():
+    """
+    Get the state of the user's queued and running jobs using qstat
+
+    :return: Dict mapping job ID to dict of task ID, task range or None to state
+    """
+    stdout = subprocess.check_output(["qstat"])
+    profiling.count("subprocess_calls")
+    job_states = {}
+    for line in stdout.decode("UTF-8").splitlines():
+        fields = line.split()
+        if len(fields) < 8 or not fields[0].isdigit():
+            continue
+        sge_state = fields[4]
+        if "E" in sge_state or "d" in sge_state:
+            state = FAILED
+        elif "r" in sge_state or "t" in sge_state or "R" in sge_state:
+            state = RUNNING
+        else:
+            state = QUEUED
+        # The queue column is empty for jobs which are not running
+        task_idx = 9 if "@" in fields[7] else 8
+        task = fields[task_idx] if len(fields) > task_idx else None
+        job_states.setdefault(fields[0], {})[task] = state
+    return job_states
+
+def _lookup(job_states, job):
+    """
+    Find the state of a job or array task in a scheduler query result
+
+    :return: State or None if the job is not known to the scheduler
+    """
+    job_id, task_id = utils.split_job_id(job)
+    task_states = job_states.get(job_id, {})
+    if task_id in task_states:
+        return task_states[task_id]
+    for tasks, state in task_states.items():
+        if tasks is None or task_id is None or _in_range(task_id, tasks):
+            return state
+    return None
+
+def _in_range(task_id, tasks):
+    """
+    Check whether a task ID is in a task range as reported by the scheduler, e.g.
+    [1-10%4] or [1,3,5-7] (SLURM) or 1-10:1 or 2,4 (SGE)
+    """
+    task_id = int(task_id)
+    for part in tasks.strip("[]").split("%")[0].split(","):
+        match = re.fullmatch(r"(\d+)(?:-(\d+)(?::(\d+))?)?", part)
+        if not match:
+            continue
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        step = int(match.group(3) or 1)
+        if first <= task_id <= last and (task_id - first) % step == 0:
+            return True
+    return False
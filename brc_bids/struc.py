@@ -6,9 +6,12 @@ import subprocess
 
 LOG = logging.getLogger(__name__)
 
-from . import utils
+def get_cmds(subject, session, data_files, outdir):
+    """
+    Get the commands to run the structural pipeline for a session
 
-def run(subject, session, data_files, outdir, cluster=False, dep_job=None):
+    :return: List of commands, each a list of arguments
+    """
     t1s = data_files.get("T1w", [])
     t2s = data_files.get("T2w", [])
     if len(t1s) == 0:
@@ -27,4 +30,4 @@ def run(subject, session, data_files, outdir, cluster=False, dep_job=None):
     if t2:
         cmd += ['--t2', t2.path]
 
-    return utils.submit_cmd(cmd, cluster, dep_job)
+    return [cmd]
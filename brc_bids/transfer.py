@@ -0,0 +1,186 @@
+"""
+BRC_BIDS: Concurrent transfer of output files
+
+Converting output to BIDS means placing many files, often on network storage where
+each operation is dominated by latency. Files are therefore transferred concurrently
+and, where the filesystem allows it, without copying data through Python: by cloning
+the source (reflink) or by copying in the kernel using ``os.sendfile``. Hardlinking is
+only used when asked for, since the destination then shares its data with the source
+and modifying either changes both.
+Files which already exist at the destination with the same size and content are left
+alone, so repeating a conversion is cheap.
+
+Destination files are written under a temporary name and renamed into place so an
+interrupted transfer never leaves a partial file behind.
+"""
+import errno
+import hashlib
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from . import profiling
+
+LOG = logging.getLogger(__name__)
+
+# Transfer methods in the order they are tried by default. Each gives the destination
+# its own copy of the data
+METHODS = ("reflink", "sendfile")
+
+# Transfer methods trying a hardlink first, for when the destination may share the
+# source's data
+LINK_METHODS = ("link", ) + METHODS
+
+# Number of files transferred at once
+DEFAULT_WORKERS = 8
+
+# Linux ioctl to clone a file (FICLONE), supported on e.g. btrfs and XFS
+FICLONE = 0x40049409
+
+# Errors which mean a transfer method is not supported between the source and destination
+_UNSUPPORTED = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP,
+                errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.EBADF)
+
+def list_images(dirpath):
+    """
+    List the NIfTI images in a directory with a single directory read
+
+    :return: Dict mapping image name without extension to tuple of full path, extension.
+             Where both .nii.gz and .nii exist, .nii.gz is preferred as in utils.find_img
+    """
+    images = {}
+    try:
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                for ext in (".nii.gz", ".nii"):
+                    if entry.name.endswith(ext):
+                        name = entry.name[:-len(ext)]
+                        if name not in images or ext == ".nii.gz":
+                            images[name] = (entry.path, ext)
+                        break
+    except FileNotFoundError:
+        pass
+    return images
+
+def file_hash(fname, chunk_size=1024*1024):
+    """
+    :return: SHA1 hex digest of a file's contents
+    """
+    sha1 = hashlib.sha1()
+    with open(fname, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def is_same(src, dest):
+    """
+    Check whether a destination file already has the same contents as the source
+
+    The file contents are only hashed if the sizes match and the files are not already
+    the same file (e.g. hardlinked)
+    """
+    try:
+        src_stat, dest_stat = os.stat(src), os.stat(dest)
+    except FileNotFoundError:
+        return False
+    if (src_stat.st_dev, src_stat.st_ino) == (dest_stat.st_dev, dest_stat.st_ino):
+        return True
+    if src_stat.st_size != dest_stat.st_size:
+        return False
+    return file_hash(src) == file_hash(dest)
+
+def transfer_file(src, dest, methods=METHODS):
+    """
+    Transfer a single file, skipping it if the destination is already the same
+
+    :param src: Source file path
+    :param dest: Destination file path. Parent directory must exist
+    :param methods: Sequence of methods to try in order, from 'link', 'reflink' and
+                    'sendfile'. If none of them succeed, the file is copied normally
+
+    :return: Method used: one of ``methods``, 'copy' or 'skipped'
+    """
+    if is_same(src, dest):
+        LOG.debug(f"{dest} is up to date")
+        profiling.count("transfer_skipped")
+        return "skipped"
+
+    tmp = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.{os.getpid()}.tmp")
+    try:
+        method = _transfer(src, tmp, methods)
+        if method != "link":
+            shutil.copymode(src, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+    LOG.debug(f"{src} -> {dest} ({method})")
+    if profiling.is_enabled():
+        profiling.count(f"transfer_{method}")
+        profiling.count("transfer_bytes", os.path.getsize(dest))
+    return method
+
+def transfer_files(pairs, methods=METHODS, workers=DEFAULT_WORKERS):
+    """
+    Transfer files concurrently
+
+    :param pairs: Sequence of (source, destination) file paths
+    :param methods: Transfer methods to try, see transfer_file
+    :param workers: Number of files to transfer at once
+
+    :return: Dict mapping method to number of files transferred using it
+    """
+    counts = {}
+    if not pairs:
+        return counts
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for method in executor.map(lambda pair: transfer_file(pair[0], pair[1], methods), pairs):
+            counts[method] = counts.get(method, 0) + 1
+    return counts
+
+def _transfer(src, dest, methods):
+    """
+    Create dest as a copy of src using the first method which works
+    """
+    for method in methods:
+        try:
+            if method == "link":
+                os.link(src, dest)
+            elif method == "reflink":
+                _reflink(src, dest)
+            elif method == "sendfile":
+                _sendfile(src, dest)
+            else:
+                raise ValueError(f"Unknown transfer method: {method}")
+            return method
+        except OSError as exc:
+            if exc.errno not in _UNSUPPORTED:
+                raise
+            LOG.debug(f"Transfer method {method} not supported for {src}: {exc}")
+            if os.path.lexists(dest):
+                os.remove(dest)
+
+    shutil.copyfile(src, dest)
+    return "copy"
+
+def _reflink(src, dest):
+    import fcntl
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+
+def _sendfile(src, dest):
+    if not hasattr(os, "sendfile"):
+        raise OSError(errno.ENOSYS, "os.sendfile not available")
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        size = os.fstat(fsrc.fileno()).st_size
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(fdest.fileno(), fsrc.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
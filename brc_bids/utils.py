@@ -4,45 +4,182 @@ OXASL_BIDS: Miscellaneous utilities
 import json
 import os
 import logging
+import re
 import subprocess
 
-import nibabel as nib
+from . import nifti, profiling
 
 LOG = logging.getLogger(__name__)
 
+# Name of directory created in the output directory for internal files, e.g. task lists
+WORK_DIRNAME = ".brc_bids"
+
+# Executor used to run commands when not in cluster mode - see set_local_executor
+_LOCAL_EXECUTOR = None
+
+# Job submission messages from SGE and SLURM, for commands which submit jobs themselves
+_JOB_ID_PATTERNS = [
+    re.compile(r"Your job(?:-array)? (\d+)"),
+    re.compile(r"Submitted batch job (\d+)"),
+]
+
+class IncompatabilityError(ValueError):
+    """
+    Raised when BIDS data cannot be interpreted as input to a pipeline
+    """
+
 def get_job_id(stdout):
     """
     Get last job ID submitted by a command
+
+    For array jobs, the ID of the whole array is returned
     """
     last_id = None
     for line in stdout.splitlines():
         if "jobid" in line.lower():
             last_id = line.split(":")[1].strip()
+            continue
+        for pattern in _JOB_ID_PATTERNS:
+            match = pattern.search(line)
+            if match:
+                last_id = match.group(1)
     return last_id
 
-def submit_cmd(cmd, cluster, dep_job, minutes=5, ram=None):
+def split_job_id(job_id):
+    """
+    Split a job ID into the ID of the job and the array task ID, if any
+
+    Array task IDs may be given as <job>.<task> (SGE), <job>_<task> (SLURM)
+    or <job>[<task>] (PBS)
+
+    :return: Tuple of job ID, task ID or None if not an array task
+    """
+    match = re.match(r"^(\d+)(?:[._\[](\d+)\]?)?$", str(job_id).strip())
+    if not match:
+        return str(job_id).strip(), None
+    return match.group(1), match.group(2)
+
+def dep_job_ids(dep_job):
+    """
+    Get the job IDs to hold on from a dependency specification
+
+    :param dep_job: None, a job ID, an object with a ``job_id`` attribute (e.g. an
+                    array task) or a sequence of these
+    :return: List of unique job IDs
+    """
+    if dep_job is None:
+        return []
+    if isinstance(dep_job, (list, tuple, set)):
+        job_ids = [job_id for dep in dep_job for job_id in dep_job_ids(dep)]
+        return sorted(set(job_ids), key=job_ids.index)
+    if hasattr(dep_job, "job_id"):
+        dep_job = dep_job.job_id
+        if dep_job is None:
+            return []
+    return [str(dep_job)]
+
+def fsl_sub_job_id(stdout):
+    """
+    Get the job ID from the output of fsl_sub
+    """
+    stdout = stdout.strip()
+    if re.match(r"^\d+$", stdout):
+        return stdout
+    return get_job_id(stdout) or stdout
+
+def work_dir(outdir, *subdirs):
+    """
+    Get a directory for internal files in the output directory, creating it if required
+    """
+    dirpath = os.path.join(outdir, WORK_DIRNAME, *subdirs)
+    os.makedirs(dirpath, exist_ok=True)
+    return dirpath
+
+def set_local_executor(executor):
+    """
+    Set the executor used to run commands when not in cluster mode
+
+    :param executor: local.LocalExecutor instance, or None to run commands one at a
+                     time as they are submitted
+    """
+    global _LOCAL_EXECUTOR
+    _LOCAL_EXECUTOR = executor
+
+def submit_cmd(cmd, cluster, dep_job, minutes=5, ram=None, batch=None):
+    """
+    Run a command, or submit it to the cluster
+
+    :param cmd: Command as a sequence of arguments
+    :param cluster: If True, submit using fsl_sub. Otherwise pass the command to the local
+                    executor if one has been set, or run it immediately
+    :param dep_job: Job(s) which must complete before this command can run - see dep_job_ids
+    :param minutes: Expected run time in minutes
+    :param ram: Expected memory requirement in Mb
+    :param batch: Optional batch.TaskArray. If specified the command is added to the
+                  array rather than being submitted and the array task is returned
+
+    :return: Job ID of submitted command, if any
+    """
+    if batch is not None:
+        return batch.add(cmd, dep_job, minutes=minutes, ram=ram)
+
     if cluster:
-        sub_cmd = ["fsl_sub", "-T", str(minutes)]
-        if dep_job:
-            LOG.info(f"Dep job={dep_job}")
-            sub_cmd.extend(["-j", dep_job])
-        if ram:
-            LOG.info(f"RAM={ram} Mb")
-            sub_cmd.extend(["-R", str(ram)])
-
-        sub_cmd.extend(cmd)
-        LOG.info(" ".join(sub_cmd))
-        stdout = subprocess.check_output(sub_cmd)
+        sub_cmd = _fsl_sub_cmd(cmd, dep_job, minutes, ram)
+        with profiling.timer("fsl_sub", "submit"):
+            stdout = subprocess.check_output(sub_cmd)
+        profiling.count("subprocess_calls")
         stdout = stdout.decode("UTF-8")
         LOG.debug(stdout)
-        return stdout.strip()
+        return fsl_sub_job_id(stdout)
+    elif _LOCAL_EXECUTOR is not None:
+        return _LOCAL_EXECUTOR.submit(cmd, dep_job_ids(dep_job), minutes=minutes, ram=ram)
     else:
         LOG.info(" ".join(cmd))
-        stdout = subprocess.check_output(cmd)
+        with profiling.timer("run_cmd", "submit", cmd=cmd[0]):
+            stdout = subprocess.check_output(cmd)
+        profiling.count("subprocess_calls")
         stdout = stdout.decode("UTF-8")
         LOG.debug(stdout)
         return get_job_id(stdout)
 
+async def submit_cmd_async(cmd, dep_job, minutes=5, ram=None, semaphore=None):
+    """
+    Submit a command to the cluster using fsl_sub without blocking the event loop
+
+    :param semaphore: Optional asyncio.Semaphore limiting the number of concurrent fsl_sub calls
+    :return: Job ID of submitted command
+    """
+    import asyncio
+    sub_cmd = _fsl_sub_cmd(cmd, dep_job, minutes, ram)
+    semaphore = semaphore or asyncio.Semaphore(1)
+    async with semaphore:
+        with profiling.timer("fsl_sub", "submit"):
+            proc = await asyncio.create_subprocess_exec(*sub_cmd, stdout=asyncio.subprocess.PIPE)
+            stdout, _stderr = await proc.communicate()
+    profiling.count("subprocess_calls")
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, sub_cmd, stdout)
+    stdout = stdout.decode("UTF-8")
+    LOG.debug(stdout)
+    return fsl_sub_job_id(stdout)
+
+def _fsl_sub_cmd(cmd, dep_job, minutes, ram):
+    """
+    :return: fsl_sub command line to submit a command
+    """
+    sub_cmd = ["fsl_sub", "-T", str(minutes)]
+    dep_ids = dep_job_ids(dep_job)
+    if dep_ids:
+        LOG.info(f"Dep job={dep_ids}")
+        sub_cmd.extend(["-j", ",".join(dep_ids)])
+    if ram:
+        LOG.info(f"RAM={ram} Mb")
+        sub_cmd.extend(["-R", str(ram)])
+
+    sub_cmd.extend(cmd)
+    LOG.info(" ".join(sub_cmd))
+    return sub_cmd
+
 def bids_filename(suffix, subject, session, labeldict=None):
     """
     Get a BIDS style filename
@@ -54,7 +191,7 @@ def bids_filename(suffix, subject, session, labeldict=None):
     """
     fname = f"sub-{subject}"
     if session:
-        fname += f"_ses-%{session}"
+        fname += f"_ses-{session}"
     if labeldict:
         for key, value in labeldict.items():
             fname += f"_{key}-{value}"
@@ -74,14 +211,16 @@ def find_img(fname):
 
 def load_img(fname):
     """
-    Load an image
+    Load an image header and its JSON sidecar
+
+    Only the NIfTI header is read, see nifti.probe
 
-    :return: Tuple of nii structure, JSON metadata dictionary
+    :return: Tuple of nifti.HeaderInfo, JSON metadata dictionary
     """
-    nii = nib.load(fname)
+    info = nifti.probe(fname)
     json_filename = fname[:fname.index(".nii")] + ".json"
     with open(json_filename, "r") as f:
         metadata = json.load(f)
-    metadata["img_shape"] = nii.shape
+    metadata["img_shape"] = info.shape
 
-    return nii, metadata
+    return info, metadata
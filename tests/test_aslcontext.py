@@ -0,0 +1,121 @@
+"""
+Tests for interpretation of the ASL context
+"""
+import numpy as np
+import pytest
+
+from brc_bids import aslcontext
+from brc_bids.utils import IncompatabilityError
+
+def _interpret(types, timings=None):
+    return aslcontext.interpret(aslcontext.parse(types), timings)
+
+def _write(tmp_path, lines):
+    fname = str(tmp_path / "sub-01_aslcontext.tsv")
+    with open(fname, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return fname
+
+def test_read(tmp_path):
+    codes = aslcontext.read(_write(tmp_path, ["volume_type", "M0SCAN", "Label", "control", ""]))
+    assert list(codes) == [aslcontext.M0SCAN, aslcontext.LABEL, aslcontext.CONTROL]
+
+def test_read_no_header(tmp_path):
+    with pytest.raises(IncompatabilityError):
+        aslcontext.read(_write(tmp_path, ["label", "control"]))
+
+def test_parse_cbf():
+    with pytest.raises(IncompatabilityError, match="CBF"):
+        aslcontext.parse(["cbf", "label"])
+
+def test_parse_unknown():
+    with pytest.raises(IncompatabilityError, match="Unknown volume types"):
+        aslcontext.parse(["label", "tag"])
+
+def test_tc():
+    ctx = _interpret(["m0scan", "label", "control", "label", "control"])
+    assert (ctx.iaf, ctx.order) == ("tc", "tc")
+    assert list(ctx.asl_volumes) == [1, 2, 3, 4]
+    assert list(ctx.calib_volumes) == [0]
+    assert ctx.timings is None and ctx.ibf is None
+
+def test_ct():
+    ctx = _interpret(["control", "label"] * 3 + ["m0scan", "m0scan"])
+    assert (ctx.iaf, ctx.order) == ("ct", "ct")
+    assert list(ctx.asl_volumes) == list(range(6))
+    assert list(ctx.calib_volumes) == [6, 7]
+
+def test_control_perev():
+    ctx = _interpret(["label", "control(perev)"])
+    assert ctx.order == "tc"
+
+def test_tc_timings_per_volume_rpt():
+    # Per-volume timings including the calibration image, cycling through two PLDs
+    plds = [0, 1.0, 1.0, 2.0, 2.0, 1.0, 1.0, 2.0, 2.0]
+    ctx = _interpret(["m0scan"] + ["label", "control"] * 4, plds)
+    assert list(ctx.timings) == [1.0, 2.0]
+    assert ctx.ibf == "rpt" and ctx.rpts is None
+
+def test_tc_timings_per_pair_tis():
+    ctx = _interpret(["label", "control"] * 5, [1.0, 1.0, 1.0, 2.0, 2.0])
+    assert list(ctx.timings) == [1.0, 2.0]
+    assert ctx.ibf == "tis"
+    assert list(ctx.rpts) == [3, 2]
+
+def test_irregular_timings_not_deduplicated():
+    ctx = _interpret(["label", "control"] * 3, [1.0, 2.0, 1.0])
+    assert list(ctx.timings) == [1.0, 2.0, 1.0]
+    assert ctx.ibf is None
+
+def test_blocked():
+    ctx = _interpret(["m0scan", "label", "label", "label", "control", "control", "control"])
+    assert (ctx.iaf, ctx.order) == ("tc", "blocked")
+    assert list(ctx.asl_volumes) == [1, 4, 2, 5, 3, 6]
+    assert list(ctx.calib_volumes) == [0]
+
+def test_blocked_timings():
+    # Blocks of two labels and two controls, each block covering both PLDs
+    ctx = _interpret(["label", "label", "control", "control"] * 2, np.tile([1.0, 2.0], 4))
+    assert ctx.order == "blocked"
+    assert list(ctx.asl_volumes) == [0, 2, 1, 3, 4, 6, 5, 7]
+    assert list(ctx.timings) == [1.0, 2.0]
+    assert ctx.ibf == "rpt"
+
+def test_mixed_paired_by_timing():
+    types = ["label", "control", "control", "label", "label", "control"]
+    plds = [1.0, 2.0, 1.0, 2.0, 3.0, 3.0]
+    ctx = _interpret(types, plds)
+    assert (ctx.iaf, ctx.order) == ("tc", "mixed")
+    # Each label is paired with the control with the same PLD, in order of acquisition of the label
+    assert list(ctx.asl_volumes) == [0, 2, 3, 1, 4, 5]
+    assert list(ctx.timings) == [1.0, 2.0, 3.0]
+
+def test_mixed_unpaired_timings():
+    with pytest.raises(IncompatabilityError, match="Could not pair"):
+        _interpret(["label", "control", "control", "label"], [1.0, 2.0, 1.0, 3.0])
+
+def test_diff():
+    ctx = _interpret(["m0scan", "deltam", "deltam", "deltam"], [1.0, 2.0, 3.0])
+    assert (ctx.iaf, ctx.order) == ("diff", "diff")
+    assert list(ctx.asl_volumes) == [1, 2, 3]
+    assert list(ctx.timings) == [1.0, 2.0, 3.0]
+
+def test_single_diff():
+    ctx = _interpret(["deltam"])
+    assert ctx.iaf == "diff"
+
+def test_mixed_diff_and_label():
+    with pytest.raises(IncompatabilityError, match="mixed deltam"):
+        _interpret(["deltam", "label", "control"])
+
+def test_unequal_label_control():
+    with pytest.raises(IncompatabilityError, match="2 label images but 1 control"):
+        _interpret(["label", "control", "label"])
+
+def test_single_volume():
+    with pytest.raises(IncompatabilityError, match="Only one ASL volume"):
+        _interpret(["m0scan", "label"])
+
+def test_no_asl():
+    with pytest.raises(IncompatabilityError, match="No ASL data"):
+        _interpret(["m0scan", "m0scan"])
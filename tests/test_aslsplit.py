@@ -0,0 +1,75 @@
+"""
+Tests for splitting ASL data containing M0 volumes in the oxasl job
+"""
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+
+from brc_bids import oxasl
+
+def _options(asl_volumes):
+    return {"asl" : "/data/asl.nii.gz", "calib" : "/data/asl.nii.gz", "calib_volumes" : [0], "asl_volumes" : asl_volumes, "tr" : 4.0}
+
+def test_split_options(tmp_path):
+    options, split = oxasl._split_options(_options([1, 2, 3, 4]), str(tmp_path))
+    asl_out, calib_out = str(tmp_path / "asl.nii.gz"), str(tmp_path / "m0scan.nii.gz")
+    assert options == {"asl" : asl_out, "calib" : calib_out, "tr" : 4.0}
+    assert split == ("/data/asl.nii.gz", [1, 2, 3, 4], [0], asl_out, calib_out)
+    # Nothing is written until the job runs
+    assert os.listdir(str(tmp_path)) == []
+
+def test_split_options_reordered(tmp_path):
+    options, split = oxasl._split_options(_options([1, 3, 2, 4]), str(tmp_path))
+    assert options["asl_volumes"] == [0, 2, 1, 3]
+    assert split[1] == [1, 2, 3, 4]
+
+def test_split_options_separate_m0(tmp_path):
+    options = {"asl" : "/data/asl.nii.gz", "calib" : "/data/m0scan.nii.gz"}
+    assert oxasl._split_options(options, str(tmp_path)) == (options, None)
+
+def test_split_command():
+    split = ("/data/asl.nii.gz", [1, 2, 3], [0], "/out/asl.nii.gz", "/out/m0scan.nii.gz")
+    assert oxasl.get_split_command(*split) == [
+        "brc_bids", "aslsplit", "--input", "/data/asl.nii.gz", "--asl", "/out/asl.nii.gz", "--asl-volumes", "1,2,3",
+        "--calib", "/out/m0scan.nii.gz", "--calib-volumes", "0",
+    ]
+
+def test_cached_split_options(tmp_path):
+    asl_path = str(tmp_path / "asl.nii.gz")
+    open(asl_path, "w").close()
+    options = dict(_options([1, 2, 3, 4]), asl=asl_path, calib=asl_path)
+    first, split = oxasl._cached_split_options(options, str(tmp_path / "cache"))
+    # The cache directory depends only on the input and the volumes selected
+    assert oxasl._cached_split_options(options, str(tmp_path / "cache")) == (first, split)
+    assert os.path.dirname(first["asl"]).startswith(str(tmp_path / "cache") + os.sep)
+    other, _split = oxasl._cached_split_options(dict(options, calib_volumes=[0, 5]), str(tmp_path / "cache"))
+    assert os.path.dirname(other["asl"]) != os.path.dirname(first["asl"])
+
+    options = {"asl" : asl_path, "calib" : "/data/m0scan.nii.gz"}
+    assert oxasl._cached_split_options(options, str(tmp_path / "cache")) == (options, None)
+
+def test_run_split(tmp_path):
+    data = np.arange(2 * 2 * 2 * 5, dtype=np.float32).reshape((2, 2, 2, 5))
+    asl_path = str(tmp_path / "asl.nii.gz")
+    nib.save(nib.Nifti1Image(data, np.identity(4)), asl_path)
+    split_dir = tmp_path / "out" / "aslsplit"
+    asl_out, calib_out, shapes = str(split_dir / "asl.nii.gz"), str(split_dir / "m0scan.nii.gz"), str(tmp_path / "shapes.txt")
+
+    script = f"import nibabel as nib; open({shapes!r}, 'w').write(str(nib.load({asl_out!r}).shape) + str(nib.load({calib_out!r}).get_fdata()[0, 0, 0]))"
+    assert oxasl.run_split([sys.executable, "-c", script], asl_path, [1, 2, 3, 4], [0], asl_out, calib_out) == 0
+    with open(shapes) as f:
+        assert f.read() == "(2, 2, 2, 4)0.0"
+
+    # The split images are kept and reused by later runs
+    os.utime(asl_out, ns=(0, 0))
+    assert oxasl.run_split([sys.executable, "-c", script], asl_path, [1, 2, 3, 4], [0], asl_out, calib_out) == 0
+    assert os.stat(asl_out).st_mtime_ns == 0
+
+def test_run_split_failed(tmp_path):
+    data = np.zeros((2, 2, 2, 3), dtype=np.float32)
+    asl_path = str(tmp_path / "asl.nii")
+    nib.save(nib.Nifti1Image(data, np.identity(4)), asl_path)
+    asl_out, calib_out = str(tmp_path / "split" / "asl.nii"), str(tmp_path / "split" / "m0scan.nii")
+    assert oxasl.run_split([sys.executable, "-c", "raise SystemExit(2)"], asl_path, [1, 2], [0], asl_out, calib_out) == 2
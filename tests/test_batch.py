@@ -0,0 +1,78 @@
+"""
+Tests for fsl_sub array job submission
+"""
+import itertools
+
+import pytest
+
+from brc_bids import batch
+
+@pytest.fixture
+def fsl_sub(monkeypatch):
+    """
+    Replace fsl_sub with a fake returning incrementing job IDs
+
+    :return: List of fsl_sub commands run
+    """
+    calls, job_ids = [], itertools.count(100)
+    def check_output(cmd):
+        calls.append(cmd)
+        return f"{next(job_ids)}\n".encode("UTF-8")
+    monkeypatch.setattr(batch.subprocess, "check_output", check_output)
+    return calls
+
+def _read_tasks(taskfile):
+    with open(taskfile) as f:
+        return f.read().splitlines()
+
+def test_independent_array(tmp_path, fsl_sub):
+    array = batch.TaskArray("a", str(tmp_path))
+    for idx in range(3):
+        array.add(["cmd", str(idx)])
+    assert array.submit(cluster=True) == "100"
+    assert "--array_hold" not in fsl_sub[0]
+    assert _read_tasks(fsl_sub[0][-1]) == ["cmd 0", "cmd 1", "cmd 2"]
+
+def test_aligned_array(tmp_path, fsl_sub):
+    a = batch.TaskArray("a", str(tmp_path))
+    a_tasks = [a.add(["a", str(idx)]) for idx in range(3)]
+    a.submit(cluster=True)
+
+    b = batch.TaskArray("b", str(tmp_path))
+    b.add(["b", "0"], dep_job=a_tasks[0])
+    b.add(["b", "2"], dep_job=a_tasks[2])
+    b.submit(cluster=True)
+    assert fsl_sub[1][fsl_sub[1].index("--array_hold") + 1] == "100"
+    assert _read_tasks(fsl_sub[1][-1]) == ["b 0", batch.NOOP_TASK, "b 2"]
+
+def test_chained_aligned_arrays(tmp_path, fsl_sub):
+    a = batch.TaskArray("a", str(tmp_path))
+    a_tasks = [a.add(["a", str(idx)]) for idx in range(3)]
+    a.submit(cluster=True)
+
+    b = batch.TaskArray("b", str(tmp_path))
+    b_tasks = [b.add(["b", "0"], dep_job=a_tasks[0]), b.add(["b", "2"], dep_job=a_tasks[2])]
+    b.submit(cluster=True)
+
+    # c is aligned with b, whose tasks have been placed at indices 0 and 2
+    c = batch.TaskArray("c", str(tmp_path))
+    c.add(["c", "2"], dep_job=b_tasks[1])
+    c.add(["c", "0"], dep_job=b_tasks[0])
+    assert c.submit(cluster=True) == "102"
+    assert fsl_sub[2][fsl_sub[2].index("--array_hold") + 1] == "101"
+    assert _read_tasks(fsl_sub[2][-1]) == ["c 0", batch.NOOP_TASK, "c 2"]
+
+def test_multiple_parents_hold_on_jobs(tmp_path, fsl_sub):
+    a = batch.TaskArray("a", str(tmp_path))
+    a_task = a.add(["a"])
+    a.submit(cluster=True)
+    b = batch.TaskArray("b", str(tmp_path))
+    b_task = b.add(["b"])
+    b.submit(cluster=True)
+
+    c = batch.TaskArray("c", str(tmp_path))
+    c.add(["c", "0"], dep_job=a_task)
+    c.add(["c", "1"], dep_job=b_task)
+    c.submit(cluster=True)
+    assert "--array_hold" not in fsl_sub[2]
+    assert fsl_sub[2][fsl_sub[2].index("-j") + 1] == "100,101"
@@ -0,0 +1,26 @@
+"""
+Tests for the command converting oxasl output to BIDS
+"""
+import argparse
+import shlex
+
+from brc_bids import oxasl
+from brc_bids.__main__ import BidsoutArgumentParser
+
+def test_output_as_bids_command(tmp_path):
+    args = argparse.Namespace(bidsdir=str(tmp_path / "ds"), output=str(tmp_path / "out"), bids_output=None)
+    configs = [
+        {"subject" : "01", "session" : "1", "options" : {"output" : str(tmp_path / "out" / "01_1" / "oxasl")}},
+        {"subject" : "02", "session" : None, "options" : {"output" : str(tmp_path / "out" / "02_None" / "oxasl")}},
+    ]
+    cmd = shlex.split(oxasl.get_output_as_bids_command(args, configs))
+    assert cmd[:2] == ["brc_bids", "bidsout"]
+
+    # The command must be accepted by brc_bids bidsout and list every output
+    parsed = BidsoutArgumentParser().parse_args(cmd[2:])
+    assert parsed.bidsdir == str(tmp_path / "ds")
+    outputs = oxasl.read_outputs_manifest(parsed.manifest)
+    assert [(output["oxasl_dir"], output["subject"], output["session"]) for output in outputs] == [
+        (configs[0]["options"]["output"], "01", "1"),
+        (configs[1]["options"]["output"], "02", None),
+    ]
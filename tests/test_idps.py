@@ -0,0 +1,21 @@
+"""
+Tests for IDP extraction commands
+"""
+import os
+
+from brc_bids import idps
+
+def test_write_list(tmp_path):
+    fname = str(tmp_path / "subjs.txt")
+    assert idps._write_list(fname, ["01_1", "02_1"]) == fname
+    with open(fname) as f:
+        assert f.read() == "01_1\n02_1\n"
+
+    # Unchanged list is not rewritten
+    os.utime(fname, ns=(0, 0))
+    idps._write_list(fname, ["01_1", "02_1"])
+    assert os.stat(fname).st_mtime_ns == 0
+
+    idps._write_list(fname, ["01_1"])
+    with open(fname) as f:
+        assert f.read() == "01_1\n"
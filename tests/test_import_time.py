@@ -0,0 +1,25 @@
+"""
+Tests that the command line entry points do not import heavy dependencies
+
+Entry points such as ``brc_bids bidsout`` and ``brc_bids status`` may be run once per
+session as cluster tasks, so they must not pay for importing pybids and friends until
+they actually need them.
+"""
+import subprocess
+import sys
+
+import pytest
+
+# Modules imported when starting each entry point
+ENTRY_MODULES = ["brc_bids.__main__", "brc_bids.oxasl", "brc_bids.status"]
+
+# Dependencies which are slow to import and must only be imported when needed
+HEAVY_MODULES = ["bids", "nibabel", "numpy", "pandas", "sqlalchemy"]
+
+@pytest.mark.parametrize("module", ENTRY_MODULES)
+def test_no_heavy_imports(module):
+    # A fresh interpreter is needed since other tests import these modules
+    code = f"import sys, {module}; print(' '.join(sorted(sys.modules)))"
+    result = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, check=True)
+    imported = set([name.split(".")[0] for name in result.stdout.decode("UTF-8").split()])
+    assert sorted(imported & set(HEAVY_MODULES)) == []
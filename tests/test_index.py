@@ -0,0 +1,197 @@
+"""
+Tests for indexing and grouping the files in a BIDS dataset
+"""
+import json
+import os
+
+import pytest
+
+from brc_bids import index
+
+SUFFIXES = ("T1w", "asl")
+
+def _touch(path, content=b""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+@pytest.fixture
+def bidsdir(tmp_path):
+    """
+    Dataset with two subjects, each with two sessions containing a T1w and an ASL image
+    """
+    root = tmp_path / "ds"
+    _touch(str(root / "dataset_description.json"), json.dumps({"Name" : "test", "BIDSVersion" : "1.6.0"}).encode("utf-8"))
+    for subj in ("01", "02"):
+        for sess in ("1", "2"):
+            sessdir = root / f"sub-{subj}" / f"ses-{sess}"
+            _touch(str(sessdir / "anat" / f"sub-{subj}_ses-{sess}_T1w.nii.gz"))
+            _touch(str(sessdir / "perf" / f"sub-{subj}_ses-{sess}_asl.nii.gz"))
+    return str(root)
+
+def _summary(grouped):
+    """
+    :return: Dict mapping (subject, session) to dict of suffix to file names
+    """
+    return {
+        (subj, sess) : {suffix : [os.path.basename(record.path) for record in files] for suffix, files in session_files.items()}
+        for subj, subj_sessions in grouped.items()
+        for sess, session_files in subj_sessions.items()
+    }
+
+def test_group_files(bidsdir):
+    grouped = _summary(index.group_files(index.get_layout(bidsdir), SUFFIXES))
+    assert sorted(grouped) == [("01", "1"), ("01", "2"), ("02", "1"), ("02", "2")]
+    for (subj, sess), files in grouped.items():
+        assert files == {"T1w" : [f"sub-{subj}_ses-{sess}_T1w.nii.gz"], "asl" : [f"sub-{subj}_ses-{sess}_asl.nii.gz"]}
+
+def test_group_files_sessions(bidsdir):
+    grouped = _summary(index.group_files(index.get_layout(bidsdir), SUFFIXES, sessions=["2"]))
+    assert sorted(grouped) == [("01", "2"), ("02", "2")]
+    assert grouped[("02", "2")]["T1w"] == ["sub-02_ses-2_T1w.nii.gz"]
+
+def test_group_files_subjects_and_sessions(bidsdir):
+    grouped = _summary(index.group_files(index.get_layout(bidsdir), SUFFIXES, subjects=["02"], sessions=["1", "2"]))
+    assert sorted(grouped) == [("02", "1"), ("02", "2")]
+
+def test_layout_sessions_not_indexed(bidsdir, tmp_path):
+    layout = index.get_layout(bidsdir, str(tmp_path / "out"), sessions=["1"])
+    assert sorted(layout.get_sessions()) == ["1"]
+    grouped = _summary(index.group_files(layout, SUFFIXES, sessions=["1"]))
+    assert sorted(grouped) == [("01", "1"), ("02", "1")]
+
+    # A different selection has its own index
+    layout = index.get_layout(bidsdir, str(tmp_path / "out"), subjects=["02"], sessions=["2"])
+    assert layout.get_subjects() == ["02"] and layout.get_sessions() == ["2"]
+
+@pytest.fixture
+def layout_calls(monkeypatch):
+    """
+    Record whether each BIDSLayout created rebuilt its database, and the directories
+    which were re-scanned for the snapshot
+
+    :return: Dict with lists of reset_database values and scanned directories
+    """
+    import bids
+    calls = {"reset" : [], "scanned" : []}
+    layout_cls, scan_dir = bids.BIDSLayout, index._scan_dir
+    def _layout(*args, **kwargs):
+        calls["reset"].append(kwargs.get("reset_database", None))
+        return layout_cls(*args, **kwargs)
+    def _scan(conn, dirpath, *args, **kwargs):
+        calls["scanned"].append(dirpath)
+        return scan_dir(conn, dirpath, *args, **kwargs)
+    monkeypatch.setattr(bids, "BIDSLayout", _layout)
+    monkeypatch.setattr(index, "_scan_dir", _scan)
+    return calls
+
+def test_layout_index_reused(bidsdir, tmp_path, layout_calls):
+    outdir = str(tmp_path / "out")
+    index.get_layout(bidsdir, outdir)
+    assert os.path.isfile(os.path.join(outdir, index.INDEX_DIRNAME, "snapshot.sqlite"))
+    assert layout_calls["reset"] == [True]
+
+    layout_calls["scanned"].clear()
+    layout = index.get_layout(bidsdir, outdir)
+    assert layout_calls["reset"] == [True, False]
+    assert layout_calls["scanned"] == []
+    assert len(layout.get(suffix="T1w", extension=".nii.gz")) == 4
+
+def test_layout_index_changes(bidsdir, tmp_path, layout_calls):
+    outdir = str(tmp_path / "out")
+    index.get_layout(bidsdir, outdir)
+    sessdir = os.path.join(bidsdir, "sub-01", "ses-1", "anat")
+
+    added = os.path.join(sessdir, "sub-01_ses-1_run-2_T1w.nii.gz")
+    _touch(added)
+    layout_calls["scanned"].clear()
+    layout = index.get_layout(bidsdir, outdir)
+    assert layout_calls["reset"][-1] is True
+    # Only the changed directory is re-scanned
+    assert layout_calls["scanned"] == [sessdir]
+    assert added in [f.path for f in layout.get(subject="01", session="1", suffix="T1w")]
+
+    os.remove(added)
+    layout = index.get_layout(bidsdir, outdir)
+    assert layout_calls["reset"][-1] is True
+    assert added not in [f.path for f in layout.get(subject="01", session="1", suffix="T1w")]
+
+    index.get_layout(bidsdir, outdir)
+    assert layout_calls["reset"][-1] is False
+
+def test_layout_index_selection(bidsdir, tmp_path, layout_calls):
+    outdir = str(tmp_path / "out")
+    index.get_layout(bidsdir, outdir)
+    layout = index.get_layout(bidsdir, outdir, subjects=["02"])
+    # A selection is indexed in its own subdirectory, leaving the full index alone
+    assert layout_calls["reset"] == [True, True]
+    assert layout.get_subjects() == ["02"]
+    subdirs = [name for name in os.listdir(os.path.join(outdir, index.INDEX_DIRNAME)) if name.startswith("subjects-")]
+    assert len(subdirs) == 1
+    assert os.path.isfile(os.path.join(outdir, index.INDEX_DIRNAME, subdirs[0], "snapshot.sqlite"))
+
+    index.get_layout(bidsdir, outdir, subjects=["02"])
+    layout = index.get_layout(bidsdir, outdir)
+    assert layout_calls["reset"] == [True, True, False, False]
+    assert layout.get_subjects() == ["01", "02"]
+
+def test_iter_session_files_order(bidsdir):
+    keys = [(s.subject, s.session) for s in index.iter_session_files(index.get_layout(bidsdir), SUFFIXES)]
+    assert keys == [("01", "1"), ("01", "2"), ("02", "1"), ("02", "2")]
+
+def test_iter_session_files_streamed(bidsdir, monkeypatch):
+    # Sessions of the first subject are yielded before later subjects are grouped
+    grouped_subjects = []
+    subject_session_files = index._subject_session_files
+    def _grouped(file_entities, *args):
+        grouped_subjects.extend(sorted(set([entities["subject"] for entities in file_entities.values()])))
+        return subject_session_files(file_entities, *args)
+    monkeypatch.setattr(index, "_subject_session_files", _grouped)
+
+    session_files = index.iter_session_files(index.get_layout(bidsdir), SUFFIXES)
+    first = next(session_files)
+    assert (first.subject, first.session) == ("01", "1")
+    assert grouped_subjects == ["01"]
+    assert [(s.subject, s.session) for s in session_files] == [("01", "2"), ("02", "1"), ("02", "2")]
+    assert grouped_subjects == ["01", "02"]
+
+def test_iter_session_files_filters(bidsdir):
+    layout = index.get_layout(bidsdir)
+    keys = [(s.subject, s.session) for s in index.iter_session_files(layout, SUFFIXES, subjects=["02"], sessions=["1"])]
+    assert keys == [("02", "1")]
+    assert list(index.iter_session_files(layout, SUFFIXES, subjects=["03"])) == []
+
+def test_iter_session_files_no_sessions(bidsdir):
+    _touch(os.path.join(bidsdir, "sub-03", "anat", "sub-03_T1w.nii.gz"))
+    session_files = list(index.iter_session_files(index.get_layout(bidsdir, reset=True), SUFFIXES))
+    assert [(s.subject, s.session) for s in session_files][-1] == ("03", None)
+    assert [os.path.basename(record.path) for record in session_files[-1]["T1w"]] == ["sub-03_T1w.nii.gz"]
+    assert session_files[-1]["asl"] == ()
+
+def test_iter_session_files_associations(bidsdir):
+    # Associated files in the subject directory and at the top level
+    _touch(os.path.join(bidsdir, "asl.json"), b'{"M0Type" : "Separate"}')
+    _touch(os.path.join(bidsdir, "sub-02", "ses-1", "perf", "sub-02_ses-1_asl.json"), b"{}")
+    session_files = {(s.subject, s.session) : s for s in index.iter_session_files(index.get_layout(bidsdir, reset=True), SUFFIXES)}
+    assocs = {key : [(a.filename, a.entities.get("suffix")) for a in s["asl"][0].associations] for key, s in session_files.items()}
+    assert assocs[("02", "1")] == [("sub-02_ses-1_asl.json", "asl")]
+    assert assocs[("01", "1")] == [("asl.json", "asl")]
+    # Records for top level files are shared between subjects
+    assert session_files[("01", "1")]["asl"][0].associations[0] is session_files[("02", "2")]["asl"][0].associations[0]
+
+def test_iter_session_files_queries(bidsdir):
+    # The number of database queries does not depend on the number of subjects
+    from sqlalchemy import event
+    for subj in ("03", "04"):
+        _touch(os.path.join(bidsdir, f"sub-{subj}", "ses-1", "perf", f"sub-{subj}_ses-1_asl.nii.gz"))
+    layout = index.get_layout(bidsdir)
+    statements = []
+    def _execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = layout.session.get_bind()
+    event.listen(engine, "before_cursor_execute", _execute)
+    try:
+        assert len(list(index.iter_session_files(layout, SUFFIXES))) == 6
+    finally:
+        event.remove(engine, "before_cursor_execute", _execute)
+    assert len(statements) == 3
@@ -0,0 +1,43 @@
+"""
+Tests for the ledger of submitted jobs
+"""
+import os
+
+from brc_bids import ledger, utils
+
+def _entries(run_id, key, stage, jobs):
+    cmds = [["cmd", str(idx)] for idx in range(len(jobs))]
+    markers = [f"/out/{key}.{stage}.{idx}.done" for idx in range(len(jobs))]
+    return ledger.entries(run_id, key, stage, cmds, jobs, markers, True)
+
+def test_latest_supersedes_earlier_runs():
+    entries = _entries("run1", "01_1", "struc", ["100", "101"]) + _entries("run1", "01_1", "dwi", ["102"])
+    # The resubmitted stage now has fewer commands
+    entries += _entries("run2", "01_1", "struc", ["200"])
+    latest = ledger.latest(entries)
+    assert sorted(latest) == [("01_1", "dwi", 0), ("01_1", "struc", 0)]
+    assert latest[("01_1", "struc", 0)]["job"] == "200"
+    assert latest[("01_1", "dwi", 0)]["job"] == "102"
+
+def test_latest_sessions_independent():
+    entries = _entries("run1", "01_1", "struc", ["100"]) + _entries("run1", "02_1", "struc", ["101"])
+    entries += _entries("run2", "02_1", "struc", ["200"])
+    latest = ledger.latest(entries)
+    assert latest[("01_1", "struc", 0)]["job"] == "100"
+    assert latest[("02_1", "struc", 0)]["job"] == "200"
+
+def test_read_append(tmp_path):
+    outdir = str(tmp_path)
+    assert ledger.read(outdir) == []
+    entries = _entries("run1", "01_1", "struc", ["100", None])
+    ledger.append(outdir, entries)
+    ledger.append(outdir, [])
+    assert ledger.read(outdir) == entries
+
+def test_read_truncated(tmp_path):
+    outdir = str(tmp_path)
+    entries = _entries("run1", "01_1", "struc", ["100"])
+    ledger.append(outdir, entries)
+    with open(os.path.join(outdir, utils.WORK_DIRNAME, ledger.LEDGER_FILENAME), "a") as f:
+        f.write('{"run" : "run2", "key" : "01')
+    assert ledger.read(outdir) == entries
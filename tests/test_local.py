@@ -0,0 +1,46 @@
+"""
+Tests for the local concurrent executor
+"""
+import sys
+import threading
+
+from brc_bids import local
+
+def _wait(executor, timeout=10):
+    """
+    Wait for an executor in a separate thread so a hang fails the test instead of blocking it
+    """
+    errors = []
+    def wait():
+        try:
+            executor.wait()
+        except Exception as exc:
+            errors.append(exc)
+    thread = threading.Thread(target=wait, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "LocalExecutor.wait() did not return"
+    return errors
+
+def test_dependencies(tmp_path):
+    executor = local.LocalExecutor(jobs=2)
+    out = tmp_path / "out.txt"
+    first = executor.submit([sys.executable, "-c", f"open({str(out)!r}, 'w').write('1')"])
+    executor.submit([sys.executable, "-c", f"assert open({str(out)!r}).read() == '1'"], dep_job=[first])
+    assert _wait(executor) == []
+
+def test_failed_dependency_skipped():
+    executor = local.LocalExecutor(jobs=2)
+    first = executor.submit([sys.executable, "-c", "raise SystemExit(1)"])
+    executor.submit([sys.executable, "-c", "pass"], dep_job=[first])
+    errors = _wait(executor)
+    assert len(errors) == 1 and "2 local jobs failed" in str(errors[0])
+
+def test_unexpected_exception_fails_job(monkeypatch):
+    executor = local.LocalExecutor(jobs=1)
+    def run(job):
+        raise ValueError("unexpected")
+    monkeypatch.setattr(executor, "_run", run)
+    executor.submit(["true"])
+    errors = _wait(executor)
+    assert len(errors) == 1 and "1 local jobs failed" in str(errors[0])
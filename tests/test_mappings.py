@@ -0,0 +1,101 @@
+"""
+Tests for mapping BIDS metadata to pipeline options
+"""
+import copy
+import logging
+
+import numpy as np
+import pytest
+
+from brc_bids import mappings
+
+ASL_METADATA = {
+    "ArterialSpinLabelingType" : "PCASL",
+    "PostLabelingDelay" : 1.8,
+    "LabelingDuration" : 1.8,
+}
+
+def test_slice_timing():
+    metadata = dict(ASL_METADATA, SliceTiming=[0.0, 0.05, 0.1, 0.15])
+    options = mappings.options_from_metadata(metadata, "asl")
+    assert options["slicedt"] == pytest.approx(0.05)
+    assert "sliceband" not in options
+
+def test_slice_timing_multiband():
+    metadata = dict(ASL_METADATA, SliceTiming=[0.0, 0.05, 0.1] * 2)
+    options = mappings.options_from_metadata(metadata, "asl")
+    assert options["slicedt"] == pytest.approx(0.05)
+    assert options["sliceband"] == 3
+
+def test_slice_timing_irregular_warns_once(caplog):
+    metadata = dict(ASL_METADATA, SliceTiming=[0.0, 0.0, 0.05, 0.1])
+    with caplog.at_level(logging.WARN, logger="brc_bids.mappings"):
+        options = mappings.options_from_metadata(metadata, "asl")
+    assert "sliceband" not in options
+    assert len([record for record in caplog.records if "multiband" in record.getMessage()]) == 1
+
+def test_no_slice_timing():
+    options = mappings.options_from_metadata(ASL_METADATA, "asl")
+    assert "slicedt" not in options and "sliceband" not in options
+    assert options["casl"] is True
+    assert list(options["plds"]) == [1.8]
+    assert options["bolus"] == 1.8
+
+def _reference_options(metadata, filetype, **extra_metadata):
+    """
+    Mapping as done before plans were compiled, applying METADATA_MAPPINGS directly
+    to a merged copy of the metadata
+    """
+    config = {}
+    metadata = dict(metadata)
+    metadata.update(extra_metadata)
+    for option_key, md_key in mappings.METADATA_MAPPINGS[filetype]:
+        val = None
+        if type(md_key) is str and md_key in metadata:
+            val = metadata.get(md_key)
+        elif callable(md_key):
+            val = md_key(metadata, config)
+        if val is not None:
+            config[option_key] = val
+    return config
+
+def _assert_same_options(options, expected):
+    assert sorted(options) == sorted(expected)
+    for key, val in expected.items():
+        assert np.array_equal(options[key], val)
+
+PLAN_CASES = [
+    ("asl", ASL_METADATA, {}),
+    ("asl", dict(ASL_METADATA, SliceTiming=[0.0, 0.05, 0.1] * 2, EchoTime=0.012, VascularCrushing=False), {}),
+    ("asl", {"ArterialSpinLabelingType" : "PASL", "PostLabelingDelay" : [1.0, 1.5], "BolusCutOffTimingSequence" : 0.7}, {}),
+    ("asl", dict(ASL_METADATA, InitialPostLabelDelay=1.5), {"PostLabelingDelay" : 2.0}),
+    ("calib", {"RepetitionTime" : 5.0, "EchoTime" : 0.012}, {}),
+    ("calib", {"RepetitionTimePreparation" : 4.0, "RepetitionTime" : 5.0}, {"img_shape" : (64, 64, 20)}),
+    ("calib", {"RepetitionTime" : None}, {}),
+    ("cblip", {"TotalReadoutTime" : 0.063, "PhaseEncodingDirection" : "j-"}, {"img_shape" : (64, 64, 20)}),
+    ("cblip", {"EffectiveEchoSpacing" : 0.0005, "PhaseEncodingDirection" : "i"}, {}),
+    ("dwi", {"EffectiveEchoSpacing" : 0.0005, "PhaseEncodingDirection" : "k"}, {"EffectiveEchoSpacing" : 0.0007}),
+    ("struct", {"EchoTime" : 0.003}, {}),
+]
+
+@pytest.mark.parametrize("filetype, metadata, extra", PLAN_CASES)
+def test_plan_matches_mappings(filetype, metadata, extra):
+    original = copy.deepcopy(metadata)
+    options = mappings.options_from_metadata(metadata, filetype, **extra)
+    _assert_same_options(options, _reference_options(metadata, filetype, **extra))
+    # The metadata is not copied, so must not be modified
+    assert metadata == original
+
+@pytest.mark.parametrize("filetype", sorted(mappings.METADATA_MAPPINGS))
+def test_plan_batch(filetype):
+    cases = [(metadata, extra) for case_filetype, metadata, extra in PLAN_CASES if case_filetype == filetype and not extra]
+    batch = mappings.options_from_metadata_batch([metadata for metadata, _extra in cases], filetype)
+    assert len(batch) == len(cases)
+    for options, (metadata, _extra) in zip(batch, cases):
+        _assert_same_options(options, _reference_options(metadata, filetype))
+
+def test_compile_mappings():
+    def func(metadata, options):
+        return 1
+    plan = mappings.compile_mappings([("a", None), ("b", "KeyB"), ("c", func), (None, func)])
+    assert plan == (("b", "KeyB", None), ("c", None, func), (None, None, func))
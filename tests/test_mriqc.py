@@ -0,0 +1,75 @@
+"""
+Tests for running MRIQC as per-session participant jobs and a group job
+"""
+import argparse
+import itertools
+import os
+
+import pytest
+
+from brc_bids import mriqc, pipeline, records, utils
+
+@pytest.fixture
+def fsl_sub(monkeypatch):
+    """
+    Replace fsl_sub with a fake returning incrementing job IDs
+
+    :return: List of fsl_sub commands run
+    """
+    calls, job_ids = [], itertools.count(100)
+    def check_output(cmd):
+        calls.append(cmd)
+        return f"{next(job_ids)}\n".encode("UTF-8")
+    monkeypatch.setattr(utils.subprocess, "check_output", check_output)
+    return calls
+
+def _session(bidsdir, subject, session):
+    path = os.path.join(bidsdir, f"sub-{subject}", f"ses-{session}", "anat", f"sub-{subject}_ses-{session}_T1w.nii.gz")
+    return records.SessionFiles(subject, session, {"T1w" : [records.FileRecord(path, {"subject" : subject, "session" : session})]})
+
+def test_participant_cmd(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cmd = mriqc.participant_cmd("ds", "out", "01", "1")
+    assert cmd[:4] == ["singularity", "run", "--cleanenv", mriqc.SINGULARITY_IMAGE]
+    assert cmd[4:7] == [str(tmp_path / "ds"), str(tmp_path / "out"), "participant"]
+    assert cmd[cmd.index("--participant-label") + 1] == "01"
+    assert cmd[cmd.index("--session-id") + 1] == "1"
+    assert cmd[cmd.index("--mem_gb") + 1] == str(mriqc.RAM // 1000)
+    assert "--no-sub" in cmd
+
+    # Each session has its own work directory
+    workdir = cmd[cmd.index("-w") + 1]
+    assert os.path.isabs(workdir)
+    assert workdir != mriqc.participant_cmd("ds", "out", "01", "2")[cmd.index("-w") + 1]
+
+def test_participant_cmd_no_session(tmp_path):
+    cmd = mriqc.participant_cmd(str(tmp_path / "ds"), str(tmp_path / "out"), "01")
+    assert "--session-id" not in cmd
+
+def test_group_cmd(tmp_path):
+    cmd = mriqc.group_cmd(str(tmp_path / "ds"), str(tmp_path / "out"))
+    assert cmd[4:] == [str(tmp_path / "ds"), str(tmp_path / "out"), "group", "--no-sub"]
+    assert mriqc.get_group_cmds(str(tmp_path / "ds"), str(tmp_path / "out")) == [cmd]
+
+def test_get_cmds(tmp_path):
+    bidsdir = str(tmp_path / "ds")
+    cmds = mriqc.get_cmds("01", "1", _session(bidsdir, "01", "1"), str(tmp_path / "out"))
+    assert cmds == [mriqc.participant_cmd(bidsdir, str(tmp_path / "out"), "01", "1")]
+    assert mriqc.get_cmds("01", "1", records.SessionFiles("01", "1", {"T1w" : []}), str(tmp_path / "out")) == []
+
+def test_group_fan_in(tmp_path, fsl_sub):
+    bidsdir, outdir = str(tmp_path / "ds"), str(tmp_path / "out")
+    args = argparse.Namespace(output=outdir, bidsdir=bidsdir, cluster=True, array=False, submit_concurrency=1,
+                              incremental=False, local_scratch=False, scratch_dir=None)
+    sessions = [_session(bidsdir, subject, session) for subject, session in (("01", "1"), ("01", "2"), ("02", "1"))]
+    session_jobs = pipeline.run(args, sessions, pipeline.get_stages(["mriqc", "mriqcgroup"]))
+
+    # One participant job for each session, then a single group job holding on all of them
+    assert len(fsl_sub) == 4
+    participant_jobs = sorted([jobs["mriqc"] for jobs in session_jobs.values()])
+    assert participant_jobs == ["100", "101", "102"]
+    group = fsl_sub[-1]
+    assert "group" in group[-1]
+    assert sorted(group[group.index("-j") + 1].split(",")) == participant_jobs
+    assert group[group.index("-T") + 1] == str(mriqc.GROUP_MINUTES)
+    assert group[group.index("-R") + 1] == str(mriqc.GROUP_RAM)
@@ -0,0 +1,78 @@
+"""
+Tests for reading NIfTI headers without loading the image, checked against nibabel
+"""
+import json
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from brc_bids import nifti, utils
+
+SHAPE = (4, 5, 6, 3)
+
+QFORM = np.array([
+    [0, -2.0, 0, 10],
+    [1.5, 0, 0, -20],
+    [0, 0, 2.5, 30],
+    [0, 0, 0, 1],
+])
+
+SFORM = np.array([
+    [1.9, 0.1, 0, -90],
+    [0, 2.1, 0.2, -126],
+    [0.1, 0, 2.2, -72],
+    [0, 0, 0, 1],
+])
+
+def _save(fname, cls, qform=None, sform=None, endianness="<"):
+    img = cls(np.zeros(SHAPE, dtype=np.int16), None, cls.header_class(endianness=endianness))
+    img.set_qform(qform, code=1 if qform is not None else 0)
+    img.set_sform(sform, code=2 if sform is not None else 0)
+    if qform is None and sform is None:
+        img.header.set_zooms((1.5, 2.0, 2.5, 3.0))
+    nib.save(img, fname)
+    return nib.load(fname)
+
+@pytest.mark.parametrize("cls", [nib.Nifti1Image, nib.Nifti2Image])
+@pytest.mark.parametrize("ext", [".nii", ".nii.gz"])
+@pytest.mark.parametrize("qform, sform", [(QFORM, None), (None, SFORM), (QFORM, SFORM), (None, None)],
+                         ids=["qform", "sform", "both", "neither"])
+def test_probe_matches_nibabel(tmp_path, cls, ext, qform, sform):
+    fname = str(tmp_path / f"img{ext}")
+    img = _save(fname, cls, qform, sform)
+    info = nifti.probe(fname)
+    assert info.shape == img.shape
+    assert info.header_size == img.header.sizeof_hdr
+    assert info.vox_offset == img.dataobj.offset
+    np.testing.assert_allclose(info.affine, img.header.get_best_affine(), atol=1e-5)
+
+def test_probe_big_endian(tmp_path):
+    fname = str(tmp_path / "img.nii.gz")
+    img = _save(fname, nib.Nifti1Image, QFORM, endianness=">")
+    info = nifti.probe(fname)
+    assert info.shape == img.shape
+    np.testing.assert_allclose(info.affine, img.affine, atol=1e-5)
+
+def test_probe_cached(tmp_path):
+    fname = str(tmp_path / "img.nii")
+    _save(fname, nib.Nifti1Image, QFORM)
+    info = nifti.probe(fname)
+    assert nifti.probe(fname) is info
+
+    # Rewriting the image invalidates the cached header
+    nib.save(nib.Nifti1Image(np.zeros((2, 3, 4), dtype=np.int16), QFORM), fname)
+    assert nifti.probe(fname).shape == (2, 3, 4)
+
+def test_parse_header_invalid():
+    with pytest.raises(ValueError):
+        nifti.parse_header(b"\0" * nifti.NIFTI1_HEADER_SIZE)
+
+def test_load_img(tmp_path):
+    fname = str(tmp_path / "sub-01_asl.nii.gz")
+    _save(fname, nib.Nifti1Image, sform=SFORM)
+    with open(str(tmp_path / "sub-01_asl.json"), "w") as f:
+        json.dump({"RepetitionTime" : 4.0}, f)
+    info, metadata = utils.load_img(fname)
+    assert metadata == {"RepetitionTime" : 4.0, "img_shape" : SHAPE}
+    np.testing.assert_allclose(info.affine, SFORM, atol=1e-5)
@@ -0,0 +1,23 @@
+"""
+Tests for the oxasl command line
+"""
+import shlex
+
+import numpy as np
+
+from brc_bids import oxasl
+
+def test_oxasl_command():
+    options = {"asl" : "/data/asl.nii.gz", "plds" : np.array([0.25, 0.5]), "casl" : True, "bolus" : 1.8,
+               "tes" : [0.01], "cmethod" : None, "ibf" : "rpt", "output" : "/out/01_1/oxasl"}
+    assert oxasl.get_oxasl_command(options, ["--overwrite"]) == [
+        "oxasl", "-i", "/data/asl.nii.gz", "--plds", "0.25,0.5", "--casl", "--bolus", "1.8", "--ibf", "rpt",
+        "-o", "/out/01_1/oxasl", "--overwrite",
+    ]
+
+def test_oxasl_command_quoting():
+    # Paths with spaces and shell metacharacters stay single arguments
+    options = {"asl" : "/data/my study/sub-01 asl.nii.gz", "calib" : "/data/it's;m0.nii.gz", "output" : "/out/a b"}
+    cmd = oxasl.get_oxasl_command(options)
+    assert cmd == ["oxasl", "-i", "/data/my study/sub-01 asl.nii.gz", "-c", "/data/it's;m0.nii.gz", "-o", "/out/a b"]
+    assert shlex.split(oxasl.get_oxasl_command_line(options)) == cmd
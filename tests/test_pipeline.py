@@ -0,0 +1,128 @@
+"""
+Tests for submission of the pipeline stages
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+
+import pytest
+
+from brc_bids import ledger, pipeline, records, utils
+
+@pytest.fixture
+def fsl_sub(monkeypatch):
+    """
+    Replace fsl_sub with a fake returning incrementing job IDs
+
+    :return: List of fsl_sub commands run
+    """
+    calls, job_ids = [], itertools.count(100)
+    def check_output(cmd):
+        calls.append(cmd)
+        return f"{next(job_ids)}\n".encode("UTF-8")
+    monkeypatch.setattr(utils.subprocess, "check_output", check_output)
+    return calls
+
+def _args(outdir, **kwargs):
+    args = dict(output=str(outdir), bidsdir=str(outdir), cluster=True, array=False, submit_concurrency=1,
+                incremental=False, local_scratch=False, scratch_dir=None)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+def _stages(fail_subject=None):
+    def get_cmds(subject, session, data_files, outdir):
+        if subject == fail_subject:
+            raise RuntimeError(f"Failed to get commands for {subject}")
+        return [["first", subject, session]]
+    def get_cmds_second(subject, session, data_files, outdir):
+        return [["second", subject, session]]
+    return [
+        pipeline.Stage("first", get_cmds),
+        pipeline.Stage("second", get_cmds_second, needs=["first"]),
+    ]
+
+def _sessions(subjects, outdir=None, seen=None):
+    """
+    Generate sessions, recording the ledger keys present when each is taken
+    """
+    for subject in subjects:
+        if seen is not None:
+            seen.append(sorted(set([entry["key"] for entry in ledger.read(outdir)])))
+        yield records.SessionFiles(subject, "1", {})
+
+def test_sessions_recorded_as_submitted(tmp_path, fsl_sub):
+    seen = []
+    session_jobs = pipeline.run(_args(tmp_path), _sessions(["01", "02", "03"], str(tmp_path), seen), _stages())
+    assert seen == [[], ["01_1"], ["01_1", "02_1"]]
+    assert session_jobs[("02", "1")] == {"first" : "102", "second" : "103"}
+
+    entries = ledger.latest(ledger.read(str(tmp_path)))
+    assert len(entries) == 6
+    assert entries[("02_1", "second", 0)]["job"] == "103"
+    # The second stage holds on the first stage of the same session
+    assert fsl_sub[3][fsl_sub[3].index("-j") + 1] == "102"
+
+def test_failed_submission_keeps_submitted_sessions(tmp_path, fsl_sub):
+    with pytest.raises(RuntimeError):
+        pipeline.run(_args(tmp_path), _sessions(["01", "02", "03"]), _stages(fail_subject="02"))
+    entries = ledger.latest(ledger.read(str(tmp_path)))
+    assert sorted(set([key for key, _stage, _idx in entries])) == ["01_1"]
+
+def test_array_sessions_recorded_after_submission(tmp_path, fsl_sub):
+    pipeline.run(_args(tmp_path, array=True), _sessions(["01", "02"]), _stages())
+    entries = ledger.latest(ledger.read(str(tmp_path)))
+    assert entries[("01_1", "first", 0)]["job"] == "100.1"
+    assert entries[("02_1", "second", 0)]["job"] == "101.2"
+
+def test_incremental_holds_on_pending_jobs(tmp_path, fsl_sub, monkeypatch):
+    pipeline.run(_args(tmp_path), _sessions(["01"]), _stages())
+    # The first stage is still running, the second has failed
+    monkeypatch.setattr(pipeline.status, "pending_jobs", lambda outdir: {("01_1", "first") : ["100"]})
+    fsl_sub.clear()
+    session_jobs = pipeline.run(_args(tmp_path, incremental=True), _sessions(["01"]), _stages())
+    assert len(fsl_sub) == 1 and "second" in fsl_sub[0][-1]
+    assert fsl_sub[0][fsl_sub[0].index("-j") + 1] == "100"
+    assert session_jobs[("01", "1")]["first"] == ["100"]
+
+@pytest.fixture
+def fsl_sub_script(tmp_path, monkeypatch):
+    """
+    Put a fake fsl_sub on the PATH which takes a while to submit each job and logs
+    when it started and finished
+
+    :return: Function returning the logged calls as dicts with argv, start and end times, job ID
+    """
+    bindir, log = tmp_path / "bin", tmp_path / "fsl_sub.log"
+    bindir.mkdir()
+    script = bindir / "fsl_sub"
+    script.write_text(f"""#!{sys.executable}
+import json, os, sys, time
+start = time.time()
+time.sleep(0.2)
+with open({str(log)!r}, "a") as f:
+    f.write(json.dumps({{"argv" : sys.argv[1:], "start" : start, "end" : time.time(), "job" : str(os.getpid())}}) + "\\n")
+print(os.getpid())
+""")
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bindir) + os.pathsep + os.environ.get("PATH", ""))
+    return lambda: [json.loads(line) for line in log.read_text().splitlines()]
+
+def test_async_sessions_submitted_concurrently(tmp_path, fsl_sub_script):
+    args = _args(tmp_path / "out", submit_concurrency=4)
+    session_jobs = pipeline.run(args, _sessions(["01", "02", "03", "04"]), _stages())
+    calls = fsl_sub_script()
+    assert len(calls) == 8
+
+    # fsl_sub calls for different sessions overlap
+    assert any(a["start"] < b["end"] and b["start"] < a["end"] for a, b in itertools.combinations(calls, 2))
+
+    # Within each session the second stage is submitted after, and holds on, the first
+    for subject in ("01", "02", "03", "04"):
+        jobs = session_jobs[(subject, "1")]
+        first = [call for call in calls if call["job"] == jobs["first"]][0]
+        second = [call for call in calls if call["job"] == jobs["second"]][0]
+        assert second["start"] >= first["end"]
+        assert second["argv"][second["argv"].index("-j") + 1] == jobs["first"]
+        assert f"second {subject} 1" in second["argv"][-1]
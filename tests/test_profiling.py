@@ -0,0 +1,83 @@
+"""
+Tests for timing and counting instrumentation and the profile report
+"""
+import json
+import os
+import threading
+
+import pytest
+
+from brc_bids import profiling
+
+@pytest.fixture
+def enabled():
+    profiling.reset()
+    profiling.enable()
+    yield
+    profiling.disable()
+    profiling.reset()
+
+@profiling.timed()
+def _work(fail=False):
+    if fail:
+        raise ValueError("failed")
+    return 1
+
+def test_disabled_records_nothing():
+    profiling.reset()
+    with profiling.timer("section"):
+        profiling.count("files")
+    assert _work() == 1
+    assert profiling.summary() == {"sections" : {}, "counters" : {}}
+
+def test_write_report(enabled, tmp_path):
+    with profiling.timer("layout", files=3):
+        pass
+    for _idx in range(2):
+        _work()
+    with pytest.raises(ValueError):
+        _work(fail=True)
+    profiling.count("sidecar_reads")
+    profiling.count("sidecar_bytes", 100)
+    profiling.count("sidecar_bytes", 50)
+
+    fname = str(tmp_path / "profile.json")
+    profiling.write_report(fname)
+    with open(fname) as f:
+        report = json.load(f)
+
+    assert report["displayTimeUnit"] == "ms"
+    assert report["counters"] == {"sidecar_reads" : 1, "sidecar_bytes" : 150}
+    assert sorted(report["sections"]) == ["layout", "test_profiling._work"]
+    # Calls which raise are still timed
+    work = report["sections"]["test_profiling._work"]
+    assert work["calls"] == 3
+    assert 0 <= work["max"] <= work["total"]
+
+    # Trace events in the Chrome trace 'complete' event format
+    events = report["traceEvents"]
+    assert len(events) == 4
+    for event in events:
+        assert event["ph"] == "X" and event["cat"] == "brc_bids"
+        assert event["ts"] >= 0 and event["dur"] >= 0
+        assert event["pid"] == os.getpid()
+    layout = [event for event in events if event["name"] == "layout"][0]
+    assert layout["args"] == {"files" : 3}
+    assert "args" not in [event for event in events if event["name"] != "layout"][0]
+
+def test_counters_threads(enabled):
+    def _count():
+        for _idx in range(1000):
+            profiling.count("calls")
+    threads = [threading.Thread(target=_count) for _idx in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert profiling.summary()["counters"] == {"calls" : 4000}
+
+def test_reset(enabled):
+    with profiling.timer("section"):
+        profiling.count("files")
+    profiling.reset()
+    assert profiling.summary() == {"sections" : {}, "counters" : {}}
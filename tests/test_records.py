@@ -0,0 +1,66 @@
+"""
+Tests for the lightweight records of BIDS files
+"""
+import pickle
+
+import pytest
+
+from brc_bids import records
+
+@pytest.fixture
+def record():
+    context = records.FileRecord("/ds/sub-01/perf/sub-01_aslcontext.tsv", {"subject" : "01", "suffix" : "aslcontext"})
+    return records.FileRecord(
+        "/ds/sub-01/perf/sub-01_asl.nii.gz",
+        {"subject" : "01", "suffix" : "asl", "extension" : ".nii.gz"},
+        {"PostLabelingDelay" : 1.8},
+        [context],
+    )
+
+def test_file_record_immutable(record):
+    with pytest.raises(AttributeError):
+        record.path = "/other.nii.gz"
+    with pytest.raises(AttributeError):
+        del record.metadata
+    with pytest.raises(TypeError):
+        record.entities["subject"] = "02"
+    with pytest.raises(TypeError):
+        record.metadata["PostLabelingDelay"] = 2.0
+    assert isinstance(record.associations, tuple)
+
+def test_file_record_metadata_not_copied():
+    metadata = {"PostLabelingDelay" : 1.8}
+    record = records.FileRecord("/ds/sub-01_asl.nii.gz", {}, metadata)
+    # The record is a view of the metadata resolved from the sidecars
+    metadata["M0Type"] = "Included"
+    assert record.get_metadata()["M0Type"] == "Included"
+
+def test_file_record_pickle(record):
+    copy = pickle.loads(pickle.dumps(record))
+    assert copy == record and copy.path == record.path
+    assert dict(copy.entities) == dict(record.entities)
+    assert dict(copy.metadata) == {"PostLabelingDelay" : 1.8}
+    assert copy.associations == record.associations
+    assert copy.associations[0].entities["suffix"] == "aslcontext"
+    with pytest.raises(TypeError):
+        copy.entities["subject"] = "02"
+
+def test_file_record_pickle_no_metadata():
+    record = records.FileRecord("/ds/sub-01_T1w.nii.gz", {"suffix" : "T1w"})
+    assert pickle.loads(pickle.dumps(record)).metadata is None
+
+def test_session_files_immutable(record):
+    session_files = records.SessionFiles("01", None, {"asl" : [record], "T1w" : []})
+    assert session_files["asl"] == (record, )
+    assert sorted(session_files) == ["T1w", "asl"]
+    with pytest.raises(AttributeError):
+        session_files.subject = "02"
+    with pytest.raises(TypeError):
+        session_files["T1w"] = (record, )
+
+def test_session_files_pickle(record):
+    session_files = records.SessionFiles("01", "1", {"asl" : [record]})
+    copy = pickle.loads(pickle.dumps(session_files))
+    assert (copy.subject, copy.session) == ("01", "1")
+    assert copy["asl"] == (record, )
+    assert dict(copy["asl"][0].metadata) == {"PostLabelingDelay" : 1.8}
@@ -0,0 +1,43 @@
+"""
+Tests for subject selection and sharding
+"""
+import pytest
+
+from brc_bids import shard
+
+def test_parse_shard():
+    assert shard.parse_shard("2/4") == (2, 4)
+    with pytest.raises(ValueError):
+        shard.parse_shard("5/4")
+    with pytest.raises(ValueError):
+        shard.parse_shard("x")
+
+def test_split_count():
+    assert shard.split(["03", "01", "02", "04", "05"], 2) == [["01", "03", "05"], ["02", "04"]]
+
+def test_split_size():
+    sizes = {"01" : 10, "02" : 5, "03" : 4, "04" : 1}
+    assert shard.split(sizes, 2, sizes) == [["01"], ["02", "03", "04"]]
+
+def test_merge_manifests(tmp_path):
+    outdir = str(tmp_path)
+    subjects = ["01", "02", "03", "04"]
+    for idx in (1, 3):
+        shard_subjects = shard.split(subjects, 3)[idx-1]
+        session_jobs = {(subj, "1") : {"struc" : "10" + subj} for subj in shard_subjects}
+        shard.write_manifest(shard.manifest_path(outdir, (idx, 3)), (idx, 3), shard_subjects, session_jobs)
+
+    fnames = shard.find_manifests(outdir)
+    assert len(fnames) == 2
+    merged = shard.merge_manifests(fnames)
+    assert merged["subjects"] == ["01", "03", "04"]
+    assert [sess["subject"] for sess in merged["sessions"]] == ["01", "03", "04"]
+    assert merged["sessions"][0]["jobs"] == {"struc" : ["1001"]}
+    assert shard.missing_shards(merged) == ["2/3"]
+
+def test_merge_overlapping_manifests(tmp_path):
+    outdir = str(tmp_path)
+    for idx in (1, 2):
+        shard.write_manifest(shard.manifest_path(outdir, (idx, 2)), (idx, 2), ["01"], {})
+    with pytest.raises(ValueError):
+        shard.merge_manifests(shard.find_manifests(outdir))
@@ -0,0 +1,99 @@
+"""
+Tests for resolving JSON sidecar metadata using the BIDS inheritance principle
+"""
+import json
+import os
+
+import pytest
+
+from brc_bids import sidecars
+
+def _write(path, data=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        if data is not None:
+            json.dump(data, f)
+
+@pytest.fixture
+def bidsdir(tmp_path):
+    """
+    Dataset with sidecars at the top, subject, session and datatype levels
+    """
+    sidecars.clear_cache()
+    root = str(tmp_path / "ds")
+    _write(os.path.join(root, "dataset_description.json"), {"Name" : "test", "BIDSVersion" : "1.6.0"})
+    _write(os.path.join(root, "dwi.json"), {"EffectiveEchoSpacing" : 0.0005, "Level" : "top"})
+    _write(os.path.join(root, "T1w.json"), {"Level" : "top", "Top" : True})
+    _write(os.path.join(root, "acq-hi_T1w.json"), {"Acq" : "hi"})
+    _write(os.path.join(root, "sub-01", "sub-01_T1w.json"), {"Level" : "subject", "Subject" : True})
+    _write(os.path.join(root, "sub-01", "ses-1", "sub-01_ses-1_T1w.json"), {"Level" : "session"})
+    anat = os.path.join(root, "sub-01", "ses-1", "anat")
+    _write(os.path.join(anat, "sub-01_ses-1_T1w.nii.gz"))
+    _write(os.path.join(anat, "sub-01_ses-1_acq-hi_T1w.nii.gz"))
+    _write(os.path.join(anat, "sub-01_ses-1_acq-lo_T1w.json"), {"Acq" : "lo"})
+    _write(os.path.join(anat, "sub-01_ses-1_dwi.json"), {"Level" : "anat"})
+    _write(os.path.join(root, "sub-01", "ses-1", "dwi", "sub-01_ses-1_dwi.nii.gz"))
+    _write(os.path.join(root, "sub-02", "anat", "sub-02_T1w.nii.gz"))
+    return root
+
+def _path(root, *parts):
+    return os.path.join(root, "sub-01", "ses-1", *parts)
+
+def test_parse_filename():
+    assert sidecars._parse_filename("sub-01_ses-1_acq-hi_T1w.nii.gz") == ({"sub" : "01", "ses" : "1", "acq" : "hi"}, "T1w")
+    assert sidecars._parse_filename("dwi.json") == ({}, "dwi")
+
+def test_top_level_inheritance(bidsdir):
+    image = _path(bidsdir, "dwi", "sub-01_ses-1_dwi.nii.gz")
+    # The dwi sidecar in the anat directory does not apply to the dwi datatype
+    assert sidecars.find_sidecars(image) == [os.path.join(bidsdir, "dwi.json")]
+    assert sidecars.get_metadata(image) == {"EffectiveEchoSpacing" : 0.0005, "Level" : "top"}
+
+def test_entity_subset(bidsdir):
+    # Sidecars with an entity which is not in the file name do not apply
+    image = _path(bidsdir, "anat", "sub-01_ses-1_T1w.nii.gz")
+    assert "Acq" not in sidecars.get_metadata(image)
+    image = _path(bidsdir, "anat", "sub-01_ses-1_acq-hi_T1w.nii.gz")
+    assert sidecars.get_metadata(image)["Acq"] == "hi"
+
+def test_session_subject_level(bidsdir):
+    image = _path(bidsdir, "anat", "sub-01_ses-1_T1w.nii.gz")
+    assert sidecars.get_metadata(image) == {"Level" : "session", "Top" : True, "Subject" : True}
+    # Another subject only inherits the top level sidecar
+    image = os.path.join(bidsdir, "sub-02", "anat", "sub-02_T1w.nii.gz")
+    assert sidecars.get_metadata(image) == {"Level" : "top", "Top" : True}
+
+def test_override_order(bidsdir):
+    image = _path(bidsdir, "anat", "sub-01_ses-1_acq-hi_T1w.nii.gz")
+    assert sidecars.find_sidecars(image) == [
+        os.path.join(bidsdir, "T1w.json"),
+        os.path.join(bidsdir, "acq-hi_T1w.json"),
+        os.path.join(bidsdir, "sub-01", "sub-01_T1w.json"),
+        _path(bidsdir, "sub-01_ses-1_T1w.json"),
+    ]
+    _write(_path(bidsdir, "anat", "sub-01_ses-1_acq-hi_T1w.json"), {"Level" : "file", "Acq" : "file"})
+    assert sidecars.get_metadata(image, revalidate=True) == {"Level" : "file", "Top" : True, "Subject" : True, "Acq" : "file"}
+
+def test_sidecar_has_no_metadata(bidsdir):
+    assert sidecars.get_metadata(os.path.join(bidsdir, "sub-01", "sub-01_T1w.json")) == {}
+
+def test_revalidate(bidsdir):
+    image = _path(bidsdir, "dwi", "sub-01_ses-1_dwi.nii.gz")
+    metadata = sidecars.get_metadata(image)
+    _write(os.path.join(bidsdir, "dwi.json"), {"EffectiveEchoSpacing" : 0.001})
+
+    # Cached metadata is returned until it is revalidated
+    assert sidecars.get_metadata(image) is metadata
+    assert sidecars.get_metadata(image, revalidate=True) == {"EffectiveEchoSpacing" : 0.001}
+
+    # Unchanged content keeps the same metadata even if the sidecar is touched
+    metadata = sidecars.get_metadata(image)
+    stat = os.stat(os.path.join(bidsdir, "dwi.json"))
+    os.utime(os.path.join(bidsdir, "dwi.json"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert sidecars.get_metadata(image, revalidate=True) is metadata
+
+def test_prefetch(bidsdir):
+    images = [_path(bidsdir, "dwi", "sub-01_ses-1_dwi.nii.gz"), _path(bidsdir, "anat", "sub-01_ses-1_T1w.nii.gz")]
+    sidecars.prefetch(images, workers=2)
+    assert sidecars._METADATA[images[0]][1]["Level"] == "top"
+    assert sidecars._METADATA[images[1]][1]["Level"] == "session"
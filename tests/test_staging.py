@@ -0,0 +1,72 @@
+"""
+Tests for running pipeline commands on node-local scratch
+"""
+import json
+import os
+import sys
+
+from brc_bids import staging
+
+# Fake stage command: copies the file after --in into <path>/<subject>/<stage>/out.txt and
+# lists the files it can see under <path>/<subject>
+SCRIPT = """
+import os, sys
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+sessdir = os.path.join(args["--path"], args["--subject"])
+seen = sorted(os.path.relpath(os.path.join(d, f), sessdir) for d, _, fs in os.walk(sessdir) for f in fs)
+os.makedirs(os.path.join(sessdir, args["--stage"]), exist_ok=True)
+with open(os.path.join(sessdir, args["--stage"], "out.txt"), "w") as f:
+    f.write(open(args["--in"]).read() + "\\n" + "\\n".join(seen))
+"""
+
+def _write(path, content="data"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+def _cmd(infile, outdir, stage):
+    return [sys.executable, "-c", SCRIPT, "--in", infile, "--path", outdir, "--subject", "01_1", "--stage", stage]
+
+def _seen(outdir, stage):
+    with open(os.path.join(outdir, "01_1", stage, "out.txt")) as f:
+        return f.read().splitlines()[1:]
+
+def test_wrap_cmd():
+    assert staging.wrap_cmd(["cmd", "a"], "out", "01_1", "dwi", ["struc"], "/scratch") == [
+        "brc_bids", "staged", "--output", "out", "--session", "01_1", "--stage", "dwi",
+        "--need", "struc", "--scratch", "/scratch", "--", "cmd", "a"
+    ]
+
+def test_stage_only_needed_outputs(tmp_path):
+    outdir, infile = str(tmp_path / "out"), str(tmp_path / "bids" / "sub-01_T1w.nii.gz")
+    _write(infile, "T1")
+    _write(str(tmp_path / "bids" / "sub-01_T1w.json"), "{}")
+    _write(os.path.join(outdir, "01_1", "other", "big.nii.gz"))
+    scratch = str(tmp_path / "scratch" / "not" / "created")
+
+    assert staging.run_staged(_cmd(infile, outdir, "struc"), outdir, "01_1", "struc", scratch=scratch) == 0
+    with open(os.path.join(outdir, "01_1", "struc", "out.txt")) as f:
+        assert f.read().splitlines()[0] == "T1"
+    assert _seen(outdir, "struc") == []
+    with open(staging.outputs_path(outdir, "01_1", "struc")) as f:
+        assert json.load(f) == [os.path.join("01_1", "struc", "out.txt")]
+
+    # Only the recorded outputs of the needed stage are staged in
+    assert staging.run_staged(_cmd(infile, outdir, "dwi"), outdir, "01_1", "dwi", ["struc"], scratch=scratch) == 0
+    assert _seen(outdir, "dwi") == [os.path.join("struc", "out.txt")]
+    assert os.listdir(scratch) == []
+
+def test_stage_unrecorded_needs(tmp_path):
+    # If a needed stage was not run staged, the whole session is staged in
+    outdir, infile = str(tmp_path / "out"), str(tmp_path / "in.txt")
+    _write(infile)
+    _write(os.path.join(outdir, "01_1", "struc", "T1.nii.gz"))
+    assert staging.run_staged(_cmd(infile, outdir, "dwi"), outdir, "01_1", "dwi", ["struc"], scratch=str(tmp_path)) == 0
+    assert _seen(outdir, "dwi") == [os.path.join("struc", "T1.nii.gz")]
+
+def test_failed_cmd_not_synced(tmp_path):
+    outdir = str(tmp_path / "out")
+    cmd = ["/bin/sh", "-c", 'mkdir -p "$0/01_1" && touch "$0/01_1/partial" && exit 3', outdir]
+    assert staging.run_staged(cmd, outdir, "01_1", "struc", scratch=str(tmp_path / "scratch")) == 3
+    assert not os.path.exists(os.path.join(outdir, "01_1", "partial"))
+    assert not os.path.exists(staging.outputs_path(outdir, "01_1", "struc"))
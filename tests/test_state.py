@@ -0,0 +1,64 @@
+"""
+Tests for the pipeline state used by incremental re-runs
+"""
+import json
+import os
+
+from brc_bids import ledger, state, status
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+def _dataset(root):
+    _write_json(os.path.join(root, "dataset_description.json"), {"Name" : "test", "BIDSVersion" : "1.6.0"})
+    _write_json(os.path.join(root, "dwi.json"), {"EffectiveEchoSpacing" : 0.0005})
+    image = os.path.join(root, "sub-01", "ses-1", "dwi", "sub-01_ses-1_dwi.nii.gz")
+    os.makedirs(os.path.dirname(image))
+    with open(image, "wb") as f:
+        f.write(b"image")
+    return image
+
+def test_marker_path_absolute(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    marker = state.marker_path("out", "01_1", "struc", 0)
+    assert os.path.isabs(marker)
+    assert marker == str(tmp_path / "out" / ".brc_bids" / "state" / "01_1" / "struc.0.done")
+
+def test_input_files_include_inherited_sidecars(tmp_path):
+    image = _dataset(str(tmp_path / "ds"))
+    inputs = state.input_files([["dwi", "--input", image]])
+    assert str(tmp_path / "ds" / "dwi.json") in inputs
+    assert image in inputs
+
+def test_inherited_sidecar_change_not_up_to_date(tmp_path):
+    image = _dataset(str(tmp_path / "ds"))
+    outdir = str(tmp_path / "out")
+    cmds = [["dwi", "--input", image]]
+    state.prepare(outdir, "01_1", "dwi", cmds)
+    open(state.marker_path(outdir, "01_1", "dwi", 0), "w").close()
+    assert state.is_up_to_date(outdir, "01_1", "dwi", cmds)
+
+    _write_json(str(tmp_path / "ds" / "dwi.json"), {"EffectiveEchoSpacing" : 0.00055})
+    assert not state.is_up_to_date(outdir, "01_1", "dwi", cmds)
+
+def test_pending_jobs(tmp_path, monkeypatch):
+    outdir = str(tmp_path)
+    markers = [state.marker_path(outdir, key, "struc", 0) for key in ("01_1", "01_2", "02_1")]
+    entries = []
+    for key, job, marker in zip(("01_1", "01_2", "02_1"), ("100", "101", "102.3"), markers):
+        entries.extend(ledger.entries("run1", key, "struc", [["struc"]], [job], [marker], True))
+    ledger.append(outdir, entries)
+    open(markers[1], "w").close()
+
+    monkeypatch.setattr(status, "_query_slurm", lambda job_ids: {"100" : {None : status.FAILED}, "102" : {"[1-4]" : status.QUEUED}})
+    assert status.pending_jobs(outdir, "slurm") == {("02_1", "struc") : ["102"]}
+
+def test_input_files_skip_split_cache(tmp_path):
+    asl = tmp_path / "asl.nii.gz"
+    split = tmp_path / "out" / ".brc_bids" / state.SPLIT_DIRNAME / "0123" / "asl.nii.gz"
+    os.makedirs(str(split.parent))
+    for path in (asl, split):
+        open(str(path), "w").close()
+    assert state.input_files([["brc_bids", "aslsplit", "--input", str(asl), "--", "oxasl", "-i", str(split)]]) == [str(asl)]
@@ -0,0 +1,109 @@
+"""
+Tests for resolving the status of submitted jobs from scheduler output
+"""
+import os
+
+import pytest
+
+from brc_bids import ledger, status
+
+SACCT_OUTPUT = """100|COMPLETED
+101|RUNNING
+102_[3-5%2]|PENDING
+102_1|RUNNING
+102_2|FAILED
+103|CANCELLED by 1234
+104|PENDING
+105|
+"""
+
+QSTAT_OUTPUT = """job-ID  prior   name       user         state submit/start at     queue                          slots ja-task-ID
+-----------------------------------------------------------------------------------------------------------------
+    200 0.55500 struc      user         r     01/01/2024 10:00:00 all.q@node1                        1
+    201 0.55500 dwi        user         qw    01/01/2024 10:00:00                                    1
+    202 0.55500 arr        user         r     01/01/2024 10:00:00 all.q@node2                        1 1
+    202 0.55500 arr        user         qw    01/01/2024 10:00:00                                    1 2-10:2
+    203 0.55500 bad        user         Eqw   01/01/2024 10:00:00                                    1
+"""
+
+@pytest.fixture
+def scheduler_output(monkeypatch):
+    """
+    Replace sacct and qstat with fakes returning fixed output
+
+    :return: List of commands run
+    """
+    calls = []
+    def check_output(cmd):
+        calls.append(cmd)
+        return (SACCT_OUTPUT if cmd[0] == "sacct" else QSTAT_OUTPUT).encode("UTF-8")
+    monkeypatch.setattr(status.subprocess, "check_output", check_output)
+    return calls
+
+def test_query_slurm(scheduler_output):
+    job_states = status._query_slurm(["100", "101", "102", "103", "104", "105"])
+    assert job_states == {
+        "100" : {None : status.FAILED},
+        "101" : {None : status.RUNNING},
+        "102" : {"[3-5%2]" : status.QUEUED, "1" : status.RUNNING, "2" : status.FAILED},
+        "103" : {None : status.FAILED},
+        "104" : {None : status.QUEUED},
+    }
+
+def test_query_slurm_chunked(scheduler_output, monkeypatch):
+    monkeypatch.setattr(status, "SACCT_CHUNK", 2)
+    status._query_slurm(["100", "101", "102", "103", "104"])
+    assert [cmd[-1] for cmd in scheduler_output] == ["100,101", "102,103", "104"]
+
+def test_query_sge(scheduler_output):
+    assert status._query_sge() == {
+        "200" : {None : status.RUNNING},
+        "201" : {None : status.QUEUED},
+        "202" : {"1" : status.RUNNING, "2-10:2" : status.QUEUED},
+        "203" : {None : status.FAILED},
+    }
+
+@pytest.mark.parametrize("task_id, tasks, expected", [
+    ("4", "[3-5%2]", True),
+    ("6", "[3-5%2]", False),
+    ("5", "[1,3,5-7]", True),
+    ("2", "[1,3,5-7]", False),
+    ("6", "2-10:2", True),
+    ("7", "2-10:2", False),
+    ("4", "2,4", True),
+])
+def test_in_range(task_id, tasks, expected):
+    assert status._in_range(task_id, tasks) == expected
+
+def _ledger_entries(outdir, scheduler_jobs):
+    entries = []
+    for key, job in scheduler_jobs:
+        marker = os.path.join(outdir, f"{key}.done")
+        entries.extend(ledger.entries("run1", key, "struc", [["struc", key]], [job], [marker], True))
+    return ledger.latest(entries)
+
+def test_resolve_slurm(tmp_path, scheduler_output):
+    outdir = str(tmp_path)
+    entries = _ledger_entries(outdir, [("a", "101"), ("b", "102.4"), ("c", "102.2"), ("d", "104"), ("e", "999"), ("f", "100")])
+    # Finished jobs with a marker are done without asking the scheduler
+    open(os.path.join(outdir, "f.done"), "w").close()
+    states = status.resolve(entries, "slurm")
+    assert {key : state for (key, _stage, _idx), state in states.items()} == {
+        "a" : status.RUNNING, "b" : status.QUEUED, "c" : status.FAILED, "d" : status.QUEUED,
+        "e" : status.FAILED, "f" : status.DONE,
+    }
+    # One sacct call for all the jobs, not including the one which is done
+    assert len(scheduler_output) == 1
+    assert scheduler_output[0][-1] == "101,102,104,999"
+
+def test_resolve_sge(tmp_path, scheduler_output):
+    entries = _ledger_entries(str(tmp_path), [("a", "200"), ("b", "202.1"), ("c", "202.6"), ("d", "202.7"), ("e", "203")])
+    states = status.resolve(entries, "sge")
+    assert {key : state for (key, _stage, _idx), state in states.items()} == {
+        "a" : status.RUNNING, "b" : status.RUNNING, "c" : status.QUEUED, "d" : status.FAILED, "e" : status.FAILED,
+    }
+
+def test_resolve_markers_only(tmp_path, scheduler_output):
+    entries = _ledger_entries(str(tmp_path), [("a", "200")])
+    assert list(status.resolve(entries, "markers").values()) == [status.INCOMPLETE]
+    assert scheduler_output == []
@@ -0,0 +1,104 @@
+"""
+Tests for transferring output files
+"""
+import errno
+import os
+
+import pytest
+
+from brc_bids import transfer
+
+def _write(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def _unsupported(err):
+    def _fail(*args, **kwargs):
+        raise OSError(err, os.strerror(err))
+    return _fail
+
+@pytest.fixture
+def src(tmp_path):
+    path = str(tmp_path / "src.nii.gz")
+    _write(path, b"image data")
+    os.chmod(path, 0o640)
+    return path
+
+def _tmp_files(dirpath):
+    return [name for name in os.listdir(dirpath) if name.endswith(".tmp")]
+
+def test_default_does_not_link(src, tmp_path, monkeypatch):
+    monkeypatch.setattr(transfer, "_reflink", _unsupported(errno.EOPNOTSUPP))
+    dest = str(tmp_path / "dest.nii.gz")
+    assert transfer.transfer_file(src, dest) == "sendfile"
+    assert _read(dest) == b"image data"
+    assert not os.path.samefile(src, dest)
+    assert os.stat(dest).st_mode & 0o777 == 0o640
+
+def test_link_opt_in(src, tmp_path):
+    dest = str(tmp_path / "dest.nii.gz")
+    assert transfer.transfer_file(src, dest, methods=transfer.LINK_METHODS) == "link"
+    assert os.path.samefile(src, dest)
+
+def test_link_falls_back(src, tmp_path, monkeypatch):
+    # e.g. the destination is on another filesystem
+    monkeypatch.setattr(transfer.os, "link", _unsupported(errno.EXDEV))
+    monkeypatch.setattr(transfer, "_reflink", _unsupported(errno.ENOTTY))
+    dest = str(tmp_path / "dest.nii.gz")
+    assert transfer.transfer_file(src, dest, methods=transfer.LINK_METHODS) == "sendfile"
+    assert _read(dest) == b"image data"
+
+def test_reflink(src, tmp_path, monkeypatch):
+    def _reflink(src, dest):
+        _write(dest, _read(src))
+    monkeypatch.setattr(transfer, "_reflink", _reflink)
+    dest = str(tmp_path / "dest.nii.gz")
+    assert transfer.transfer_file(src, dest) == "reflink"
+    assert _read(dest) == b"image data"
+
+def test_copy_fallback(src, tmp_path, monkeypatch):
+    monkeypatch.setattr(transfer, "_reflink", _unsupported(errno.EOPNOTSUPP))
+    monkeypatch.setattr(transfer.os, "sendfile", _unsupported(errno.EINVAL))
+    dest = str(tmp_path / "dest.nii.gz")
+    assert transfer.transfer_file(src, dest) == "copy"
+    assert _read(dest) == b"image data"
+    assert _tmp_files(str(tmp_path)) == []
+
+def test_error_not_hidden(src, tmp_path, monkeypatch):
+    # Errors other than an unsupported method are raised without leaving a partial file
+    monkeypatch.setattr(transfer, "_reflink", _unsupported(errno.ENOSPC))
+    dest = str(tmp_path / "dest.nii.gz")
+    with pytest.raises(OSError):
+        transfer.transfer_file(src, dest)
+    assert not os.path.exists(dest)
+    assert _tmp_files(str(tmp_path)) == []
+
+def test_skip_same(src, tmp_path, monkeypatch):
+    dest = str(tmp_path / "dest.nii.gz")
+    _write(dest, b"image data")
+    monkeypatch.setattr(transfer, "_transfer", _unsupported(errno.EIO))
+    assert transfer.transfer_file(src, dest) == "skipped"
+
+def test_skip_same_file_without_hashing(src, tmp_path, monkeypatch):
+    dest = str(tmp_path / "dest.nii.gz")
+    os.link(src, dest)
+    monkeypatch.setattr(transfer, "file_hash", _unsupported(errno.EIO))
+    assert transfer.is_same(src, dest)
+
+def test_replace_changed(src, tmp_path):
+    # Same size but different contents
+    dest = str(tmp_path / "dest.nii.gz")
+    _write(dest, b"IMAGE DATA")
+    assert not transfer.is_same(src, dest)
+    assert transfer.transfer_file(src, dest) != "skipped"
+    assert _read(dest) == b"image data"
+
+def test_transfer_files_counts(src, tmp_path, monkeypatch):
+    monkeypatch.setattr(transfer, "_reflink", _unsupported(errno.EOPNOTSUPP))
+    _write(str(tmp_path / "dest1.nii.gz"), b"image data")
+    pairs = [(src, str(tmp_path / f"dest{idx}.nii.gz")) for idx in range(3)]
+    assert transfer.transfer_files(pairs, workers=2) == {"sendfile" : 2, "skipped" : 1}